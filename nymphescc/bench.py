@@ -0,0 +1,395 @@
+# ~\~ language=Python filename=nymphescc/bench.py
+# ~\~ begin <<lit/benchmarks.md|nymphescc/bench.py>>[0]
+from __future__ import annotations
+import argparse
+from collections import deque
+from dataclasses import is_dataclass
+from datetime import datetime
+import functools
+from importlib import resources
+import itertools
+import json
+import logging
+import os
+from pathlib import Path
+import platform
+import queue
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import types
+import typing
+from typing import Callable, Iterable, Optional, Union
+
+import dhall
+
+from .messages import construct, read_settings, Group, _builders
+from .core import Register, BytesPort, EchoSuppressor, CONTROL_CHANGE
+from .db import NymphesDB
+from .trace import Tracer
+from .compare import Comparator
+from .generate import Generator, store
+from .engine import Engine
+from .sim import SimulatedClock, SimulatedNymphes
+from . import maintenance
+
+
+Result = dict[str, float]
+Results = dict[str, Result]
+
+
+def timed(f: Callable[[], object], repeat: int = 5, number: int = 10,
+          items: Optional[int] = None) -> Result:
+    """Time `f`, returns the best and median time per call in seconds. If
+    `f` processes a number of `items`, the throughput (items/s) is added."""
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        for _ in range(number):
+            f()
+        times.append((time.perf_counter() - t0) / number)
+    result = { "best": min(times), "median": statistics.median(times) }
+    if items is not None:
+        result["throughput"] = items / result["median"]
+    return result
+
+
+def reference_construct(annot, json):
+    """Reflective implementation of `construct`, kept as a baseline."""
+    if annot is str:
+        assert isinstance(json, str)
+        return json
+    if annot is int:
+        assert isinstance(json, int)
+        return json
+    if typing.get_origin(annot) is list:
+        assert isinstance(json, list)
+        return [reference_construct(typing.get_args(annot)[0], item) for item in json]
+    if typing.get_origin(annot) is Union \
+        and typing.get_args(annot)[1] is types.NoneType:
+        if json is None:
+            return None
+        else:
+            return reference_construct(typing.get_args(annot)[0], json)
+    if is_dataclass(annot):
+        assert isinstance(json, dict)
+        arg_annot = typing.get_type_hints(annot)
+        assert all(k in json for k in arg_annot)
+        args = { k: reference_construct(v, json[k])
+                 for k, v in arg_annot.items() }
+        return annot(**args)
+
+
+def bench_construct() -> Results:
+    with resources.open_text(__package__, "messages.dhall") as inp:
+        raw_data = dhall.load(inp)
+    return { "construct.reference": timed(lambda: reference_construct(list[Group], raw_data))
+           , "construct.compiled": timed(lambda: construct(list[Group], raw_data)) }
+
+
+def bench_settings() -> Results:
+    def cold():
+        _builders.clear()
+        read_settings()
+    return { "read_settings.cold": timed(cold, number=1)
+           , "read_settings.warm": timed(read_settings, number=1) }
+
+
+def bench_register() -> Results:
+    register = Register.new()
+    port = BytesPort()
+    register.send_all(port)
+    stream = bytes(port.bytes) * 100
+    n_msgs = len(stream) // 3
+    return { "register.new": timed(Register.new, number=1)
+           , "register.send_all": timed(lambda: register.send_all(BytesPort()), number=100)
+           , "bytes_port.read_cc": timed(
+                lambda: deque(BytesPort(stream).read_cc(None), maxlen=0),
+                number=1, items=n_msgs) }
+
+
+def synthetic_stream(register: Register, n: int, seed: int = 0) -> bytes:
+    """Random CC messages for known parameters, about one in ten of them
+    switching the modulator."""
+    rng = random.Random(seed)
+    params = [p for p in register.midi_map if p != register.plan.selector]
+    buffer = bytearray()
+    for _ in range(n):
+        if rng.random() < 0.1:
+            buffer.extend((CONTROL_CHANGE, register.plan.selector, rng.randrange(4)))
+        else:
+            buffer.extend((CONTROL_CHANGE, rng.choice(params), rng.randrange(128)))
+    return bytes(buffer)
+
+
+def bench_ingest(n: int = 100_000) -> Results:
+    register = Register.new()
+    echo = EchoSuppressor()
+    stream = synthetic_stream(register, n)
+    messages = list(BytesPort(stream).read_cc(None))
+
+    def ingest(echo=None):
+        port = BytesPort()
+        deque(register.ingest(port, messages, echo), maxlen=0)
+
+    logging.disable(logging.WARNING)
+    try:
+        return { "register.ingest": timed(ingest, number=1, items=n)
+               , "register.ingest.echo": timed(lambda: ingest(echo), number=1, items=n) }
+    finally:
+        logging.disable(logging.NOTSET)
+
+
+def bench_trace(n: int = 100_000) -> Results:
+    """Cost of tracing the path of a message, when disabled and enabled."""
+    def trace_path(tracer):
+        for _ in range(n):
+            token = tracer.start("a")
+            tracer.stamp(token, "b")
+            tracer.finish(token, "c")
+    enabled = Tracer()
+    enabled.enable()
+    return { "trace.disabled": timed(lambda: trace_path(Tracer()), number=1, items=n)
+           , "trace.enabled": timed(lambda: trace_path(enabled), number=1, items=n) }
+
+
+def bench_compare(n: int = 10_000, seed: int = 0) -> Results:
+    """Diff two patches, and rank a group of `n` snapshots against the
+    live state."""
+    register = Register.new()
+    rng = random.Random(seed)
+    states = [bytes(rng.randrange(128) for _ in register.plan.slots) for _ in range(n)]
+    midis = [register.plan.encode_state(state) for state in states]
+    comparator = Comparator(register)
+    live = register.snapshot()
+    return { "compare.diff": timed(lambda: comparator.diff(live, midis[0]), number=100)
+           , "compare.rank": timed(lambda: comparator.rank(live, midis), number=1, items=n) }
+
+
+def bench_generate(n: int = 10_000) -> Results:
+    """Generate `n` variations of the live state and store them in a new
+    group, then index their parameters."""
+    register = Register.new()
+    generator = Generator(register)
+    live = register.snapshot()
+    results = { "generate.variations": timed(
+        lambda: generator.variations(live, n, seed=0), number=1, items=n) }
+    with tempfile.TemporaryDirectory() as tmp:
+        db = NymphesDB(Path(tmp) / "bench.db", decode=register.decode)
+        results["generate.store"] = timed(
+            lambda: store(db, generator, "bench", generator.variations(live, n)),
+            repeat=3, number=1, items=n)
+        t0 = time.perf_counter()
+        count = db.index_parameters()
+        dt = time.perf_counter() - t0
+        results["generate.index"] = { "best": dt, "median": dt, "throughput": count / dt }
+        db.close()
+    return results
+
+
+def bench_db(sizes: Iterable[int] = (10_000, 100_000)) -> Results:
+    register = Register.new()
+    midi = register.plan.encode(register.values)
+    results = {}
+    for size in sizes:
+        with tempfile.TemporaryDirectory() as tmp:
+            db = NymphesDB(Path(tmp) / "bench.db")
+            group_id = db.new_group("bench")
+            t0 = time.perf_counter()
+            db.new_snapshots(group_id, itertools.repeat(midi, size))
+            dt = time.perf_counter() - t0
+            results[f"db.{size}.bulk_insert"] = \
+                { "best": dt, "median": dt, "throughput": size / dt }
+            ids = [s.key for s in db.snapshots_page(group_id, 0, size)]
+            rng = random.Random(0)
+
+            def recall():
+                snapshot = db.snapshot(rng.choice(ids))
+                register.load_midi(snapshot.midi)
+
+            results |= {
+                f"db.{size}.insert": timed(lambda: db.new_snapshot(group_id, midi), number=5),
+                f"db.{size}.count": timed(lambda: db.snapshot_count(group_id)),
+                f"db.{size}.page": timed(
+                    lambda: db.snapshots_page(group_id, rng.randrange(size), 100)),
+                f"db.{size}.list": timed(lambda: db.snapshots(group_id), repeat=3, number=1),
+                f"db.{size}.recall": timed(recall) }
+            db.close()
+    return results
+
+
+def bench_maintenance(size: int = 10_000, seed: int = 0) -> Results:
+    """Maintenance jobs on a database of `size` random snapshots, with one
+    worker process up to one per core, to show how they scale."""
+    register = Register.new()
+    rng = random.Random(seed)
+    cores = os.cpu_count() or 1
+    counts = sorted({min(2 ** i, cores) for i in range(cores.bit_length() + 1)})
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        path = Path(tmp) / "bench.db"
+        db = NymphesDB(path)
+        db.new_snapshots(db.new_group("bench"), (
+            register.plan.encode_state(bytes(rng.randrange(128) for _ in register.plan.slots))
+            for _ in range(size)))
+        db.close()
+        for job in ("index", "validate"):
+            for workers in counts:
+                results[f"maintenance.{job}.{workers}"] = timed(
+                    lambda: maintenance.run_job(path, job, workers, resume=False),
+                    repeat=3, number=1, items=size)
+    return results
+
+
+def bench_sequencer(steps: int = 16, bpm: float = 120) -> Results:
+    """Timing error of sequenced steps against a simulated clock, with
+    and without jitter on the ticks, and with CCs sent by hand on every
+    tick. The steps go through the engine to a simulated device that
+    takes the time of the wire, and are timed once they are sent. Every
+    step sets every slot, so most of each step is cut to fit the
+    bandwidth."""
+    register = Register.new()
+    plan = register.plan
+    values = [(step, mod, ctrl, step % 128) for step in range(steps) for mod, ctrl in plan.slots]
+    results = {}
+    for jitter, busy in ((0.0, 0), (0.001, 0), (0.0, 4)):
+        engine = Engine(register, simulate=True)
+        engine.load_sequence(steps, 6, values)
+
+        def handle(kind, t):
+            engine.sequencer.handle(kind, t)
+            if kind == "clock":
+                for i in range(busy):
+                    engine.send("reverb.mix", 1 + i % 4, i)
+
+        engine.start()
+        try:
+            SimulatedClock(bpm, jitter, seed=0).run(handle, ticks=steps * 6)
+            engine.q_out.join()
+        finally:
+            engine.stop()
+        # the first step is sent before the tempo is known
+        errors = sorted(abs(e) for e in list(engine.sequencer.errors)[1:])
+        results[f"sequencer.jitter_{jitter * 1e3:g}ms.busy_{busy}"] = {
+            "best": errors[0], "median": statistics.median(errors) }
+    return results
+
+
+def bench_hotplug(n: int = 5) -> Results:
+    """Time from plugging in the simulated device until the register has
+    been sent to it. Most of it is the time of the full register on the
+    MIDI wire."""
+    register = Register.new()
+    engine = Engine(register, simulate=True)
+    device = engine.nymphes_out_port
+    assert isinstance(device, SimulatedNymphes)
+    changes: queue.Queue = queue.Queue()
+    engine.on_device = lambda *change: changes.put(change)
+    engine.start()
+    times = []
+    logging.disable(logging.WARNING)
+    try:
+        for _ in range(n):
+            device.unplug()
+            changes.get()
+            device.plug()
+            times.append(changes.get()[1])
+    finally:
+        engine.stop()
+        logging.disable(logging.NOTSET)
+    return { "hotplug.sync": { "best": min(times), "median": statistics.median(times) } }
+
+
+def report(results: Results):
+    for name, r in results.items():
+        line = f"{name:40} {r['best'] * 1e6:12.1f} µs {r['median'] * 1e6:12.1f} µs"
+        if "throughput" in r:
+            line += f" {r['throughput']:12.0f} /s"
+        print(line)
+
+
+def compare(results: Results, baseline: Results, threshold: float) -> list[str]:
+    """Compare median times against a baseline, returns the names of the
+    benchmarks that got slower by more than `threshold`."""
+    regressions = []
+    for name, r in results.items():
+        if name not in baseline:
+            continue
+        ratio = r["median"] / baseline[name]["median"]
+        flag = ""
+        if ratio > threshold:
+            regressions.append(name)
+            flag = "  REGRESSION"
+        print(f"{name:40} {ratio:8.2f}x{flag}")
+    return regressions
+
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+            check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+BENCHMARKS: dict[str, Callable[[], Results]] = {
+    "construct": bench_construct,
+    "settings": bench_settings,
+    "register": bench_register,
+    "ingest": bench_ingest,
+    "trace": bench_trace,
+    "compare": bench_compare,
+    "generate": bench_generate,
+    "db": bench_db,
+    "maintenance": bench_maintenance,
+    "sequencer": bench_sequencer,
+    "hotplug": bench_hotplug }
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m nymphescc.bench")
+    parser.add_argument(
+        "benchmarks", nargs="*", metavar="NAME",
+        help=f"benchmarks to run, from: {', '.join(BENCHMARKS)} (default: all)")
+    parser.add_argument(
+        "-o", "--output", type=Path, help="save results to this JSON file")
+    parser.add_argument(
+        "-c", "--compare", type=Path, help="compare against results in this JSON file")
+    parser.add_argument(
+        "--db-sizes", type=int, nargs="+", default=[10_000, 100_000],
+        help="number of snapshots in the database benchmarks (default: %(default)s)")
+    parser.add_argument(
+        "--threshold", type=float, default=1.2,
+        help="slowdown that counts as a regression (default: %(default)s)")
+    args = parser.parse_args()
+    for name in args.benchmarks:
+        if name not in BENCHMARKS:
+            parser.error(f"unknown benchmark '{name}'")
+
+    benchmarks = BENCHMARKS | { "db": functools.partial(bench_db, args.db_sizes) }
+    results: Results = {}
+    for name in args.benchmarks or BENCHMARKS:
+        results |= benchmarks[name]()
+    report(results)
+
+    if args.output is not None:
+        args.output.write_text(json.dumps(
+            { "revision": git_revision()
+            , "date": datetime.now().isoformat()
+            , "python": sys.version
+            , "platform": platform.platform()
+            , "results": results }, indent=2))
+
+    if args.compare is not None:
+        baseline = json.loads(args.compare.read_text())["results"]
+        if compare(results, baseline, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
+# ~\~ end
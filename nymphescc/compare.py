@@ -0,0 +1,133 @@
+# ~\~ language=Python filename=nymphescc/compare.py
+# ~\~ begin <<lit/compare.md|nymphescc/compare.py>>[0]
+from __future__ import annotations
+from typing import Optional, Sequence, Union
+
+import numpy as np
+
+from .core import Register, RegisterSnapshot, BytesPort
+
+
+# A patch to compare: a MIDI buffer, or a snapshot of the live register.
+Patch = Union[bytes, RegisterSnapshot]
+
+
+class Comparator:
+    """Compares patches as state vectors (one byte per slot of the
+    transmit plan).
+
+    MIDI buffers that have the layout of the transmit plan, which is
+    everything written by `Register.send_all`, are read with a single
+    gather. Other buffers are decoded message by message on top of a base
+    state: like loading a snapshot, they only change the settings they
+    contain. When comparing, the base is the patch compared against.
+    """
+    def __init__(self, register: Register):
+        plan = register.plan
+        self._register = register
+        self._slots = plan.slots
+        self._template = np.frombuffer(plan.template, dtype=np.uint8)
+        self._offsets = np.array(plan.offsets, dtype=np.intp)
+        self._fixed = np.ones(len(plan.template), dtype=bool)
+        self._fixed[self._offsets] = False
+
+    def _decode(self, midi: bytes, base: Optional[np.ndarray]) -> np.ndarray:
+        state = np.zeros(len(self._slots), dtype=np.uint8) if base is None else base.copy()
+        index = self._register.plan.index
+        for mod, ctrl, value in self._register.decode(midi):
+            i = index.get((mod, ctrl))
+            if i is not None:
+                state[i] = value
+        return state
+
+    def state(self, patch: Patch, base: Optional[np.ndarray] = None) -> np.ndarray:
+        if isinstance(patch, RegisterSnapshot):
+            return np.frombuffer(patch.state, dtype=np.uint8)
+        return self.states([patch], base)[0]
+
+    def _buffers(self, midis: Sequence[bytes]) -> tuple[np.ndarray, np.ndarray]:
+        # midis that all have the size of the template, and which of those
+        # actually have its layout
+        buffers = np.frombuffer(b"".join(midis), dtype=np.uint8) \
+                    .reshape(-1, len(self._template))
+        return buffers, (buffers[:, self._fixed] == self._template[self._fixed]).all(axis=1)
+
+    def full(self, midis: Sequence[bytes]) -> np.ndarray:
+        """Which of `midis` have the layout of the transmit plan."""
+        size = len(self._template)
+        mask = np.array([len(midi) == size for midi in midis], dtype=bool)
+        if mask.any():
+            mask[mask] = self._buffers([m for m, f in zip(midis, mask) if f])[1]
+        return mask
+
+    def states(self, midis: Sequence[bytes], base: Optional[np.ndarray] = None) -> np.ndarray:
+        """Returns an array of shape (len(midis), slots)."""
+        size = len(self._template)
+        if not all(len(midi) == size for midi in midis):
+            return np.stack([self.states([midi], base)[0] if len(midi) == size
+                             else self._decode(midi, base) for midi in midis])
+        buffers, full = self._buffers(midis)
+        states = buffers[:, self._offsets]
+        for i in np.flatnonzero(~full).tolist():
+            states[i] = self._decode(midis[i], base)
+        return states
+
+    def midis(self, states: np.ndarray) -> list[bytes]:
+        """Encode an array of state vectors into MIDI buffers, the inverse
+        of `states`."""
+        size = len(self._template)
+        buffers = np.tile(self._template, (len(states), 1))
+        buffers[:, self._offsets] = states
+        data = buffers.tobytes()
+        return [data[i:i + size] for i in range(0, len(data), size)]
+
+    def diff(self, old: Patch, new: Patch) -> list[tuple[int, str, int, int]]:
+        """Returns (mod, ctrl, old value, new value) for every setting that
+        differs between the two patches."""
+        a = self.state(old)
+        b = self.state(new, a)
+        return [(*self._slots[i], int(a[i]), int(b[i])) for i in np.flatnonzero(a != b)]
+
+    def changes(self, patch: Patch, midis: Sequence[bytes]) -> np.ndarray:
+        """Number of settings in which each of `midis` differs from `patch`."""
+        state = self.state(patch)
+        return (self.states(midis, state) != state).sum(axis=1)
+
+    def distances(self, patch: Patch, midis: Sequence[bytes]) -> np.ndarray:
+        """Sum of absolute differences of each of `midis` to `patch`."""
+        state = self.state(patch)
+        delta = self.states(midis, state).astype(np.int16) - state
+        return np.abs(delta).sum(axis=1)
+
+    def rank(self, patch: Patch, midis: Sequence[bytes]) -> list[int]:
+        """Indices into `midis`, ordered from closest to farthest from `patch`."""
+        return np.argsort(self.distances(patch, midis), kind="stable").tolist()
+
+
+def test_comparator():
+    register = Register.new()
+    comparator = Comparator(register)
+    live = register.snapshot()
+    patches = []
+    for value in (10, 100, 0):
+        other = Register.new()
+        other.write("reverb.mix", 2, value)
+        other.write("filter.cut", 0, value)
+        patches.append(other.snapshot().midi())
+
+    assert sorted(comparator.diff(live, patches[0])) == \
+        [(0, "filter.cut", 0, 10), (2, "reverb.mix", 0, 10)]
+    assert comparator.diff(patches[2], live) == []
+    assert comparator.changes(live, patches).tolist() == [2, 2, 0]
+    assert comparator.distances(live, patches).tolist() == [20, 200, 0]
+    assert comparator.rank(live, patches) == [2, 0, 1]
+    assert comparator.midis(comparator.states(patches)) == patches
+
+    # Buffers in another layout are decoded
+    port = BytesPort()
+    register.send_cc(port, "reverb.mix", 2, 100)
+    partial = bytes(port.bytes)
+    assert comparator.diff(live, partial) == [(2, "reverb.mix", 0, 100)]
+    assert comparator.changes(live, [partial, patches[0]]).tolist() == [1, 2]
+    assert comparator.full([partial, patches[0]]).tolist() == [False, True]
+# ~\~ end
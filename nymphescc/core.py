@@ -1,12 +1,22 @@
 # ~\~ language=Python filename=nymphescc/core.py
 # ~\~ begin <<lit/core.md|nymphescc/core.py>>[0]
-from dataclasses import dataclass
+from __future__ import annotations
+import builtins
+from dataclasses import dataclass, field
 import logging
-from threading import Event
+from queue import Queue, Empty
+from threading import Event, Lock
+import time
 from .messages import read_settings, modulators, Setting, Group
+from .trace import tracer, Token
+from .metrics import registry
 import mido
 import io
-from typing import Iterator, Protocol
+from typing import Callable, Iterable, Iterator, Optional, Protocol
+
+
+UNKNOWN_CC = registry.counter(
+    "nymphescc_unknown_cc_total", "Incoming CC messages with an unknown parameter.")
 
 
 class BytesPort:
@@ -28,30 +38,145 @@ class BytesPort:
     def bytes(self):
         return self._file.getbuffer()
 
+    # `bytes` is the property above in this scope
+    def send_midi(self, buffer: builtins.bytes):
+        self._file.write(buffer)
+
     def read_cc(self, _) -> Iterator[tuple[int, int, int]]:
         for msg in mido.parse_all(self.bytes):
             if msg.is_cc():
                 yield msg.channel, msg.control, msg.value
 
+    def read_midi(self, _) -> Iterator[mido.Message]:
+        return iter(mido.parse_all(self.bytes))
+
 
 import alsa_midi
-from alsa_midi import WRITE_PORT, READ_PORT, PortCaps, PortType, ControlChangeEvent
+from alsa_midi import WRITE_PORT, READ_PORT, SYSTEM_ANNOUNCE, PortCaps, PortType, \
+    ControlChangeEvent, ProgramChangeEvent, ClockEvent, StartEvent, StopEvent, ContinueEvent, \
+    ClientStartEvent, ClientExitEvent, PortStartEvent, PortExitEvent
+
+
+class AlsaInput:
+    """Distributes incoming events over the input ports of an ALSA client.
+
+    ALSA delivers the events for all ports of a client through one queue,
+    so two threads reading from different ports would steal each other's
+    events. The first registered port reads from ALSA directly, and passes
+    events for the other ports on to their own queues.
+    """
+    def __init__(self, client):
+        self._client = client
+        self._primary: Optional[int] = None
+        self._queues: dict[int, Queue] = {}
+
+    def register(self, port_id: int):
+        if self._primary is None:
+            self._primary = port_id
+        else:
+            self._queues[port_id] = Queue()
+
+    def events(self, port_id: int, quit_event: Event, timeout=0.1) -> Iterator[alsa_midi.Event]:
+        if port_id != self._primary:
+            queue = self._queues[port_id]
+            while True:
+                try:
+                    yield queue.get(timeout=timeout)
+                except Empty:
+                    if quit_event.is_set():
+                        return
+        while True:
+            event = self._client.event_input(timeout=timeout)
+            if event is None:
+                if quit_event.is_set():
+                    return
+                else:
+                    continue
+            if event.dest.port_id == port_id:
+                yield event
+            elif event.dest.port_id in self._queues:
+                self._queues[event.dest.port_id].put(event)
+
+
+class InputPort(Protocol):
+    """What the engine needs of a port to read from the device:
+    an `AlsaPort` or a `SimulatedInput`."""
+    selected_mod: int
+
+    def auto_connect(self) -> bool: ...
+    def exited(self, client_id: int, port_id: Optional[int]): ...
+    def read_cc(self, quit_event: Event, timeout: float = ...) -> Iterator[tuple[int, int, int]]: ...
+    def read_midi(self, quit_event: Event, timeout: float = ...) -> Iterator[mido.Message]: ...
+
+
+class OutputPort(Protocol):
+    """What the engine needs of a port to send to the device: an
+    `AlsaPort` or a `SimulatedNymphes`."""
+    selected_mod: int
+
+    def auto_connect(self) -> bool: ...
+    def exited(self, client_id: int, port_id: Optional[int]): ...
+    def send_cc(self, channel: int, param: int, value: int): ...
+    def send_midi(self, buffer: bytes): ...
+
+
+# Announcement of a port or client that appeared ("start") or went away
+# ("exit"): (kind, client id, port id). The port id is None for clients.
+Announcement = tuple[str, int, Optional[int]]
+
+
+class AnnouncePort(Protocol):
+    """Source of announcements: an `AlsaAnnounce` or a `SimulatedAnnounce`."""
+    def events(self, quit_event: Event, timeout: float = ...) -> Iterator[Announcement]: ...
+
+
+class AlsaAnnounce:
+    """Subscribes to the announcements of the ALSA system client, which
+    tell when ports and clients appear and go away. The port is private to
+    this client."""
+    def __init__(self, client, input: AlsaInput):
+        self._client = client
+        self._port = client.create_port(
+            "announce", PortCaps.WRITE | PortCaps.NO_EXPORT, type=PortType.APPLICATION)
+        self._input = input
+        self._input.register(self._port.get_info().port_id)
+        self._port.connect_from(SYSTEM_ANNOUNCE)
+
+    def events(self, quit_event: Event, timeout=0.1) -> Iterator[Announcement]:
+        port_id = self._port.get_info().port_id
+        for event in self._input.events(port_id, quit_event, timeout):
+            match event:
+                case ClientStartEvent():
+                    yield "start", event.addr.client_id, None
+                case PortStartEvent():
+                    yield "start", event.addr.client_id, event.addr.port_id
+                case ClientExitEvent():
+                    yield "exit", event.addr.client_id, None
+                case PortExitEvent():
+                    yield "exit", event.addr.client_id, event.addr.port_id
 
 
 class AlsaPort:
-    def __init__(self, client, name, caps):
+    def __init__(self, client, name, caps, input: Optional[AlsaInput] = None):
         self.caps = caps
         self.selected_mod = 0
+        self.target: Optional[tuple[int, int]] = None
         self._client = client
         match caps:
             case "in":
                 self._port = self._client.create_port(name, WRITE_PORT, type=PortType.MIDI_GENERIC)
+                self._input = input or AlsaInput(client)
+                self._input.register(self._port.get_info().port_id)
             case "out":
                 self._port = self._client.create_port(name, READ_PORT, type=PortType.MIDI_GENERIC)
             case _:
                 raise ValueError(f"Unknown port caps '{caps}'")
 
-    def auto_connect(self):
+    def auto_connect(self) -> bool:
+        """Connect to the Nymphes, unless we are connected already. Returns
+        whether we are connected."""
+        if self.target is not None:
+            return True
         try:
             if self.caps == "out":
                 ports = self._client.list_ports(output=True)
@@ -62,13 +187,23 @@ class AlsaPort:
                 target = next(p for p in ports if p.client_name == "Nymphes")
                 self._port.connect_from(target)
         except StopIteration:
-            logging.warn("Nymphes device not found")
-            return
+            return False
         except alsa_midi.ALSAError as e:
             logging.error(e)
-            return
+            return False
 
         logging.debug("connected to: %s", str(target))
+        self.target = (target.client_id, target.port_id)
+        return True
+
+    def exited(self, client_id: int, port_id: Optional[int]):
+        """Forget the connection if it was to a port or client that went
+        away; ALSA has removed the subscription already."""
+        if self.target is not None and self.target[0] == client_id \
+                and port_id in (None, self.target[1]):
+            logging.debug("disconnected from: %s", self.target)
+            self.target = None
+            self.selected_mod = 0
 
     def send_cc(self, channel: int, param: int, value: int):
         self._client.event_output(
@@ -76,31 +211,260 @@ class AlsaPort:
             port=self._port)
         self._client.drain_output()
 
+    def send_midi(self, buffer: bytes):
+        """Send a buffer of raw CC messages as a single batch."""
+        for i in range(0, len(buffer), 3):
+            status, param, value = buffer[i:i+3]
+            self._client.event_output(
+                ControlChangeEvent(status & 0x0f, param, value),
+                port=self._port)
+        self._client.drain_output()
+
     def read_cc(self, quit_event: Event, timeout=0.1):
         port_id = self._port.get_info().port_id
-        while True:
-            event = self._client.event_input(timeout=timeout)
-            if event is None:
-                if quit_event.is_set():
-                    return
-                else:
-                    continue
-            if event is not None and event.dest.port_id == port_id:
-                if isinstance(event, ControlChangeEvent):
-                    yield event.channel, event.param, event.value
-                else:
+        for event in self._input.events(port_id, quit_event, timeout):
+            if isinstance(event, ControlChangeEvent):
+                yield event.channel, event.param, event.value
+            else:
+                logging.debug("skipped MIDI event: %s", str(event))
+
+    def read_midi(self, quit_event: Event, timeout=0.1) -> Iterator[mido.Message]:
+        """Read control and program changes, and clock messages."""
+        port_id = self._port.get_info().port_id
+        for event in self._input.events(port_id, quit_event, timeout):
+            match event:
+                case ControlChangeEvent():
+                    yield mido.Message("control_change", channel=event.channel,
+                                       control=event.param, value=event.value)
+                case ProgramChangeEvent():
+                    yield mido.Message("program_change", channel=event.channel,
+                                       program=event.value)
+                case ClockEvent():
+                    yield mido.Message("clock")
+                case StartEvent():
+                    yield mido.Message("start")
+                case StopEvent():
+                    yield mido.Message("stop")
+                case ContinueEvent():
+                    yield mido.Message("continue")
+                case _:
                     logging.debug("skipped MIDI event: %s", str(event))
 
 
+class EchoSuppressor:
+    """Recognizes messages from the device that echo what we sent.
+
+    The Nymphes echoes parameter changes back. Applying these to the
+    register is wasted work, and during fast slider moves a late echo would
+    set the slider back to an older value, which is then sent again.
+
+    Args:
+        window: time (s) in which we expect an echo to arrive.
+        clock: time source, for testing.
+    """
+    def __init__(self, window: float = 0.25, clock: Callable[[], float] = time.monotonic):
+        self.window = window
+        self.suppressed = 0
+        self.passed = 0
+        self._clock = clock
+        self._sent: dict[tuple[str, int, int], float] = {}
+        self._lock = Lock()
+
+    def sent(self, ctrl: str, mod: Optional[int], value: int):
+        now = self._clock()
+        with self._lock:
+            self._sent[ctrl, mod or 0, value] = now
+            if len(self._sent) > 1024:
+                self._sent = { k: t for k, t in self._sent.items()
+                               if now - t < self.window }
+
+    def is_echo(self, ctrl: str, mod: int, value: int) -> bool:
+        with self._lock:
+            t = self._sent.pop((ctrl, mod, value), None)
+        if t is not None and self._clock() - t < self.window:
+            self.suppressed += 1
+            return True
+        self.passed += 1
+        return False
+
+
+CONTROL_CHANGE = 0xb0
+
+
+@dataclass
+class TransmitPlan:
+    """Precompiled encoding of the register into CC messages.
+
+    Attributes:
+        selector: CC code of the modulator selector.
+        cc: raw CC code for each (modulator, control) pair.
+        slots: (modulator, control) pairs in transmit order. Modulated
+            controls are grouped per modulator, so that the selector is
+            switched exactly once per modulator.
+        template: MIDI buffer for the full state, with value bytes zeroed.
+        offsets: position of the value byte in `template` for each slot.
+        index: position of each slot in `slots`. A state vector has one
+            byte per slot, in this order.
+    """
+    selector: int
+    cc: dict[tuple[int, str], int]
+    slots: list[tuple[int, str]]
+    template: bytes
+    offsets: list[int]
+    index: dict[tuple[int, str], int]
+
+    @staticmethod
+    def compile(flat_config: dict[str, Setting], n_mods: int) -> TransmitPlan:
+        selector = flat_config["modulators.selector"].cc
+        modulated = [(k, v.mod) for k, v in flat_config.items() if v.mod is not None]
+        cc = { (0, k): v.cc for k, v in flat_config.items() } \
+           | { (mod, k): c for mod in range(1, n_mods) for k, c in modulated }
+        slots = []
+        template = bytearray()
+        offsets = []
+
+        def push(slot, param):
+            slots.append(slot)
+            template.extend((CONTROL_CHANGE, param, 0))
+            offsets.append(len(template) - 1)
+
+        for k, v in flat_config.items():
+            if k != "modulators.selector":
+                push((0, k), v.cc)
+        for mod in range(1, n_mods):
+            template.extend((CONTROL_CHANGE, selector, mod - 1))
+            for k, c in modulated:
+                push((mod, k), c)
+
+        index = { slot: i for i, slot in enumerate(slots) }
+        return TransmitPlan(selector, cc, slots, bytes(template), offsets, index)
+
+    @property
+    def last_mod(self) -> int:
+        return self.slots[-1][0]
+
+    def encode(self, values: dict[int, dict[str, int]]) -> bytes:
+        """Encode the full state into a ready-to-send MIDI buffer."""
+        buffer = bytearray(self.template)
+        for offset, (mod, ctrl) in zip(self.offsets, self.slots):
+            buffer[offset] = values[mod][ctrl]
+        return bytes(buffer)
+
+    def state(self, values: dict[int, dict[str, int]]) -> bytes:
+        """Pack the values into a state vector."""
+        return bytes(values[mod][ctrl] for mod, ctrl in self.slots)
+
+    def encode_state(self, state: bytes) -> bytes:
+        """Encode a state vector into a ready-to-send MIDI buffer."""
+        buffer = bytearray(self.template)
+        for offset, value in zip(self.offsets, state):
+            buffer[offset] = value
+        return bytes(buffer)
+
+    def decode_state(self, midi: bytes) -> Optional[bytes]:
+        """The state vector of a buffer written by `encode_state`, or None
+        if the buffer has another layout."""
+        if len(midi) != len(self.template):
+            return None
+        state = bytes(midi[offset] for offset in self.offsets)
+        if max(state, default=0) > 127 or self.encode_state(state) != midi:
+            return None
+        return state
+
+    def encode_diff(self, old: bytes, new: bytes) -> tuple[bytes, Optional[int]]:
+        """Encode the messages that take the device from state `old` to
+        `new`. Returns the MIDI buffer and the modulator that is selected
+        after sending it, or None if the selector is not touched. The
+        selector is always sent before the first modulated value, so the
+        buffer doesn't depend on the selected modulator."""
+        return self.encode_slots((i, b) for i, (a, b) in enumerate(zip(old, new)) if a != b)
+
+    def encode_slots(self, values: Iterable[tuple[int, int]]) -> tuple[bytes, Optional[int]]:
+        """Encode (slot index, value) pairs, given in plan order. Returns the
+        MIDI buffer and the modulator selected after sending it, as
+        `encode_diff` does."""
+        buffer = bytearray()
+        selected = None
+        for i, value in values:
+            slot = self.slots[i]
+            mod = slot[0]
+            if mod != 0 and mod != selected:
+                buffer.extend((CONTROL_CHANGE, self.selector, mod - 1))
+                selected = mod
+            buffer.extend((CONTROL_CHANGE, self.cc[slot], value))
+        return bytes(buffer), selected
+
+
+@dataclass(frozen=True)
+class RegisterSnapshot:
+    """Immutable view of the register at a given version.
+
+    Attributes:
+        version: `Register.version` at the time of the snapshot.
+        state: state vector, one byte per slot of `plan`.
+    """
+    version: int
+    state: bytes
+    plan: TransmitPlan
+
+    def value(self, ctrl: str, mod: int) -> int:
+        return self.state[self.plan.index[mod, ctrl]]
+
+    def midi(self) -> bytes:
+        return self.plan.encode_state(self.state)
+
+
 @dataclass
 class Register:
     flat_config: dict[str, Setting]
     midi_map: dict[int, tuple[str, str]]
     values: dict[int, dict[str, int]]
+    plan: TransmitPlan
+    version: int = 0    # incremented on every change
+    _snapshot: RegisterSnapshot = field(init=False, repr=False)
+    _write_lock: Lock = field(init=False, repr=False, default_factory=Lock)
+
+    def __post_init__(self):
+        self._snapshot = RegisterSnapshot(
+            self.version, self.plan.state(self.values), self.plan)
+
+    def snapshot(self) -> RegisterSnapshot:
+        """Returns a consistent view of the register. This never blocks and
+        never copies: writers replace the snapshot instead of changing it."""
+        return self._snapshot
+
+    def write(self, ctrl: str, mod: int, value: int):
+        """Set a value. All changes to the register should go through here,
+        to keep the snapshot up to date. The lock only serializes writers
+        (the MIDI reader and the GUI) and is held for a few microseconds."""
+        with self._write_lock:
+            self.values[mod][ctrl] = value
+            self.version += 1
+            state = self._snapshot.state
+            i = self.plan.index.get((mod, ctrl))
+            if i is not None:
+                state = state[:i] + bytes((value,)) + state[i+1:]
+            self._snapshot = RegisterSnapshot(self.version, state, self.plan)
+
+    def load_state(self, state: bytes) -> list[tuple[str, int, int]]:
+        """Set the register to a state vector in a single step. Returns
+        (ctrl, mod, value) for every value that changed."""
+        with self._write_lock:
+            old = self._snapshot.state
+            changed = []
+            for i, (a, b) in enumerate(zip(old, state)):
+                if a != b:
+                    mod, ctrl = self.plan.slots[i]
+                    self.values[mod][ctrl] = b
+                    changed.append((ctrl, mod, b))
+            if changed:
+                self.version += 1
+                self._snapshot = RegisterSnapshot(self.version, bytes(state), self.plan)
+            return changed
 
     def gui_msg(self, ctrl, mod, value):
         if value != self.values[mod][ctrl]:
-            self.values[mod][ctrl] = value
+            self.write(ctrl, mod, value)
             return True
         else:
             return False
@@ -124,9 +488,10 @@ class Register:
             { v.mod: ("mod", k)
               for k, v in flat_config.items()
               if v.mod }
+        n_mods = len(modulators(config))
         baseline_values = { k: 0 for k in flat_config.keys() }
         values = { mod: { k: 0 for k, v in flat_config.items() if v.mod is not None}
-                   for mod in range(1, len(modulators(config))) } \
+                   for mod in range(1, n_mods) } \
                | { 0: baseline_values }
 
         values[0]["misc.amp"] = 127
@@ -134,19 +499,150 @@ class Register:
         return Register(
             flat_config,
             midi_map_global | midi_map_baseline | midi_map_mod,
-            values)
+            values,
+            TransmitPlan.compile(flat_config, n_mods))
+
+    def ingest(self, port, messages: Iterable[tuple[int, int, int]],
+               echo: Optional[EchoSuppressor] = None) -> Iterator[tuple[str, int, int]]:
+        """Apply incoming CC messages to the register. Selector messages
+        change the selected modulator of `port`. Yields (ctrl, mod, value)
+        for every value that was written."""
+        for chan, param, value in messages:
+            if param not in self.midi_map:
+                logging.warn("msg %u %u %u unknown", chan, param, value)
+                UNKNOWN_CC.inc()
+                continue
+            kind, ctrl = self.midi_map[param]
+            logging.debug("msg %u %u %u, read as %s:%s", chan, param, value, kind, ctrl)
+            if ctrl == "modulators.selector":
+                port.selected_mod = value + 1
+                continue
+            mod = port.selected_mod if kind == "mod" else 0
+            if echo is not None and echo.is_echo(ctrl, mod, value):
+                continue
+            self.write(ctrl, mod, value)
+            yield ctrl, mod, value
 
-    def send_cc(self, port, ctrl, mod, value):
+    def decode(self, midi: bytes) -> Iterator[tuple[int, str, int]]:
+        """Decode a MIDI buffer into (mod, ctrl, value), without changing
+        the register. Used to index snapshots in the database."""
+        state = self.plan.decode_state(midi)
+        if state is not None:
+            yield from ((mod, ctrl, value) for (mod, ctrl), value in zip(self.plan.slots, state))
+            return
+        port = BytesPort(midi)
+        for _, param, value in port.read_cc(None):
+            if param not in self.midi_map:
+                continue
+            kind, ctrl = self.midi_map[param]
+            if ctrl == "modulators.selector":
+                port.selected_mod = value + 1
+                continue
+            yield (port.selected_mod if kind == "mod" else 0), ctrl, value
+
+    def load_midi(self, midi: bytes):
+        """Set the register from a MIDI buffer, as created by `send_all`."""
+        port = BytesPort(midi)
+        for _ in self.ingest(port, port.read_cc(None)):
+            pass
+
+    def send_cc(self, port, ctrl, mod, value, token: Token = None):
         if mod is not None and mod != 0:
             if port.selected_mod != mod:
-                port.send_cc(0, self.flat_config["modulators.selector"].cc, mod - 1)
+                port.send_cc(0, self.plan.selector, mod - 1)
                 port.selected_mod = mod
-            port.send_cc(0, self.flat_config[ctrl].mod, value)
+                tracer.stamp(token, "selector")
+            port.send_cc(0, self.plan.cc[mod, ctrl], value)
         else:
-            port.send_cc(0, self.flat_config[ctrl].cc, value)
+            port.send_cc(0, self.plan.cc[0, ctrl], value)
+
+    def send_all(self, port) -> RegisterSnapshot:
+        """Send every value to `port`. Returns the snapshot that was sent."""
+        snapshot = self.snapshot()
+        port.send_midi(snapshot.midi())
+        port.selected_mod = self.plan.last_mod
+        return snapshot
+
+
+def test_send_all():
+    register = Register.new()
+    register.write("filter.cut", 2, 99)
+    port = BytesPort()
+    register.send_all(port)
+    msgs = list(port.read_cc(None))
+    selector = register.plan.selector
+    assert [v for _, p, v in msgs if p == selector] == [0, 1, 2, 3]
+    assert len(msgs) == len(register.plan.slots) + 4
+    assert port.selected_mod == 4
+    assert register.plan.encode_state(register.plan.state(register.values)) == port.bytes
+    assert sorted(register.decode(bytes(port.bytes))) == \
+        sorted((mod, ctrl, register.values[mod][ctrl]) for mod, ctrl in register.plan.slots)
+    # the shortcut for buffers in plan layout agrees with decoding messages
+    unknown_cc = bytes((CONTROL_CHANGE, 127, 0))
+    assert list(register.decode(bytes(port.bytes))) == \
+        list(register.decode(bytes(port.bytes) + unknown_cc))
+    i = msgs.index((0, selector, 1))
+    j = msgs.index((0, selector, 2))
+    assert (0, register.flat_config["filter.cut"].mod, 99) in msgs[i:j]
+
+
+def test_snapshot_during_sweep():
+    from threading import Thread
+    register = Register.new()
+    start = register.snapshot()
+    n = 2000
+
+    # Every step writes two values; a coherent snapshot taken after an
+    # even number of writes has both equal.
+    def sweep():
+        for i in range(n):
+            register.write("filter.cut", 0, i % 128)
+            register.write("reverb.mix", 2, i % 128)
+
+    writer = Thread(target=sweep)
+    writer.start()
+    snapshots = []
+    while writer.is_alive():
+        snapshots.append(register.snapshot())
+    writer.join()
+    snapshots.append(register.snapshot())
+    for snap in snapshots:
+        if (snap.version - start.version) % 2 == 0:
+            assert snap.value("filter.cut", 0) == snap.value("reverb.mix", 2)
+    assert start.value("filter.cut", 0) == 0
+    assert snapshots[-1].version == start.version + 2 * n
+    assert snapshots[-1].midi() == register.plan.encode(register.values)
+    assert register.snapshot() is snapshots[-1]
+
+
+def test_echo_suppression():
+    now = 0.0
+    register = Register.new()
+    echo = EchoSuppressor(window=0.1, clock=lambda: now)
+
+    # A device that echoes everything we send it
+    device = BytesPort()
+    for value in (10, 11, 12):
+        register.gui_msg("filter.cut", 0, value)
+        register.send_cc(device, "filter.cut", 0, value)
+        echo.sent("filter.cut", 0, value)
+    register.send_cc(device, "lfo.lfo-1.rate", 3, 50)
+    echo.sent("lfo.lfo-1.rate", 3, 50)
+    now = 0.05
+    echoed = BytesPort(bytes(device.bytes))
+    assert list(register.ingest(echoed, echoed.read_cc(None), echo)) == []
+    assert register.values[0]["filter.cut"] == 12
+    assert echo.suppressed == 4
 
-    def send_all(self, port):
-        for mod, s in self.values.items():
-            for ctrl, value in s.items():
-                self.send_cc(port, ctrl, mod, value)
+    # Late echoes and changes made on the device pass
+    echo.sent("filter.cut", 0, 20)
+    now = 1.0
+    device = BytesPort()
+    register.send_cc(device, "filter.cut", 0, 20)
+    register.send_cc(device, "filter.res", 0, 30)
+    echoed = BytesPort(bytes(device.bytes))
+    assert list(register.ingest(echoed, echoed.read_cc(None), echo)) == \
+        [("filter.cut", 0, 20), ("filter.res", 0, 30)]
+    assert echo.suppressed == 4
+    assert echo.passed == 2
 # ~\~ end
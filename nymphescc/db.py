@@ -1,11 +1,16 @@
 # ~\~ language=Python filename=nymphescc/db.py
 # ~\~ begin <<lit/patch-db.md|nymphescc/db.py>>[0]
+from __future__ import annotations
 from xdg import xdg_config_home
 import sqlite3
+import threading
+import time
 from dataclasses import dataclass
 from datetime import datetime
 from pathlib import Path
-from typing import Optional
+from typing import Callable, Iterable, Optional
+
+from .metrics import registry
 
 
 db_schema = """
@@ -21,8 +26,153 @@ create table if not exists "groups"
     ( "id" integer primary key autoincrement
     , "name" text not null
     , "description" text );
+
+create index if not exists "snapshots_group"
+    on "snapshots" ("group", "id");
+
+create table if not exists "changes"
+    ( "version" integer primary key autoincrement
+    , "kind" text not null
+    , "group" integer not null
+    , "snapshot" integer );
+
+create table if not exists "live_state"
+    ( "id" integer primary key check ("id" = 0)
+    , "date" text default current_timestamp
+    , "midi" blob not null );
+
+create table if not exists "parameters"
+    ( "snapshot" integer not null
+       references "snapshots" ("id") on delete cascade
+    , "mod" integer not null
+    , "name" text not null
+    , "value" integer not null
+    , primary key ("snapshot", "mod", "name") ) without rowid;
+
+create index if not exists "parameters_value"
+    on "parameters" ("name", "mod", "value");
+
+create table if not exists "parameters_empty"
+    ( "snapshot" integer primary key
+       references "snapshots" ("id") on delete cascade );
+
+create trigger if not exists "snapshot_parameters_deleted" after delete on "snapshots"
+begin
+    delete from "parameters" where "snapshot" = old."id";
+    delete from "parameters_empty" where "snapshot" = old."id";
+end;
+
+create table if not exists "setlists"
+    ( "id" integer primary key autoincrement
+    , "name" text not null unique );
+
+create table if not exists "setlist_entries"
+    ( "setlist" integer not null
+       references "setlists" ("id") on delete cascade
+    , "position" integer not null
+    , "snapshot" integer not null
+       references "snapshots" ("id")
+    , primary key ("setlist", "position") ) without rowid;
+
+create trigger if not exists "setlist_deleted" after delete on "setlists"
+begin
+    delete from "setlist_entries" where "setlist" = old."id";
+end;
+
+create table if not exists "sequences"
+    ( "id" integer primary key autoincrement
+    , "name" text not null unique
+    , "steps" integer not null
+    , "division" integer not null );
+
+create table if not exists "sequence_values"
+    ( "sequence" integer not null
+       references "sequences" ("id") on delete cascade
+    , "step" integer not null
+    , "mod" integer not null
+    , "name" text not null
+    , "value" integer not null
+    , primary key ("sequence", "step", "mod", "name") ) without rowid;
+
+create trigger if not exists "sequence_deleted" after delete on "sequences"
+begin
+    delete from "sequence_values" where "sequence" = old."id";
+end;
+
+create table if not exists "snapshot_problems"
+    ( "snapshot" integer not null
+       references "snapshots" ("id") on delete cascade
+    , "problem" text not null );
+
+create index if not exists "snapshot_problems_snapshot"
+    on "snapshot_problems" ("snapshot");
+
+create trigger if not exists "snapshot_problems_deleted" after delete on "snapshots"
+begin
+    delete from "snapshot_problems" where "snapshot" = old."id";
+end;
+
+create table if not exists "maintenance_progress"
+    ( "job" text not null
+    , "start" integer not null
+    , "stop" integer not null
+    , primary key ("job", "start") ) without rowid;
+
+create trigger if not exists "group_added" after insert on "groups"
+begin
+    insert into "changes" ("kind", "group") values ('group-added', new."id");
+end;
+
+create trigger if not exists "group_renamed" after update of "name" on "groups"
+begin
+    insert into "changes" ("kind", "group") values ('group-renamed', new."id");
+end;
+
+create trigger if not exists "group_deleted" after delete on "groups"
+begin
+    insert into "changes" ("kind", "group") values ('group-deleted', old."id");
+end;
+
+create trigger if not exists "snapshot_added" after insert on "snapshots"
+begin
+    insert into "changes" ("kind", "group", "snapshot")
+    values ('snapshot-added', new."group", new."id");
+end;
+
+create trigger if not exists "snapshot_deleted" after delete on "snapshots"
+begin
+    insert into "changes" ("kind", "group", "snapshot")
+    values ('snapshot-deleted', old."group", old."id");
+end;
 """
 
+# Number of change records kept in the change log.
+CHANGE_LOG_SIZE = 1000
+
+
+QUERY_TIME = registry.summary(
+    "nymphescc_db_query_seconds", "Time spent executing database statements.")
+
+
+def default_path() -> Path:
+    return xdg_config_home() / "nymphescc" / "patches.db"
+
+
+class TimedCursor(sqlite3.Cursor):
+    def execute(self, *args):
+        t0 = time.perf_counter()
+        try:
+            return super().execute(*args)
+        finally:
+            QUERY_TIME.observe(time.perf_counter() - t0)
+
+    def executemany(self, *args):
+        t0 = time.perf_counter()
+        try:
+            return super().executemany(*args)
+        finally:
+            QUERY_TIME.observe(time.perf_counter() - t0)
+
 
 @dataclass
 class Snapshot:
@@ -39,34 +189,277 @@ class GroupInfo:
     description: Optional[str]
 
 
+@dataclass
+class SetlistInfo:
+    key: int
+    name: str
+
+
+@dataclass
+class SequenceInfo:
+    """A step sequence.
+
+    Attributes:
+        key: id of the sequence.
+        name: unique name.
+        steps: number of steps, after which the sequence repeats.
+        division: MIDI clock ticks per step (24 per quarter note).
+    """
+    key: int
+    name: str
+    steps: int
+    division: int
+
+
+# A value in a sequence: (step, mod, name, value)
+StepValue = tuple[int, int, str, int]
+
+
+@dataclass
+class Condition:
+    """Predicate on a setting: `low <= value <= high` for modulator `mod`
+    (0 for the baseline)."""
+    name: str
+    low: int = 0
+    high: int = 127
+    mod: int = 0
+
+    @staticmethod
+    def equal(name: str, value: int, mod: int = 0) -> Condition:
+        return Condition(name, value, value, mod)
+
+
+# Decodes a MIDI snapshot into (mod, name, value) triples.
+Decoder = Callable[[bytes], Iterable[tuple[int, str, int]]]
+
+
+@dataclass
+class Change:
+    """A change to the database, as recorded in the change log.
+
+    Attributes:
+        version: version of the database after this change.
+        kind: one of "group-added", "group-renamed", "group-deleted",
+            "snapshot-added" or "snapshot-deleted".
+        group: id of the (parent) group.
+        snapshot: id of the snapshot, if applicable.
+    """
+    version: int
+    kind: str
+    group: int
+    snapshot: Optional[int]
+
+
 class NymphesDB:
-    def __init__(self, path: Optional[Path] = None):
+    """The patch database.
+
+    If a `decode` function is given, the settings of every snapshot are
+    stored in the "parameters" table, which is what `find_snapshots`
+    searches. Snapshots added without a decoder (by another connection)
+    are indexed by `index_parameters`, which may take a while; the GUI
+    runs it in the background.
+    """
+    def __init__(self, path: Optional[Path] = None, decode: Optional[Decoder] = None):
         if path is None:
-            path = xdg_config_home() / "nymphescc" / "patches.db"
+            path = default_path()
         path.parent.mkdir(parents=True, exist_ok=True)
         self._connection = sqlite3.connect(path)
-        self._cursor = self._connection.cursor()
+        self._cursor = self._connection.cursor(TimedCursor)
         self._cursor.executescript(db_schema)
+        self._prune_changes()
         self._connection.commit()
+        self._version = self.version()
+        self._subscribers: list[Callable[[Optional[list[Change]]], None]] = []
+        self._decode = decode
 
-    def new_group(self, name: str, description: Optional[str] = None) -> int:
+    def _commit(self):
+        self._prune_changes()
+        self._connection.commit()
+        self.poll()
+
+    def _prune_changes(self):
+        """Keep only the last `CHANGE_LOG_SIZE` records of the change log.
+        Every inserted snapshot adds a record, so this runs with every
+        commit that may add some."""
+        self._cursor.execute("""
+            delete from "changes"
+            where "version" <= (select max("version") from "changes") - ?
+            """, (CHANGE_LOG_SIZE,))
+
+    def version(self) -> int:
+        (version,) = self._cursor.execute("""
+            select coalesce(max("version"), 0) from "changes"
+            """).fetchone()
+        return version
+
+    def changes_since(self, version: int) -> Optional[list[Change]]:
+        """Returns the changes made after `version`, or None if these are
+        no longer in the change log."""
+        (oldest,) = self._cursor.execute("""
+            select min("version") from "changes"
+            """).fetchone()
+        if oldest is not None and oldest > version + 1:
+            return None
+        changes = self._cursor.execute("""
+            select "version", "kind", "group", "snapshot" from "changes"
+            where "version" > ? order by "version"
+            """, (version,))
+        return [Change(*c) for c in changes.fetchall()]
+
+    def subscribe(self, callback: Callable[[Optional[list[Change]]], None]):
+        """Register a callback for changes. The callback receives a list of
+        changes, or None if the subscriber should reload everything."""
+        self._subscribers.append(callback)
+
+    def poll(self):
+        """Publish changes made since the last poll, including those made
+        by other connections."""
+        changes = self.changes_since(self._version)
+        if changes == []:
+            return
+        self._version = changes[-1].version if changes else self.version()
+        for callback in self._subscribers:
+            callback(changes)
+
+    def _insert_group(self, name: str, description: Optional[str]) -> int:
         self._cursor.execute("""
             insert into "groups" ("name", "description")
             values (?, ?)""", (name, description))
-        self._connection.commit()
-        return self._cursor.lastrowid
+        group_id = self._cursor.lastrowid
+        assert group_id is not None
+        return group_id
+
+    def new_group(self, name: str, description: Optional[str] = None) -> int:
+        group_id = self._insert_group(name, description)
+        self._commit()
+        return group_id
 
     def new_snapshot(self, group_id: int, midi: bytes, tags: Optional[str] = None) -> int:
         self._cursor.execute("""
             insert into "snapshots" ("group", "midi", "tags")
             values (?, ?, ?)""", (group_id, midi, tags))
-        self._connection.commit()
-        return self._cursor.lastrowid
+        snap_id = self._cursor.lastrowid
+        assert snap_id is not None
+        self._index_snapshots([(snap_id, midi)])
+        self._commit()
+        return snap_id
+
+    def new_snapshots(self, group_id: int, midis: Iterable[bytes]) -> int:
+        """Insert many snapshots in a single transaction. Returns the
+        number of inserted snapshots."""
+        count = self._insert_snapshots(group_id, midis)
+        self._commit()
+        return count
+
+    def new_group_snapshots(self, name: str, midis: Iterable[bytes],
+                            description: Optional[str] = None, index: bool = True) -> int:
+        """Create a group holding the given snapshots, in a single
+        transaction. Returns the id of the group. Indexing the parameters
+        takes much longer than inserting; with `index=False` that is left
+        to `index_parameters`."""
+        group_id = self._insert_group(name, description)
+        self._insert_snapshots(group_id, midis, index)
+        self._commit()
+        return group_id
+
+    def _insert_snapshots(self, group_id: int, midis: Iterable[bytes],
+                          index: bool = True) -> int:
+        (last,) = self._cursor.execute("""
+            select coalesce(max("id"), 0) from "snapshots"
+            """).fetchone()
+        self._cursor.executemany("""
+            insert into "snapshots" ("group", "midi")
+            values (?, ?)""", ((group_id, midi) for midi in midis))
+        count = self._cursor.rowcount
+        if self._decode is not None and index:
+            new = self._connection.execute("""
+                select "id", "midi" from "snapshots" where "id" > ?
+                """, (last,))
+            self._index_snapshots(new)
+        return count
+
+    def _index_snapshots(self, snapshots: Iterable[tuple[int, bytes]]):
+        if self._decode is None:
+            return
+        decode = self._decode
+        # Snapshots without any parameters are marked, so that they are
+        # not decoded again by `index_parameters`.
+        empty: list[tuple[int]] = []
+
+        def parameters():
+            for snap_id, midi in snapshots:
+                found = False
+                for mod, name, value in decode(midi):
+                    found = True
+                    yield snap_id, mod, name, value
+                if not found:
+                    empty.append((snap_id,))
+
+        self._cursor.executemany("""
+            insert or replace into "parameters" ("snapshot", "mod", "name", "value")
+            values (?, ?, ?, ?)""", parameters())
+        self._cursor.executemany("""
+            insert or replace into "parameters_empty" ("snapshot")
+            values (?)""", empty)
+
+    def index_parameters(self, batch_size: int = 1000,
+                         stop: Optional[threading.Event] = None) -> int:
+        """Index all snapshots that are not in the parameter table yet.
+        Reads and commits `batch_size` snapshots at a time, so that memory
+        use stays bounded and other connections are not locked out for
+        long. Returns early when `stop` is set. Returns the number of
+        snapshots indexed."""
+        count = 0
+        last = 0
+        while stop is None or not stop.is_set():
+            batch = self._connection.execute("""
+                select "id", "midi" from "snapshots" as s
+                where "id" > ?
+                  and not exists
+                    (select 1 from "parameters" as p where p."snapshot" = s."id")
+                  and not exists
+                    (select 1 from "parameters_empty" as e where e."snapshot" = s."id")
+                order by "id" limit ?
+                """, (last, batch_size)).fetchall()
+            if not batch:
+                break
+            self._index_snapshots(batch)
+            self._connection.commit()
+            count += len(batch)
+            last = batch[-1][0]
+        return count
+
+    def find_snapshots(self, conditions: Iterable[Condition],
+                       group_id: Optional[int] = None) -> list[int]:
+        """Returns the ids of all snapshots that satisfy every condition,
+        optionally only those in the given group."""
+        queries = []
+        args: list = []
+        for c in conditions:
+            queries.append("""
+                select "snapshot" from "parameters"
+                where "name" = ? and "mod" = ? and "value" between ? and ?""")
+            args.extend((c.name, c.mod, c.low, c.high))
+        if group_id is not None:
+            queries.append("""
+                select "id" from "snapshots" where "group" = ?""")
+            args.append(group_id)
+        if not queries:
+            queries.append("""
+                select "id" from "snapshots" """)
+        rows = self._cursor.execute(
+            " intersect ".join(queries) + " order by 1", args)
+        return [snap_id for (snap_id,) in rows.fetchall()]
 
     def delete_group(self, group_id: int):
         self._cursor.execute("""
             delete from "groups" where "id" = ?""", (group_id,))
-        self._connection.commit()
+        self._commit()
+
+    def delete_snapshot(self, snap_id: int):
+        self._cursor.execute("""
+            delete from "snapshots" where "id" = ?""", (snap_id,))
+        self._commit()
 
     def group_info(self, group_id: int) -> GroupInfo:
         info = self._cursor.execute("""
@@ -81,17 +474,37 @@ class NymphesDB:
         return [Snapshot(key, datetime.fromisoformat(date), tags, midi)
                 for key, date, midi, tags in members.fetchall()]
 
+    def snapshot_count(self, group_id: int) -> int:
+        (count,) = self._cursor.execute("""
+            select count(*) from "snapshots"
+            where "group" is ?""", (group_id,)).fetchone()
+        return count
+
+    def snapshot_position(self, group_id: int, snap_id: int) -> int:
+        (position,) = self._cursor.execute("""
+            select count(*) from "snapshots"
+            where "group" is ? and "id" < ?""", (group_id, snap_id)).fetchone()
+        return position
+
+    def snapshots_page(self, group_id: int, offset: int, limit: int) -> list[Snapshot]:
+        members = self._cursor.execute("""
+            select "id", "date", "midi", "tags" from "snapshots"
+            where "group" is ? order by "id"
+            limit ? offset ?""", (group_id, limit, offset))
+        return [Snapshot(key, datetime.fromisoformat(date), tags, midi)
+                for key, date, midi, tags in members.fetchall()]
+
     def set_name(self, group_id, name):
         self._cursor.execute("""
             update "groups" set "name" = ?
             where "id" = ?""", (name, group_id))
-        self._connection.commit()
+        self._commit()
 
     def set_description(self, group_id, name):
         self._cursor.execute("""
             update "groups" set "description" = ?
             where "id" = ?""", (name, group_id))
-        self._connection.commit()
+        self._commit()
 
     def groups(self):
         groups = self._cursor.execute("""
@@ -99,6 +512,24 @@ class NymphesDB:
             """)
         return [GroupInfo(*g) for g in groups.fetchall()]
 
+    def group_count(self) -> int:
+        (count,) = self._cursor.execute("""
+            select count(*) from "groups"
+            """).fetchone()
+        return count
+
+    def group_position(self, group_id: int) -> int:
+        (position,) = self._cursor.execute("""
+            select count(*) from "groups"
+            where "id" < ?""", (group_id,)).fetchone()
+        return position
+
+    def groups_page(self, offset: int, limit: int) -> list[GroupInfo]:
+        groups = self._cursor.execute("""
+            select "id", "name", "description" from "groups"
+            order by "id" limit ? offset ?""", (limit, offset))
+        return [GroupInfo(*g) for g in groups.fetchall()]
+
     def snapshot(self, snap_id: int) -> Snapshot:
         key, date, midi, tags = self._cursor.execute("""
             select "id", "date", "midi", "tags" from "snapshots"
@@ -112,6 +543,116 @@ class NymphesDB:
         return [(GroupInfo(key, name, description), self.snapshots(key))
                 for key, name, description in groups]
 
+    def save_setlist(self, name: str, snapshot_ids: Iterable[int]) -> int:
+        """Store a setlist, replacing the entries of an existing setlist
+        with the same name. Returns the id of the setlist."""
+        self._cursor.execute("""
+            insert into "setlists" ("name") values (?)
+            on conflict ("name") do nothing""", (name,))
+        (setlist_id,) = self._cursor.execute("""
+            select "id" from "setlists" where "name" = ?""", (name,)).fetchone()
+        self._cursor.execute("""
+            delete from "setlist_entries" where "setlist" = ?""", (setlist_id,))
+        self._cursor.executemany("""
+            insert into "setlist_entries" ("setlist", "position", "snapshot")
+            values (?, ?, ?)""",
+            ((setlist_id, pos, snap_id) for pos, snap_id in enumerate(snapshot_ids)))
+        self._connection.commit()
+        return setlist_id
+
+    def setlists(self) -> list[SetlistInfo]:
+        rows = self._cursor.execute("""
+            select "id", "name" from "setlists" order by "name"
+            """)
+        return [SetlistInfo(*r) for r in rows.fetchall()]
+
+    def setlist_id(self, name: str) -> Optional[int]:
+        row = self._cursor.execute("""
+            select "id" from "setlists" where "name" = ?""", (name,)).fetchone()
+        return row and row[0]
+
+    def setlist(self, setlist_id: int) -> list[Snapshot]:
+        """The snapshots of a setlist, in order. Entries of which the
+        snapshot was deleted are skipped."""
+        entries = self._cursor.execute("""
+            select s."id", s."date", s."midi", s."tags"
+            from "setlist_entries" as e join "snapshots" as s on s."id" = e."snapshot"
+            where e."setlist" = ? order by e."position"
+            """, (setlist_id,))
+        return [Snapshot(key, datetime.fromisoformat(date), tags, midi)
+                for key, date, midi, tags in entries.fetchall()]
+
+    def delete_setlist(self, setlist_id: int):
+        self._cursor.execute("""
+            delete from "setlists" where "id" = ?""", (setlist_id,))
+        self._connection.commit()
+
+    def snapshot_problems(self) -> list[tuple[int, str]]:
+        """Problems found by the last validation (see `maintenance`), as
+        (snapshot id, description) pairs."""
+        rows = self._cursor.execute("""
+            select "snapshot", "problem" from "snapshot_problems"
+            order by "snapshot", rowid""")
+        return rows.fetchall()
+
+    def save_sequence(self, name: str, steps: int, division: int,
+                      values: Iterable[StepValue]) -> int:
+        """Store a sequence, replacing an existing sequence with the same
+        name. Returns the id of the sequence."""
+        self._cursor.execute("""
+            insert into "sequences" ("name", "steps", "division") values (?, ?, ?)
+            on conflict ("name") do update
+            set "steps" = excluded."steps", "division" = excluded."division"
+            """, (name, steps, division))
+        (sequence_id,) = self._cursor.execute("""
+            select "id" from "sequences" where "name" = ?""", (name,)).fetchone()
+        self._cursor.execute("""
+            delete from "sequence_values" where "sequence" = ?""", (sequence_id,))
+        self._cursor.executemany("""
+            insert or replace into "sequence_values" ("sequence", "step", "mod", "name", "value")
+            values (?, ?, ?, ?, ?)""", ((sequence_id, *v) for v in values))
+        self._connection.commit()
+        return sequence_id
+
+    def sequences(self) -> list[SequenceInfo]:
+        rows = self._cursor.execute("""
+            select "id", "name", "steps", "division" from "sequences" order by "name"
+            """)
+        return [SequenceInfo(*r) for r in rows.fetchall()]
+
+    def sequence_id(self, name: str) -> Optional[int]:
+        row = self._cursor.execute("""
+            select "id" from "sequences" where "name" = ?""", (name,)).fetchone()
+        return row and row[0]
+
+    def sequence(self, sequence_id: int) -> tuple[SequenceInfo, list[StepValue]]:
+        info = self._cursor.execute("""
+            select "id", "name", "steps", "division" from "sequences"
+            where "id" = ?""", (sequence_id,)).fetchone()
+        values = self._cursor.execute("""
+            select "step", "mod", "name", "value" from "sequence_values"
+            where "sequence" = ? order by "step", "mod", "name"
+            """, (sequence_id,))
+        return SequenceInfo(*info), values.fetchall()
+
+    def delete_sequence(self, sequence_id: int):
+        self._cursor.execute("""
+            delete from "sequences" where "id" = ?""", (sequence_id,))
+        self._connection.commit()
+
+    def save_live_state(self, midi: bytes):
+        """Store the live state of the device, replacing the previous one."""
+        self._cursor.execute("""
+            insert into "live_state" ("id", "midi") values (0, ?)
+            on conflict ("id") do update
+            set "midi" = excluded."midi", "date" = current_timestamp""", (midi,))
+        self._connection.commit()
+
+    def live_state(self) -> Optional[bytes]:
+        row = self._cursor.execute("""
+            select "midi" from "live_state" where "id" = 0""").fetchone()
+        return row and row[0]
+
     def close(self):
         self._connection.close()
 
@@ -129,4 +670,119 @@ def test_db(tmp_path: Path):
     t = db.tree()
     assert t[0][0].name == "hello"
     assert len(t[0][1]) == 1
+    assert db.live_state() is None
+    db.save_live_state(b"abc")
+    db.save_live_state(b"def")
+    assert db.live_state() == b"def"
+
+
+def test_paging(tmp_path: Path):
+    db = NymphesDB(tmp_path / "test.db")
+    group_id = db.new_group("hello")
+    db.new_snapshot(group_id, b"123")
+    ids = [db.new_snapshot(group_id, b"456") for _ in range(4)]
+    assert db.snapshot_count(group_id) == 5
+    assert db.snapshot_position(group_id, ids[1]) == 2
+    assert db.new_snapshots(group_id, [b"789"] * 3) == 3
+    assert db.snapshot_count(group_id) == 8
+    page = db.snapshots_page(group_id, 3, 10)
+    assert [s.midi for s in page] == [b"456", b"456", b"789", b"789", b"789"]
+    other = db.new_group("other")
+    assert db.group_count() == 2
+    assert db.group_position(other) == 1
+    assert [g.name for g in db.groups_page(1, 10)] == ["other"]
+
+
+def test_find_snapshots(tmp_path: Path):
+    # A toy encoding: two settings, one byte each.
+    def decode(midi):
+        if not midi:
+            return []
+        return [(0, "reverb.mix", midi[0]), (1, "lfo.mode", midi[1])]
+
+    path = tmp_path / "test.db"
+    db = NymphesDB(path)
+    group_id = db.new_group("hello")
+    old_id = db.new_snapshot(group_id, bytes((110, 1)))
+    db.new_snapshots(group_id, [b"", bytes((10, 0)), bytes((20, 0))])
+    db.close()
+
+    db = NymphesDB(path, decode=decode)
+    assert db.find_snapshots([Condition("reverb.mix")]) == []
+    stop = threading.Event()
+    stop.set()
+    assert db.index_parameters(stop=stop) == 0
+    assert db.index_parameters(batch_size=3) == 4
+    assert db.index_parameters() == 0
+    other = db.new_group("other")
+    db.new_snapshots(group_id, [bytes((50, 1)), bytes((120, 0))])
+    new_id = db.new_snapshot(other, bytes((127, 1)))
+    mix = Condition("reverb.mix", low=101)
+    track = Condition.equal("lfo.mode", 1, mod=1)
+    assert db.find_snapshots([mix, track]) == [old_id, new_id]
+    assert db.find_snapshots([mix, track], group_id) == [old_id]
+    assert len(db.find_snapshots([mix])) == 3
+    assert len(db.find_snapshots([], group_id)) == 6
+    db.delete_snapshot(new_id)
+    assert db.find_snapshots([mix, track]) == [old_id]
+
+
+def test_setlists(tmp_path: Path):
+    db = NymphesDB(tmp_path / "test.db")
+    group_id = db.new_group("gig")
+    ids = [db.new_snapshot(group_id, bytes([i])) for i in range(4)]
+    setlist_id = db.save_setlist("tonight", [ids[2], ids[0], ids[3]])
+    assert [s.midi for s in db.setlist(setlist_id)] == [b"\x02", b"\x00", b"\x03"]
+    assert db.save_setlist("tonight", ids[:2]) == setlist_id
+    assert [s.key for s in db.setlist(setlist_id)] == ids[:2]
+    db.delete_snapshot(ids[0])
+    assert [s.key for s in db.setlist(setlist_id)] == ids[1:2]
+    assert db.setlists() == [SetlistInfo(setlist_id, "tonight")]
+    assert db.setlist_id("tonight") == setlist_id
+    db.delete_setlist(setlist_id)
+    assert db.setlist_id("tonight") is None
+    assert db.setlist(setlist_id) == []
+
+
+def test_sequences(tmp_path: Path):
+    db = NymphesDB(tmp_path / "test.db")
+    values = [(0, 0, "filter.cut", 10), (2, 1, "filter.cut", 90)]
+    sequence_id = db.save_sequence("wobble", 4, 6, values)
+    assert db.sequence(sequence_id) == (SequenceInfo(sequence_id, "wobble", 4, 6), values)
+    assert db.save_sequence("wobble", 8, 3, values[:1]) == sequence_id
+    assert db.sequence(sequence_id) == (SequenceInfo(sequence_id, "wobble", 8, 3), values[:1])
+    assert db.sequences() == [SequenceInfo(sequence_id, "wobble", 8, 3)]
+    assert db.sequence_id("wobble") == sequence_id
+    db.delete_sequence(sequence_id)
+    assert db.sequence_id("wobble") is None
+    assert db._cursor.execute("""
+        select count(*) from "sequence_values" """).fetchone() == (0,)
+
+
+def test_changes(tmp_path: Path):
+    db = NymphesDB(tmp_path / "test.db")
+    other = NymphesDB(tmp_path / "test.db")
+    received: list[list[Change]] = []
+
+    def receive(changes: Optional[list[Change]]):
+        assert changes is not None
+        received.append(changes)
+    db.subscribe(receive)
+    group_id = db.new_group("hello")
+    db.set_name(group_id, "world")
+    assert [c.kind for c in received[0] + received[1]] == ["group-added", "group-renamed"]
+
+    snap_id = other.new_snapshot(group_id, b"123")
+    other.delete_snapshot(snap_id)
+    db.poll()
+    assert [(c.kind, c.snapshot) for c in received[2]] == \
+        [("snapshot-added", snap_id), ("snapshot-deleted", snap_id)]
+    db.poll()
+    assert len(received) == 3
+
+    other.new_snapshots(group_id, [b"456"] * (CHANGE_LOG_SIZE + 10))
+    assert db.changes_since(0) is None
+    (count,) = db._cursor.execute("""
+        select count(*) from "changes" """).fetchone()
+    assert count == CHANGE_LOG_SIZE
 # ~\~ end
@@ -0,0 +1,726 @@
+# ~\~ language=Python filename=nymphescc/engine.py
+# ~\~ begin <<lit/engine.md|nymphescc/engine.py>>[0]
+from __future__ import annotations
+import logging
+import multiprocessing
+from multiprocessing.connection import Connection
+from multiprocessing.shared_memory import SharedMemory
+import queue
+from queue import Queue
+import struct
+import threading
+import time
+from threading import Lock, Thread
+from typing import Callable, Iterable, Iterator, Optional
+
+import mido
+
+from .core import Register, TransmitPlan, AlsaAnnounce, AlsaInput, AlsaPort, BytesPort, \
+    EchoSuppressor, InputPort, OutputPort, AnnouncePort
+from .setlist import Setlist
+from .sequencer import Sequencer, Step
+from .db import StepValue
+from .sim import SimulatedNymphes
+from .trace import tracer, Token
+from .metrics import registry
+
+
+# Callback for values received from the device: (ctrl, mod, value, token)
+OnValue = Callable[[str, int, int, Token], None]
+
+# Queue items that request sending the full register, recalling a
+# setlist entry, and playing a sequencer step.
+SEND_ALL = "*send-all*"
+RECALL = "*recall*"
+STEP = "*step*"
+
+# MIDI messages that drive the sequencer.
+CLOCK_MESSAGES = ("clock", "start", "stop", "continue")
+
+# Seconds between sending the metrics of the engine process to the GUI.
+METRICS_INTERVAL = 1.0
+
+SELECTOR_SWITCHES = registry.counter(
+    "nymphescc_selector_switches_total", "Modulator selector messages sent to the device.")
+SYNC_TIME = registry.summary(
+    "nymphescc_device_sync_seconds",
+    "Time from the Nymphes being plugged in until the register was sent to it.")
+
+
+class Engine:
+    """The MIDI engine: the ports to the Nymphes, the register, and the
+    threads that send to and receive from the device.
+
+    Values received from the device are reported through `on_value`, the
+    position in the setlist through `on_setlist`. Program changes on the
+    through port recall that entry of the setlist; the CCs in `setlist_cc`
+    (next, previous) step through it. MIDI clock on `clock_port` ("through"
+    or "device") drives the sequencer.
+
+    The engine follows the Nymphes being plugged in and out. When it
+    appears, the engine connects to it and sends the full register;
+    `on_device` is called with whether the device is connected, and the
+    time it took to sync.
+    """
+    def __init__(self, register: Register, simulate: bool = False,
+                 setlist_cc: tuple[int, ...] = (), clock_port: str = "through"):
+        self.register = register
+        self.on_value: Optional[OnValue] = None
+        self.on_setlist: Optional[Callable[[int], None]] = None
+        self.on_device: Optional[Callable[[bool, Optional[float]], None]] = None
+        self.setlist: Optional[Setlist] = None
+        self.setlist_cc = setlist_cc
+        self.clock_port = clock_port
+        self.sequencer = Sequencer(self.queue_step, self.release_sequence,
+                                   backlog=lambda: self.pending_bytes)
+        self.q_out: Queue = Queue()
+        # upper bound of the bytes in `q_out`
+        self.pending_bytes = 0
+        self._pending_lock = Lock()
+        self.quit_event = threading.Event()
+        self.echo = EchoSuppressor()
+        self.nymphes_in_port: InputPort
+        self.nymphes_out_port: OutputPort
+        self.through_port: Optional[InputPort]
+        self.announce: AnnouncePort
+        if simulate:
+            device = SimulatedNymphes(echo=True, realtime=True)
+            self.nymphes_in_port = device.input_port()
+            self.nymphes_out_port = device
+            self.through_port = None
+            self.announce = device.announce()
+        else:
+            from alsa_midi import SequencerClient
+            client = SequencerClient("NymphesCC")
+            alsa_input = AlsaInput(client)
+            self.nymphes_in_port = AlsaPort(client, "device-in", "in", alsa_input)
+            self.nymphes_out_port = AlsaPort(client, "device-out", "out")
+            self.through_port = AlsaPort(client, "through", "in", alsa_input)
+            self.announce = AlsaAnnounce(client, alsa_input)
+
+        registry.gauge("nymphescc_queue_depth", "Messages waiting to be sent.",
+                       fn=self.q_out.qsize)
+        registry.counter("nymphescc_echo_suppressed_total", "Device echoes dropped.",
+                         fn=lambda: self.echo.suppressed)
+        self.messages_out = registry.counter(
+            "nymphescc_midi_messages_total", "MIDI messages per port.", port="device-out")
+
+        self.connected = False
+        registry.gauge("nymphescc_device_connected", "Whether the Nymphes is connected.",
+                       fn=lambda: int(self.connected))
+        self.connected = self.connect()
+        if not self.connected:
+            logging.warning("Nymphes device not found, waiting for it to be plugged in")
+
+    def start(self):
+        Thread(target=self.send_nymphes).start()
+        Thread(target=self.read_nymphes).start()
+        Thread(target=self.watch_device).start()
+        if self.through_port is not None:
+            Thread(target=self.read_through).start()
+        Thread(target=self.sequencer.run, args=(self.quit_event,)).start()
+
+    def stop(self):
+        self.quit_event.set()
+
+    def send(self, ctrl: str, mod: Optional[int], value: int, token: Token = None):
+        self._put((ctrl, mod, value, token))
+
+    def send_all(self):
+        self._put((SEND_ALL, None, None, None))
+
+    def _wire_bytes(self, item) -> int:
+        """Bytes an item of the output queue puts on the wire, at most."""
+        ctrl, _, value, _ = item
+        if ctrl == STEP:
+            return len(value.midi)
+        if ctrl in (SEND_ALL, RECALL):
+            return len(self.register.plan.template)
+        # a CC, possibly after a selector switch
+        return 6
+
+    def _put(self, item):
+        with self._pending_lock:
+            self.pending_bytes += self._wire_bytes(item)
+        self.q_out.put_nowait(item)
+
+    def _done(self, item):
+        with self._pending_lock:
+            self.pending_bytes -= self._wire_bytes(item)
+        self.q_out.task_done()
+
+    def connect(self) -> bool:
+        # connect both ports, even if one fails
+        return all([self.nymphes_in_port.auto_connect(), self.nymphes_out_port.auto_connect()])
+
+    def watch_device(self):
+        """Follow ports coming and going. When the Nymphes appears, send it
+        the full register; the time since the announcement is reported
+        once it is sent."""
+        for kind, client_id, port_id in self.announce.events(self.quit_event):
+            t = time.monotonic()
+            if kind == "exit":
+                self.nymphes_in_port.exited(client_id, port_id)
+                self.nymphes_out_port.exited(client_id, port_id)
+            connected = self.connect()
+            if connected and not self.connected:
+                logging.info("Nymphes connected")
+                # the device comes up with a selection of its own
+                self.nymphes_in_port.selected_mod = 0
+                self.nymphes_out_port.selected_mod = 0
+                self._put((SEND_ALL, None, t, None))
+            elif self.connected and not connected:
+                logging.warning("Nymphes disconnected")
+                if self.on_device is not None:
+                    self.on_device(False, None)
+            self.connected = connected
+
+    def synced(self, t: float):
+        dt = time.monotonic() - t
+        SYNC_TIME.observe(dt)
+        logging.info("Nymphes synced %.1f ms after it was plugged in", dt * 1e3)
+        if self.on_device is not None:
+            self.on_device(True, dt)
+
+    def load_setlist(self, snapshots: list[tuple[int, bytes]]):
+        """Compile a setlist from (snapshot id, midi) pairs."""
+        self.setlist = Setlist.compile(self.register, snapshots)
+
+    def setlist_goto(self, index: int):
+        self._put((RECALL, None, (index, False), None))
+
+    def setlist_step(self, step: int):
+        self._put((RECALL, None, (step, True), None))
+
+    def load_sequence(self, steps: int, division: int, values: list[StepValue]):
+        self.sequencer.load(self.register.plan, steps, division, values)
+
+    def queue_step(self, step: Step):
+        self._put((STEP, None, step, None))
+
+    def release_sequence(self, slots: list[int]):
+        """Return the sequenced settings to the values in the register."""
+        plan = self.register.plan
+        state = self.register.snapshot().state
+        midi, selected = plan.encode_slots((i, state[i]) for i in slots)
+        self.queue_step(Step(midi, selected, [(plan.slots[i][1], plan.slots[i][0], state[i])
+                                              for i in slots]))
+
+    def play(self, step: Step):
+        """Send a sequencer step. The values are not written to the
+        register: they are passing changes on top of the patch."""
+        self.nymphes_out_port.send_midi(step.midi)
+        if step.index is not None:
+            self.sequencer.sent(step.index, time.monotonic())
+        if step.selected is not None:
+            self.nymphes_out_port.selected_mod = step.selected
+        for ctrl, mod, value in step.values:
+            self.echo.sent(ctrl, mod, value)
+
+    def recall(self, index: int, relative: bool):
+        setlist = self.setlist
+        if setlist is None:
+            return
+        if relative:
+            index += -1 if setlist.position is None else setlist.position
+        if not 0 <= index < len(setlist):
+            return
+        state, (midi, selected) = setlist.recall(index, self.register.snapshot().state)
+        self.nymphes_out_port.send_midi(midi)
+        if selected is not None:
+            self.nymphes_out_port.selected_mod = selected
+        for ctrl, mod, value in self.register.load_state(state):
+            self.echo.sent(ctrl, mod, value)
+            if self.on_value is not None:
+                self.on_value(ctrl, mod, value, None)
+        if self.on_setlist is not None:
+            self.on_setlist(index)
+
+    def restore(self, midi: bytes, resend: bool):
+        """Set the register from a MIDI buffer, without reporting the
+        values. If `resend`, send the full register to the device."""
+        self.register.load_midi(midi)
+        if resend:
+            self.send_all()
+
+    def load_midi(self, midi: bytes, forward: bool = True):
+        port = BytesPort(midi)
+        self.read_port(port, "snapshot", forward=forward)
+
+    def get_midi(self) -> bytes:
+        return self.register.snapshot().midi()
+
+    def send_nymphes(self):
+        while True:
+            try:
+                item = self.q_out.get(timeout=0.1)
+            except queue.Empty:
+                if self.quit_event.is_set():
+                    break
+                else:
+                    continue
+
+            ctrl, mod, value, token = item
+            if ctrl == SEND_ALL:
+                snapshot = self.register.send_all(self.nymphes_out_port)
+                SELECTOR_SWITCHES.inc(self.register.plan.last_mod)
+                for (slot_mod, slot_ctrl), slot_value in zip(snapshot.plan.slots,
+                                                             snapshot.state):
+                    self.echo.sent(slot_ctrl, slot_mod, slot_value)
+                if value is not None:
+                    self.synced(value)
+                self._done(item)
+                continue
+            if ctrl == RECALL:
+                self.recall(*value)
+                self._done(item)
+                continue
+            if ctrl == STEP:
+                self.play(value)
+                self._done(item)
+                continue
+            tracer.stamp(token, "dequeue")
+            selected = self.nymphes_out_port.selected_mod
+            self.register.send_cc(self.nymphes_out_port, ctrl, mod, value, token)
+            if self.nymphes_out_port.selected_mod != selected:
+                SELECTOR_SWITCHES.inc()
+            tracer.finish(token, "drain")
+            self.messages_out.inc()
+            self.echo.sent(ctrl, mod, value)
+            self._done(item)
+
+    def count(self, messages, port_name):
+        counter = registry.counter(
+            "nymphescc_midi_messages_total", "MIDI messages per port.", port=port_name)
+        for msg in messages:
+            counter.inc()
+            yield msg
+
+    def forward(self, messages):
+        for chan, param, value in messages:
+            self.nymphes_out_port.send_cc(chan, param, value)
+            yield chan, param, value
+
+    def clock(self, messages: Iterable[mido.Message]) -> Iterator[mido.Message]:
+        """Pass clock messages to the sequencer, pass on other messages."""
+        for msg in messages:
+            if msg.type in CLOCK_MESSAGES:
+                self.sequencer.handle(msg.type, time.monotonic())
+            else:
+                yield msg
+
+    def triggers(self, messages: Iterable[mido.Message]) -> Iterator[tuple[int, int, int]]:
+        """Handle setlist triggers, pass on other control changes."""
+        for msg in messages:
+            if msg.type == "program_change":
+                self.setlist_goto(msg.program)
+            elif not msg.is_cc():
+                continue
+            elif msg.control in self.setlist_cc:
+                if msg.value > 0:
+                    self.setlist_step(1 if msg.control == self.setlist_cc[0] else -1)
+            else:
+                yield msg.channel, msg.control, msg.value
+
+    def read_port(self, port, port_name, forward=False, echo=None, messages=None):
+        if messages is None:
+            messages = port.read_cc(self.quit_event)
+        messages = self.count(messages, port_name)
+        if tracer.enabled:
+            messages = tracer.inputs(messages)
+        if forward:
+            messages = self.forward(messages)
+        for ctrl, mod, value in self.register.ingest(port, messages, echo):
+            if self.on_value is not None:
+                self.on_value(ctrl, mod, value, tracer.start_input("read_port"))
+
+    def read_nymphes(self):
+        messages = None
+        if self.clock_port == "device":
+            messages = ((msg.channel, msg.control, msg.value) for msg in
+                        self.clock(self.nymphes_in_port.read_midi(self.quit_event))
+                        if msg.is_cc())
+        self.read_port(self.nymphes_in_port, "device-in", forward=False, echo=self.echo,
+                       messages=messages)
+
+    def read_through(self):
+        messages = self.through_port.read_midi(self.quit_event)
+        if self.clock_port == "through":
+            messages = self.clock(messages)
+        self.read_port(self.through_port, "through", forward=True,
+                       messages=self.triggers(messages))
+
+
+class SharedState:
+    """State vector of the register in shared memory.
+
+    The buffer starts with a 64-bit sequence number, followed by one byte
+    per slot of the transmit plan. The writer makes the sequence number odd
+    while writing, so readers can detect and retry torn reads (a seqlock).
+    """
+    HEADER = struct.Struct("Q")
+
+    def __init__(self, plan: TransmitPlan, shm: SharedMemory, writable: bool):
+        self.plan = plan
+        self.shm = shm
+        buf = shm.buf
+        assert buf is not None
+        self._buf: memoryview = buf if writable else buf.toreadonly()
+        self._lock = Lock()
+
+    @staticmethod
+    def create(plan: TransmitPlan) -> SharedState:
+        shm = SharedMemory(create=True, size=SharedState.HEADER.size + len(plan.slots))
+        return SharedState(plan, shm, writable=False)
+
+    @staticmethod
+    def attach(plan: TransmitPlan, name: str) -> SharedState:
+        return SharedState(plan, SharedMemory(name=name), writable=True)
+
+    def _seq(self) -> int:
+        return self.HEADER.unpack_from(self._buf)[0]
+
+    def write(self, values: dict[tuple[int, str], int]):
+        """Write values, given by slot, to the buffer."""
+        offset = self.HEADER.size
+        with self._lock:
+            seq = self._seq()
+            self.HEADER.pack_into(self._buf, 0, seq + 1)
+            for slot, value in values.items():
+                self._buf[offset + self.plan.index[slot]] = value
+            self.HEADER.pack_into(self._buf, 0, seq + 2)
+
+    def write_all(self, state: bytes):
+        """Write a complete state vector."""
+        self.write(dict(zip(self.plan.slots, state)))
+
+    def read(self) -> bytes:
+        """Returns a consistent copy of the state vector."""
+        while True:
+            seq = self._seq()
+            if seq % 2 == 1:
+                continue
+            state = bytes(self._buf[self.HEADER.size:])
+            if self._seq() == seq:
+                return state
+
+    def close(self):
+        self._buf.release()
+        self.shm.close()
+
+
+def engine_main(shm_name: str, commands: Connection, events: Connection,
+                simulate: bool, trace: bool, setlist_cc: tuple[int, ...], clock_port: str):
+    """Entry point of the engine process. Events are sent from the reader
+    and sender threads, as ("value", ctrl, mod, value, token),
+    ("setlist", position) or ("device", connected, sync time). Every
+    `METRICS_INTERVAL`, the metrics of this process are sent as
+    ("metrics", samples), to be exported by the GUI process."""
+    logging.getLogger().setLevel(logging.DEBUG)
+    if trace:
+        tracer.enable()
+    engine = Engine(Register.new(), simulate=simulate, setlist_cc=setlist_cc,
+                    clock_port=clock_port)
+    register = engine.register
+    shared = SharedState.attach(register.plan, shm_name)
+    shared.write_all(register.snapshot().state)
+    events_lock = Lock()
+
+    def on_value(ctrl, mod, value, token):
+        shared.write({ (mod, ctrl): value })
+        with events_lock:
+            events.send(("value", ctrl, mod, value, token))
+
+    def on_setlist(position):
+        with events_lock:
+            events.send(("setlist", position))
+
+    def on_device(connected, sync_time):
+        with events_lock:
+            events.send(("device", connected, sync_time))
+
+    def send_metrics():
+        while not engine.quit_event.wait(METRICS_INTERVAL):
+            with events_lock:
+                events.send(("metrics", registry.samples()))
+
+    engine.on_value = on_value
+    engine.on_setlist = on_setlist
+    engine.on_device = on_device
+    on_device(engine.connected, None)
+    engine.start()
+    Thread(target=send_metrics).start()
+    while not engine.quit_event.is_set():
+        if not commands.poll(0.1):
+            continue
+        method, *args = commands.recv()
+        match method:
+            case "send":
+                ctrl, mod, value, _ = args
+                # selector messages have no slot in the register
+                if mod is not None and register.gui_msg(ctrl, mod, value):
+                    shared.write({ (mod, ctrl): value })
+                engine.send(*args)
+            case "restore":
+                engine.restore(*args)
+                shared.write_all(register.snapshot().state)
+            case "load_midi":
+                engine.load_midi(*args)
+            case "send_all":
+                engine.send_all()
+            case "load_setlist":
+                engine.load_setlist(*args)
+            case "setlist_goto":
+                engine.setlist_goto(*args)
+            case "setlist_step":
+                engine.setlist_step(*args)
+            case "load_sequence":
+                engine.load_sequence(*args)
+            case "stop":
+                engine.stop()
+    if trace:
+        logging.info("engine latency:\n%s", tracer.dump())
+    shared.close()
+
+
+class EngineProcess:
+    """Runs the `Engine` in a separate process, so that MIDI timing does not
+    suffer from work in the GUI. Presents the same interface as `Engine`.
+
+    The register in this process is a mirror, kept up to date with the
+    values we send and the values reported by the engine. For a consistent
+    copy of the engine's state, use `get_midi`, which reads the shared
+    memory. The metrics of the engine process are merged into `registry`
+    here, so they are exported along with those of the GUI.
+    """
+    def __init__(self, register: Register, simulate: bool = False,
+                 setlist_cc: tuple[int, ...] = (), clock_port: str = "through"):
+        self.register = register
+        self.on_value: Optional[OnValue] = None
+        self.on_setlist: Optional[Callable[[int], None]] = None
+        self.on_device: Optional[Callable[[bool, Optional[float]], None]] = None
+        self.connected = False
+        self.quit_event = threading.Event()
+        self.shared = SharedState.create(register.plan)
+        ctx = multiprocessing.get_context("spawn")
+        self._commands, engine_commands = ctx.Pipe()
+        engine_events, self._events = ctx.Pipe()
+        self._process = ctx.Process(
+            target=engine_main, name="nymphescc-engine",
+            args=(self.shared.shm.name, engine_commands, engine_events,
+                  simulate, tracer.enabled, setlist_cc, clock_port))
+
+    def start(self):
+        self._process.start()
+        Thread(target=self.read_events).start()
+
+    def stop(self):
+        self.quit_event.set()
+        self._commands.send(("stop",))
+        self._process.join()
+        self.shared.close()
+        self.shared.shm.unlink()
+
+    def read_events(self):
+        while not self.quit_event.is_set():
+            if not self._events.poll(0.1):
+                continue
+            try:
+                kind, *event = self._events.recv()
+            except EOFError:
+                break
+            match kind:
+                case "value":
+                    ctrl, mod, value, token = event
+                    self.register.write(ctrl, mod, value)
+                    if self.on_value is not None:
+                        self.on_value(ctrl, mod, value, token)
+                case "setlist":
+                    if self.on_setlist is not None:
+                        self.on_setlist(*event)
+                case "device":
+                    self.connected = event[0]
+                    if self.on_device is not None:
+                        self.on_device(*event)
+                case "metrics":
+                    registry.merge(*event)
+
+    def send(self, ctrl: str, mod: Optional[int], value: int, token: Token = None):
+        self._commands.send(("send", ctrl, mod, value, token))
+
+    def send_all(self):
+        self._commands.send(("send_all",))
+
+    def restore(self, midi: bytes, resend: bool):
+        self.register.load_midi(midi)
+        self._commands.send(("restore", midi, resend))
+
+    def load_midi(self, midi: bytes, forward: bool = True):
+        self._commands.send(("load_midi", midi, forward))
+
+    def load_setlist(self, snapshots: list[tuple[int, bytes]]):
+        self._commands.send(("load_setlist", snapshots))
+
+    def setlist_goto(self, index: int):
+        self._commands.send(("setlist_goto", index))
+
+    def setlist_step(self, step: int):
+        self._commands.send(("setlist_step", step))
+
+    def load_sequence(self, steps: int, division: int, values: list[StepValue]):
+        self._commands.send(("load_sequence", steps, division, values))
+
+    def get_midi(self) -> bytes:
+        return self.register.plan.encode_state(self.shared.read())
+
+
+def test_shared_state():
+    register = Register.new()
+    plan = register.plan
+    reader = SharedState.create(plan)
+    writer = SharedState.attach(plan, reader.shm.name)
+    try:
+        writer.write({ (2, "filter.cut"): 99, (0, "misc.amp"): 127 })
+        state = reader.read()
+        assert state[plan.index[2, "filter.cut"]] == 99
+        assert state[plan.index[0, "misc.amp"]] == 127
+        assert reader.HEADER.unpack_from(reader.shm.buf)[0] == 2
+    finally:
+        writer.close()
+        reader.close()
+        reader.shm.unlink()
+
+
+def test_engine():
+    register = Register.new()
+    engine = Engine(register, simulate=True)
+    received = []
+    engine.on_value = lambda *msg: received.append(msg)
+    engine.start()
+    try:
+        register.gui_msg("filter.cut", 0, 64)
+        engine.send("filter.cut", 0, 64)
+        register.gui_msg("reverb.mix", 2, 17)
+        engine.send("reverb.mix", 2, 17)
+        engine.q_out.join()
+        engine.nymphes_out_port.assert_state(register)
+        assert received == []   # echoes are suppressed
+        assert engine.get_midi() == register.plan.encode(register.values)
+
+        def echoes(n):
+            deadline = time.monotonic() + 10.0
+            while engine.echo.suppressed < n and time.monotonic() < deadline:
+                time.sleep(0.01)
+            return engine.echo.suppressed
+
+        sent = echoes(2)
+        engine.send_all()
+        engine.q_out.join()
+        assert echoes(sent + len(register.plan.slots)) == sent + len(register.plan.slots)
+        assert received == []
+    finally:
+        engine.stop()
+
+
+def test_setlist_triggers():
+    register = Register.new()
+    engine = Engine(register, simulate=True, setlist_cc=(80, 81))
+    positions = []
+    engine.on_setlist = positions.append
+    patches = []
+    for cut in (10, 20, 30):
+        patch = Register.new()
+        patch.write("filter.cut", 0, cut)
+        patches.append(patch)
+    engine.load_setlist([(i, p.snapshot().midi()) for i, p in enumerate(patches)])
+    engine.start()
+    try:
+        through = BytesPort(b"".join(msg.bin() for msg in [
+            mido.Message("program_change", program=1),
+            mido.Message("control_change", control=80, value=127),
+            mido.Message("control_change", control=80, value=0),
+            mido.Message("control_change", control=74, value=5),
+            mido.Message("control_change", control=81, value=127)]))
+        assert list(engine.triggers(through.read_midi(None))) == [(0, 74, 5)]
+        engine.q_out.join()
+        assert positions == [1, 2, 1]
+        engine.nymphes_out_port.assert_state(patches[1])
+        assert register.values[0]["filter.cut"] == 20
+    finally:
+        engine.stop()
+
+
+def test_sequencer_clock():
+    from .sim import SimulatedClock
+    register = Register.new()
+    register.write("filter.cut", 0, 64)
+    engine = Engine(register, simulate=True, clock_port="device")
+    device = engine.nymphes_out_port
+    register.send_all(device)
+    engine.load_sequence(2, 3, [(0, 0, "filter.cut", 10), (1, 2, "reverb.mix", 90)])
+    played = []
+
+    def play(step):
+        played.append(step.values)
+        engine.queue_step(step)
+    engine.sequencer.play = play
+    clock = BytesPort(b"".join(mido.Message(kind).bin() for kind in ("start", "clock", "stop")))
+    assert list(engine.clock(clock.read_midi(None))) == []
+    engine.start()
+    try:
+        SimulatedClock(bpm=300).run(engine.sequencer.handle, ticks=12)
+        engine.q_out.join()
+        assert played[:4] == [[("filter.cut", 0, 10)], [("reverb.mix", 2, 90)]] * 2
+        assert engine.pending_bytes == 0
+        # the steps were timed when they were on the wire
+        assert len(engine.sequencer.errors) >= 3
+        # after stop, the sequenced settings are back at their values
+        device.assert_state(register)
+    finally:
+        engine.stop()
+
+
+def test_hotplug():
+    register = Register.new()
+    engine = Engine(register, simulate=True)
+    device = engine.nymphes_out_port
+    changes = Queue()
+    engine.on_device = lambda *change: changes.put(change)
+    engine.start()
+    try:
+        device.unplug()
+        assert changes.get(timeout=10.0) == (False, None)
+        register.gui_msg("reverb.mix", 2, 17)
+        engine.send("reverb.mix", 2, 17)
+        engine.q_out.join()
+        assert device.diff(register) == [(2, "reverb.mix", 0, 17)]
+        device.plug()
+        connected, sync_time = changes.get(timeout=10.0)
+        assert connected and sync_time > 0
+        device.assert_state(register)
+        assert device.selector_switches == register.plan.last_mod
+    finally:
+        engine.stop()
+
+
+def test_engine_process():
+    import time
+    register = Register.new()
+    engine = EngineProcess(register, simulate=True)
+    engine.start()
+    try:
+        register.gui_msg("reverb.mix", 2, 17)
+        engine.send("reverb.mix", 2, 17)
+        expected = register.plan.encode(register.values)
+        deadline = time.monotonic() + 10.0
+        while engine.get_midi() != expected:
+            assert time.monotonic() < deadline
+            time.sleep(0.01)
+        # the engine's metrics are exported from this process
+        while ("nymphescc_device_connected", ()) not in registry._remote:
+            assert time.monotonic() < deadline + METRICS_INTERVAL
+            time.sleep(0.01)
+        assert registry._remote["nymphescc_device_connected", ()] == ("gauge", (1,))
+    finally:
+        engine.stop()
+# ~\~ end
@@ -0,0 +1,123 @@
+# ~\~ language=Python filename=nymphescc/generate.py
+# ~\~ begin <<lit/generate.md|nymphescc/generate.py>>[0]
+from __future__ import annotations
+from typing import Mapping, Optional
+
+import numpy as np
+
+from .core import Register
+from .compare import Comparator, Patch
+from .db import NymphesDB
+
+
+class Generator:
+    """Generates variations of patches, as arrays of state vectors (one row
+    per patch, one column per slot of the transmit plan).
+
+    The amount of change is a strength between 0 and 1, which can be set
+    per group of settings ("filter", "lfo", ...). For a continuous setting,
+    the strength is the standard deviation of the change as a fraction of
+    its range. An enum setting is set to a random label with a probability
+    equal to the strength. Values always stay within the bounds of their
+    setting. Given a `seed`, the result is reproducible.
+    """
+    def __init__(self, register: Register):
+        self._comparator = Comparator(register)
+        settings = [(ctrl, register.flat_config[ctrl]) for _, ctrl in register.plan.slots]
+        self._groups = np.array([ctrl.split(".")[0] for ctrl, _ in settings])
+        self._lower = np.array([s.bounds.lower for _, s in settings], dtype=np.int16)
+        self._upper = np.array([s.bounds.upper for _, s in settings], dtype=np.int16)
+        self._enum = np.array([s.is_enum() for _, s in settings])
+
+    def _strengths(self, strength: float, groups: Optional[Mapping[str, float]]) -> np.ndarray:
+        strengths = np.full(len(self._groups), strength)
+        for group, s in (groups or {}).items():
+            strengths[self._groups == group] = s
+        return strengths
+
+    def mutate(self, states: np.ndarray, strength: float,
+               groups: Optional[Mapping[str, float]] = None,
+               rng: Optional[np.random.Generator] = None) -> np.ndarray:
+        """Returns a mutated copy of `states`."""
+        rng = rng or np.random.default_rng()
+        strengths = self._strengths(strength, groups)
+        span = self._upper - self._lower
+        noise = rng.standard_normal(states.shape) * (strengths * span)
+        result = np.rint(states + noise)
+        picked = rng.random(states.shape) < strengths
+        labels = rng.integers(self._lower, self._upper + 1, size=states.shape)
+        result = np.where(self._enum, np.where(picked, labels, states), result)
+        return np.clip(result, self._lower, self._upper).astype(np.uint8)
+
+    def variations(self, patch: Patch, n: int, strength: float = 0.1,
+                   groups: Optional[Mapping[str, float]] = None,
+                   seed: Optional[int] = None) -> np.ndarray:
+        """`n` variations around `patch`."""
+        state = self._comparator.state(patch)
+        states = np.broadcast_to(state, (n, len(state)))
+        return self.mutate(states, strength, groups, np.random.default_rng(seed))
+
+    def between(self, a: Patch, b: Patch, n: int, strength: float = 0.0,
+                groups: Optional[Mapping[str, float]] = None,
+                seed: Optional[int] = None) -> np.ndarray:
+        """`n` patches at random points between `a` and `b`, mutated by
+        `strength`. Enum settings take the value of either patch, with a
+        chance of `b` that grows towards it."""
+        rng = np.random.default_rng(seed)
+        sa = self._comparator.state(a).astype(np.int16)
+        sb = self._comparator.state(b, sa.astype(np.uint8)).astype(np.int16)
+        t = rng.random((n, 1))
+        states = np.where(self._enum,
+                          np.where(rng.random((n, len(sa))) < t, sb, sa),
+                          np.rint(sa + t * (sb - sa)))
+        return self.mutate(states, strength, groups, rng)
+
+    def midis(self, states: np.ndarray) -> list[bytes]:
+        return self._comparator.midis(states)
+
+
+def store(db: NymphesDB, generator: Generator, name: str, states: np.ndarray) -> int:
+    """Store generated patches as a new group, in a single transaction.
+    Returns the id of the group. The parameters of the new snapshots are
+    not indexed; call `db.index_parameters()` afterwards."""
+    return db.new_group_snapshots(name, generator.midis(states), index=False)
+
+
+def test_generator(tmp_path):
+    from .db import Condition
+    register = Register.new()
+    register.write("filter.cut", 0, 64)
+    register.write("lfo.lfo-1.type", 0, 2)
+    generator = Generator(register)
+    index = register.plan.index
+    states = generator.variations(register.snapshot(), 1000, 0.2,
+                                  groups={"filter": 0.5, "reverb": 0.0}, seed=1)
+    assert states.shape == (1000, len(register.plan.slots))
+    assert (states == generator.variations(register.snapshot(), 1000, 0.2,
+                                           groups={"filter": 0.5, "reverb": 0.0},
+                                           seed=1)).all()
+    assert (states >= generator._lower).all() and (states <= generator._upper).all()
+    assert (states[:, index[0, "reverb.mix"]] == 0).all()
+    assert states[:, index[0, "filter.cut"]].std() > 20
+    lfo_type = states[:, index[0, "lfo.lfo-1.type"]]
+    assert set(lfo_type.tolist()) == {0, 1, 2, 3}
+    assert 750 < (lfo_type == 2).sum() < 900
+
+    other = Register.new()
+    other.write("filter.cut", 0, 100)
+    other.write("lfo.lfo-1.type", 0, 3)
+    mixed = generator.between(register.snapshot(), other.snapshot(), 100, seed=2)
+    cut = mixed[:, index[0, "filter.cut"]]
+    assert (cut >= 64).all() and (cut <= 100).all()
+    assert set(mixed[:, index[0, "lfo.lfo-1.type"]].tolist()) == {2, 3}
+
+    db = NymphesDB(tmp_path / "test.db", decode=register.decode)
+    group_id = store(db, generator, "variations", states[:10])
+    snapshots = db.snapshots(group_id)
+    assert len(snapshots) == 10
+    assert db.index_parameters(batch_size=3) == 10
+    assert (generator._comparator.states([s.midi for s in snapshots]) == states[:10]).all()
+    assert db.find_snapshots([Condition.equal("lfo.lfo-1.type", 2)], group_id) == \
+        [s.key for s, t in zip(snapshots, lfo_type) if t == 2]
+    db.close()
+# ~\~ end
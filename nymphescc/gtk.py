@@ -1,99 +1,154 @@
 # ~\~ language=Python filename=nymphescc/gtk.py
 # ~\~ begin <<lit/gtk.md|nymphescc/gtk.py>>[0]
 from __future__ import annotations
+import argparse
 from dataclasses import dataclass, field
 import logging
-import queue
-from queue import Queue
 import threading
 from threading import Thread
 from importlib import resources
-import re
+import signal
 from collections import OrderedDict
 from datetime import datetime
 import functools
+from pathlib import Path
+from typing import Callable, Optional
 
 import gi
 gi.require_version("Gtk", "4.0")
 from gi.repository import GObject, Gtk, GLib, Gdk, Gio
 
-from alsa_midi import SequencerClient
 from .messages import read_settings, Group, modulators
-from .core import Register, AlsaPort, BytesPort
-from .db import NymphesDB
+from .core import Register
+from .db import NymphesDB, Change
+from .engine import Engine, EngineProcess
+from .compare import Comparator
+from .library import Library, LibraryError
+from .generate import Generator, store
+from .trace import tracer
+from .watchdog import Watchdog
+from . import metrics
+from .metrics import registry
+
+
+# Interval (ms) at which we check the database for changes by other processes.
+DB_POLL_INTERVAL = 1000
+# Interval (s) at which the live state is saved, if it changed.
+AUTOSAVE_INTERVAL = 5.0
+# Number of variations made at once, and how much they differ.
+VARIATIONS = 1000
+VARIATION_STRENGTH = 0.1
+
+IDLE_BACKLOG = registry.gauge(
+    "nymphescc_gtk_idle_backlog", "UI updates waiting for the GTK main loop.")
+# the backlog is updated from the reader threads and the GTK thread
+IDLE_BACKLOG_LOCK = threading.Lock()
 
 
 class Interface:
-    def __init__(self):
-        self.q_out = Queue()
+    """The GUI side of the application: the register as shown, the MIDI
+    engine, and the database. The engine runs in threads of this process,
+    or in its own process if `engine_process` is set. The interface takes
+    over the mounted `libraries`, and closes them when it stops."""
+    def __init__(self, resend_state=False, simulate=False, engine_process=False,
+                 setlist_cc=(), libraries=(), clock_port="through"):
         self.set_ui_value = None
+        self.set_setlist_position = None
+        self.set_device_status = None
+        self.setlist_name: Optional[str] = None
+        self.setlist_length = 0
         self.register = Register.new()
-        client = SequencerClient("NymphesCC")
-        self.nymphes_in_port = AlsaPort(client, "device-in", "in")
-        self.nymphes_out_port = AlsaPort(client, "device-out", "out")
-        self.through_port = AlsaPort(client, "through", "in")
+        self.libraries = list(libraries)
+        if engine_process:
+            self.engine = EngineProcess(self.register, simulate=simulate, setlist_cc=setlist_cc,
+                                        clock_port=clock_port)
+        else:
+            self.engine = Engine(self.register, simulate=simulate, setlist_cc=setlist_cc,
+                                 clock_port=clock_port)
+        self.engine.on_value = self.set_ui
+        self.engine.on_setlist = self.set_setlist
+        self.engine.on_device = self.set_device
         self.quit_event = threading.Event()
-        self.db = NymphesDB()
-
-        self.nymphes_in_port.auto_connect()
-        self.nymphes_out_port.auto_connect()
-
-    def set_ui(self, ctrl, mod, value):
-        GLib.idle_add(self.set_ui_value, ctrl, mod, value)
-
-    def send_nymphes(self):
+        self.db = NymphesDB(decode=self.register.decode)
+
+        live_state = self.db.live_state()
+        if live_state is not None:
+            self.engine.restore(live_state, resend_state)
+
+    def set_ui(self, ctrl, mod, value, token=None):
+        tracer.stamp(token, "idle_add")
+        with IDLE_BACKLOG_LOCK:
+            IDLE_BACKLOG.inc()
+        GLib.idle_add(self.idle_set_ui, ctrl, mod, value, token)
+
+    def idle_set_ui(self, ctrl, mod, value, token):
+        with IDLE_BACKLOG_LOCK:
+            IDLE_BACKLOG.dec()
+        self.set_ui_value(ctrl, mod, value, token)
+
+    def set_setlist(self, position):
+        if self.set_setlist_position is not None:
+            GLib.idle_add(self.set_setlist_position, position)
+
+    def set_device(self, connected, sync_time):
+        if self.set_device_status is not None:
+            GLib.idle_add(self.set_device_status, connected, sync_time)
+
+    def load_setlist(self, setlist_id, name):
+        snapshots = self.db.setlist(setlist_id)
+        self.engine.load_setlist([(s.key, s.midi) for s in snapshots])
+        self.setlist_name = name
+        self.setlist_length = len(snapshots)
+        self.set_setlist(None)
+
+    def load_sequence(self, sequence_id):
+        info, values = self.db.sequence(sequence_id)
+        self.engine.load_sequence(info.steps, info.division, values)
+
+    def stop(self):
+        self.quit_event.set()
+        self.engine.stop()
+        for library in self.libraries:
+            library.close()
+
+    def autosave(self, interval=AUTOSAVE_INTERVAL):
+        """Store the register in the database whenever it changed, at most
+        once every `interval` seconds. Runs in its own thread, so it uses its
+        own database connection."""
+        db = NymphesDB()
+        saved = self.register.version
         while True:
-            try:
-                ctrl, mod, value = self.q_out.get(timeout=0.1)
-            except queue.Empty:
-                if self.quit_event.is_set():
-                    break
-                else:
-                    continue
-
-            if mod is not None and mod != 0 and self.nymphes_out_port.selected_mod != mod:
-                self.nymphes_out_port.send_cc(
-                    0, self.register.flat_config["modulators.selector"].cc, mod - 1)
-                self.nymphes_out_port.selected_mod = mod
-            if mod is not None and mod > 0:
-                self.nymphes_out_port.send_cc(
-                    0, self.register.flat_config[ctrl].mod, value)
-            else:
-                self.nymphes_out_port.send_cc(
-                    0, self.register.flat_config[ctrl].cc, value)
-
-            self.q_out.task_done()
-
-    def read_port(self, port, forward=False):
-        for chan, param, value in port.read_cc(self.quit_event):
-            if forward:
-                self.nymphes_out_port.send_cc(chan, param, value)
-            if param not in self.register.midi_map:
-                logging.warn("msg %u %u %u unknown", chan, param, value)
-                continue
-            kind, ctrl = self.register.midi_map[param]
-            logging.debug("msg %u %u %u, read as %s:%s", chan, param, value, kind, ctrl)
-            if kind == "mod":
-                self.register.values[port.selected_mod][ctrl] = value
-                self.set_ui(ctrl, port.selected_mod, value)
-            elif ctrl == "modulators.selector":
-                port.selected_mod = value + 1
-            else:
-                self.register.values[0][ctrl] = value
-                self.set_ui(ctrl, 0, value)
-
-    def read_nymphes(self):
-        self.read_port(self.nymphes_in_port, forward=False)
+            stop = self.quit_event.wait(interval)
+            if self.register.version != saved:
+                saved = self.register.version
+                db.save_live_state(self.get_midi())
+            if stop:
+                break
+        db.close()
+
+    def index(self):
+        """Index the parameters of snapshots that were stored without a
+        decoder. Runs in its own thread, so it uses its own database
+        connection."""
+        db = NymphesDB(decode=self.register.decode)
+        db.index_parameters(stop=self.quit_event)
+        db.close()
+
+    def generate(self, patch, n=VARIATIONS, strength=VARIATION_STRENGTH):
+        """Store `n` variations of `patch` as a new group. Runs in its own
+        thread, so it uses its own database connection."""
+        db = NymphesDB(decode=self.register.decode)
+        generator = Generator(self.register)
+        name = "Variations " + datetime.now().strftime("%c")
+        store(db, generator, name, generator.variations(patch, n, strength))
+        db.index_parameters()
+        db.close()
 
     def load_snapshot(self, snap_id):
-        midi = self.db.snapshot(snap_id).midi
-        port = BytesPort(midi)
-        self.read_port(port, forward=True)
+        self.engine.load_midi(self.db.snapshot(snap_id).midi, forward=True)
 
     def get_midi(self):
-        port = BytesPort()
-        self.register.send_all(port)
-        return port.bytes
+        return self.engine.get_midi()
 
 
 def slider_group(group: Group, on_changed):
@@ -229,18 +284,91 @@ class GGroupInfo(GObject.GObject):
 class GSnapshotInfo(GObject.GObject):
     key = GObject.property(type=int)
     timestamp = GObject.property(type=float)
+    changes = GObject.property(type=int, default=-1)
 
     def __init__(self):
         super(GSnapshotInfo, self).__init__()
 
     @staticmethod
-    def new(key: int, timestamp: float) -> GSnapshotInfo:
+    def new(key: int, timestamp: float, changes: int = -1) -> GSnapshotInfo:
         obj = GSnapshotInfo()
         obj.key = key
         obj.timestamp = timestamp
+        obj.changes = changes
         return obj
 
 
+class PagedListModel(GObject.Object, Gio.ListModel):
+    """List model that fetches its items in pages, only when they are
+    requested by the view. At most `max_pages` pages are kept in memory.
+
+    Args:
+        item_type: GObject type of the items.
+        count: function returning the total number of items.
+        fetch: function taking an offset and limit, returning a list of items.
+    """
+    def __init__(self, item_type, count, fetch, page_size=100, max_pages=8):
+        super(PagedListModel, self).__init__()
+        self._item_type = item_type
+        self._count = count
+        self._fetch = fetch
+        self._page_size = page_size
+        self._max_pages = max_pages
+        self._pages: OrderedDict[int, list] = OrderedDict()
+        self._n_items = count()
+
+    def do_get_item_type(self):
+        return self._item_type.__gtype__
+
+    def do_get_n_items(self):
+        return self._n_items
+
+    def do_get_item(self, position):
+        if position >= self._n_items:
+            return None
+        page, offset = divmod(position, self._page_size)
+        if page in self._pages:
+            self._pages.move_to_end(page)
+        else:
+            self._pages[page] = self._fetch(page * self._page_size, self._page_size)
+            if len(self._pages) > self._max_pages:
+                self._pages.popitem(last=False)
+        items = self._pages[page]
+        return items[offset] if offset < len(items) else None
+
+    def cached_item(self, position):
+        """Returns the item at `position` if it is loaded, None otherwise."""
+        page, offset = divmod(position, self._page_size)
+        items = self._pages.get(page, [])
+        return items[offset] if offset < len(items) else None
+
+    def _invalidate(self, position):
+        first = position // self._page_size
+        for page in [p for p in self._pages if p >= first]:
+            del self._pages[page]
+
+    def reset(self, count=None, fetch=None):
+        """Reload all items, optionally from a new source."""
+        self._count = count or self._count
+        self._fetch = fetch or self._fetch
+        removed = self._n_items
+        self._pages.clear()
+        self._n_items = self._count()
+        self.items_changed(0, removed, self._n_items)
+
+    def insert(self, position, n=1):
+        """Notify the model that `n` items were inserted at `position`."""
+        self._invalidate(position)
+        self._n_items += n
+        self.items_changed(position, 0, n)
+
+    def remove(self, position, n=1):
+        """Notify the model that `n` items were removed at `position`."""
+        self._invalidate(position)
+        self._n_items -= n
+        self.items_changed(position, n, 0)
+
+
 class DeletableRow(Gtk.Box):
     def __init__(self):
         super(DeletableRow, self).__init__()
@@ -271,6 +399,10 @@ class DeletableRow(Gtk.Box):
     def set_label(self, text: str):
         self._label.set_label(text)
 
+    @property
+    def label(self):
+        return self._label
+
     @property
     def delete_button(self):
         return self._delete_button
@@ -289,90 +421,228 @@ def maybe(f):
 @dataclass
 class SessionPane:
     iface: Interface
+    source: Gtk.DropDown
     search_entry: Gtk.SearchEntry
-    session_list: Gtk.ListBox
+    session_list: Gtk.ListView
     add_session_button: Gtk.Button
 
     info_box: Gtk.Box
     name: Gtk.Entry
     description: Gtk.TextView
-    snapshot_list: Gtk.ListBox
+    snapshot_list: Gtk.ListView
     add_snapshot_button: Gtk.Button
-
-    session_list_store: Gio.ListStore \
-        = field(default_factory=lambda: Gio.ListStore.new(GGroupInfo))
-    snapshot_list_store: Gio.ListStore \
-        = field(default_factory=lambda: Gio.ListStore.new(GSnapshotInfo))
+    compare_button: Gtk.ToggleButton
+    setlist_button: Gtk.Button
+    generate_button: Gtk.Button
+
+    session_model: PagedListModel = field(init=False)
+    session_selection: Gtk.SingleSelection = field(init=False)
+    snapshot_model: PagedListModel = field(init=False)
+    snapshot_selection: Gtk.SingleSelection = field(init=False)
+    comparator: Comparator = field(init=False)
+    # The mounted library shown instead of the database, if any. Groups and
+    # snapshots are then keyed by their index in the library.
+    library: Optional[Library] = field(init=False)
+    # Patches in the library that match the search, in library order; None
+    # if we're not searching.
+    matches: Optional[list[int]] = field(init=False)
+    # Called with the differences between the live state and the selected
+    # snapshot in compare mode, or None when leaving compare mode.
+    show_diff: Callable[[Optional[list[tuple[int, str, int, int]]]], None] = field(init=False)
 
     def __post_init__(self):
-        self.session_list.bind_model(self.session_list_store, self.session_list_row)
-        self.snapshot_list.bind_model(self.snapshot_list_store, self.snapshot_list_row)
-        self.session_list.connect("row-selected", self.select_group_event)
-        self.snapshot_list.connect("row-selected", self.select_snapshot_event)
+        self.library = None
+        self.matches = None
+        self.session_model = PagedListModel(
+            GGroupInfo, self.group_count, self.group_page)
+        self.session_selection = selection_model(self.session_model)
+        self.session_list.set_model(self.session_selection)
+        self.session_list.set_factory(list_factory(
+            self.session_list_row_setup, self.session_list_row_bind,
+            self.session_list_row_unbind))
+
+        self.snapshot_model = PagedListModel(GSnapshotInfo, lambda: 0, lambda *_: [])
+        self.snapshot_selection = selection_model(self.snapshot_model)
+        self.snapshot_list.set_model(self.snapshot_selection)
+        self.snapshot_list.set_factory(list_factory(
+            self.snapshot_list_row_setup, self.snapshot_list_row_bind))
+
+        self.session_selection.connect("notify::selected-item", self.select_group_event)
+        self.snapshot_selection.connect("notify::selected-item", self.select_snapshot_event)
         self.add_session_button.connect("clicked", self.add_session_event)
         self.add_snapshot_button.connect("clicked", self.add_snapshot_event)
+        self.compare_button.connect("toggled", self.compare_toggled_event)
+        self.setlist_button.connect("clicked", self.setlist_event)
+        self.generate_button.connect("clicked", self.generate_event)
+        self.source.connect("notify::selected", self.source_changed_event)
+        self.search_entry.connect("search-changed", self.search_changed_event)
+        self.comparator = Comparator(self.iface.register)
+        self.show_diff = lambda _: None
         self.name.connect("changed", self.name_changed_event)
         self.description.get_buffer().connect("changed", self.description_changed_event)
         self.name.connect("editing-done", self.focus_description)
-        self.load_groups()
-        self._selected_row = None
+        self._snapshot_group = None
+        self.iface.db.subscribe(self.apply_changes)
+        GLib.timeout_add(DB_POLL_INTERVAL, self.poll_db)
 
     @maybe
     def group_id(self):
-        idx = self.session_list.get_selected_row().get_index()
-        return self.session_list_store.get_item(idx).key
+        return self.group_info().key
 
-    @maybe
     def group_info(self):
-        idx = self.session_list.get_selected_row().get_index()
-        return self.session_list_store.get_item(idx)
+        return self.session_selection.get_selected_item()
 
     @maybe
     def snapshot_id(self):
-        idx = self.snapshot_list.get_selected_row().get_index()
-        return self.snapshot_list_store.get_item(idx).key
+        return self.snapshot_selection.get_selected_item().key
+
+    def group_count(self):
+        if self.library is not None:
+            return len(self.library_groups())
+        return self.iface.db.group_count()
+
+    def group_page(self, offset, limit):
+        if self.library is not None:
+            return [GGroupInfo.new(g, self.library.group_name(g), None)
+                    for g in self.library_groups()[offset:offset + limit]]
+        return [GGroupInfo.new(g.key, g.name, g.description)
+                for g in self.iface.db.groups_page(offset, limit)]
+
+    def library_groups(self):
+        """Groups of the library that are shown: those with a match, when
+        searching."""
+        if self.matches is None:
+            return range(len(self.library.groups))
+        return sorted({int(self.library.patches[i]["group"]) for i in self.matches})
+
+    def library_patches(self, group):
+        patches = self.library.group_patches(group)
+        if self.matches is None:
+            return patches
+        return [i for i in self.matches if i in patches]
+
+    def library_page(self, library, patches):
+        def fetch(offset, limit):
+            page = patches[offset:offset + limit]
+            if self.compare_button.get_active():
+                live = self.comparator.state(self.iface.register.snapshot())
+                changes = (library.states[list(page)] != live).sum(axis=1).tolist()
+            else:
+                changes = [-1] * len(page)
+            return [GSnapshotInfo.new(i, float(library.patches[i]["timestamp"]), n)
+                    for i, n in zip(page, changes)]
+        return fetch
+
+    def snapshot_midi(self, snap_id):
+        if self.library is not None:
+            return self.library.midi(snap_id)
+        return self.iface.db.snapshot(snap_id).midi
+
+    def snapshot_page(self, group_id):
+        def fetch(offset, limit):
+            page = self.iface.db.snapshots_page(group_id, offset, limit)
+            if self.compare_button.get_active():
+                changes = self.comparator.changes(
+                    self.iface.register.snapshot(), [s.midi for s in page]).tolist()
+            else:
+                changes = [-1] * len(page)
+            return [GSnapshotInfo.new(s.key, s.timestamp.timestamp(), n)
+                    for s, n in zip(page, changes)]
+        return fetch
+
+    def session_list_row_setup(self, _, list_item):
+        row = DeletableRow.new("")
+        row.delete_button.connect("clicked", self.delete_session, list_item)
+        list_item.bind_property("selected", row.delete_button, "visible",
+                                GObject.BindingFlags.SYNC_CREATE)
+        list_item.set_child(row)
+
+    def session_list_row_bind(self, _, list_item):
+        row = list_item.get_child()
+        row.binding = list_item.get_item().bind_property(
+            "name", row.label, "label", GObject.BindingFlags.SYNC_CREATE)
+
+    def session_list_row_unbind(self, _, list_item):
+        list_item.get_child().binding.unbind()
+
+    def snapshot_list_row_setup(self, _, list_item):
+        label = Gtk.Label()
+        label.set_margin_top(5)
+        label.set_margin_bottom(5)
+        list_item.set_child(label)
 
-    def session_list_row(self, group_info: GGroupInfo) -> DeletableRow:
-        x = DeletableRow.new(group_info.name)
-        x.delete_button.connect("clicked", self.delete_session)
-        return x
+    def snapshot_list_row_bind(self, _, list_item):
+        item = list_item.get_item()
+        label = datetime.fromtimestamp(item.timestamp).strftime("%c")
+        if item.changes >= 0:
+            label += f" ({item.changes} changes)"
+        list_item.get_child().set_label(label)
 
     def focus_description(self, _):
         self.description.grab_focus()
 
-    def delete_session(self, _):
-        idx = self.session_list.get_selected_row().get_index()
-        self.iface.db.delete_group(self.group_id())
-        self._selected_row = None
-        self.session_list_store.remove(idx)
+    def delete_session(self, _, list_item):
+        if self.library is None:
+            self.iface.db.delete_group(list_item.get_item().key)
 
-    def snapshot_list_row(self, snapshot_info: GSnapshotInfo) -> Gtk.Label:
-        return Gtk.Label.new(datetime.fromtimestamp(snapshot_info.timestamp).strftime("%c"))
+    def poll_db(self):
+        self.iface.db.poll()
+        return GLib.SOURCE_CONTINUE
+
+    def apply_changes(self, changes: Optional[list[Change]]):
+        """Apply changes in the database to the list models. If we can't be
+        sure of the position of each change, we reload."""
+        if self.library is not None:
+            return
+        structural = [c for c in changes or [] if c.kind != "group-renamed"]
+        if changes is None or len(structural) > 1:
+            self.load_groups()
+            if self._snapshot_group is not None:
+                self.load_snapshots(self._snapshot_group)
+            return
+
+        db = self.iface.db
+        for c in changes:
+            match c.kind:
+                case "group-added":
+                    self.session_model.insert(db.group_position(c.group))
+                case "group-deleted":
+                    self.session_model.remove(db.group_position(c.group))
+                case "group-renamed":
+                    item = self.session_model.cached_item(db.group_position(c.group))
+                    if item is not None and item.key == c.group:
+                        item.name = db.group_info(c.group).name
+                case "snapshot-added" if c.group == self._snapshot_group:
+                    self.snapshot_model.insert(db.snapshot_position(c.group, c.snapshot))
+                case "snapshot-deleted" if c.group == self._snapshot_group:
+                    self.snapshot_model.remove(db.snapshot_position(c.group, c.snapshot))
 
     def load_groups(self):
-        self.session_list_store.remove_all()
-        for g in self.iface.db.groups():
-            self.session_list_store.append(GGroupInfo.new(g.key, g.name, g.description))
+        self.session_model.reset()
 
     def load_snapshots(self, group_id):
-        self.snapshot_list_store.remove_all()
-        for s in self.iface.db.snapshots(group_id):
-            self.snapshot_list_store.append(GSnapshotInfo.new(s.key, s.timestamp.timestamp()))
+        self._snapshot_group = group_id
+        if self.library is not None:
+            patches = self.library_patches(group_id)
+            self.snapshot_model.reset(
+                functools.partial(len, patches), self.library_page(self.library, patches))
+            return
+        self.snapshot_model.reset(
+            functools.partial(self.iface.db.snapshot_count, group_id),
+            self.snapshot_page(group_id))
 
-    def select_group_event(self, _1, row):
-        if row is None:
+    def select_group_event(self, selection, _):
+        if selection.get_selected_item() is None:
             self.info_box.set_sensitive(False)
             self.name.set_text("")
             self.description.get_buffer().set_text("", -1)
-            self.snapshot_list_store.remove_all()
+            self._snapshot_group = None
+            self.snapshot_model.reset(lambda: 0)
             return
 
-        row.get_child().show_delete_button()
-        if self._selected_row:
-            self._selected_row.get_child().hide_delete_button()
-        self._selected_row = row
-
-        info = self.iface.db.group_info(self.group_id())
+        info = self.group_info()
+        if self.library is None:
+            info = self.iface.db.group_info(info.key)
         self.info_box.set_sensitive(True)
         self.name.set_text(info.name)
         self.description.get_buffer().set_text(info.description or "", -1)
@@ -381,53 +651,115 @@ class SessionPane:
     def select_snapshot_event(self, _1, _2):
         if self.snapshot_id() is None:
             return
-        self.iface.load_snapshot(self.snapshot_id())
+        if self.compare_button.get_active():
+            midi = self.snapshot_midi(self.snapshot_id())
+            self.show_diff(self.comparator.diff(self.iface.register.snapshot(), midi))
+        elif self.library is not None:
+            self.iface.engine.load_midi(self.library.midi(self.snapshot_id()), forward=True)
+        else:
+            self.iface.load_snapshot(self.snapshot_id())
+
+    def source_changed_event(self, dropdown, _):
+        selected = dropdown.get_selected()
+        self.library = self.iface.libraries[selected - 1] if selected > 0 else None
+        self.matches = None
+        writable = self.library is None
+        self.search_entry.set_text("")
+        self.search_entry.set_visible(not writable)
+        for widget in (self.add_session_button, self.add_snapshot_button,
+                       self.setlist_button, self.generate_button):
+            widget.set_sensitive(writable)
+        self.name.set_editable(writable)
+        self.description.set_editable(writable)
+        self.session_selection.set_selected(Gtk.INVALID_LIST_POSITION)
+        self.load_groups()
+
+    def search_changed_event(self, entry):
+        """Show only the library patches of which the name starts with the
+        search text, and the groups they are in."""
+        if self.library is None:
+            return
+        text = entry.get_text()
+        self.matches = sorted(self.library.search(text)) if text else None
+        self.session_selection.set_selected(Gtk.INVALID_LIST_POSITION)
+        self.load_groups()
+
+    def setlist_event(self, _):
+        info = self.group_info()
+        if info is None:
+            return
+        snap_ids = [s.key for s in self.iface.db.snapshots(info.key)]
+        setlist_id = self.iface.db.save_setlist(info.name, snap_ids)
+        self.iface.load_setlist(setlist_id, info.name)
+
+    def generate_event(self, _):
+        Thread(target=self.iface.generate, args=(self.iface.register.snapshot(),)).start()
+
+    def compare_toggled_event(self, button):
+        if not button.get_active():
+            self.show_diff(None)
+        if self._snapshot_group is not None:
+            self.load_snapshots(self._snapshot_group)
 
     def add_session_event(self, _):
         group_id = self.iface.db.new_group("New Group")
-        info = self.iface.db.group_info(group_id)
-        self.session_list_store.append(GGroupInfo.new(info.key, info.name, info.description))
-        idx = self.session_list_store.get_n_items() - 1
-        self.session_list.select_row(self.session_list.get_row_at_index(idx))
+        self.session_selection.set_selected(self.iface.db.group_position(group_id))
         self.name.select_region(0, -1)
         self.name.grab_focus()
 
     def add_snapshot_event(self, _):
-        snap_id = self.iface.db.new_snapshot(self.group_info().key, self.iface.get_midi())
-        s = self.iface.db.snapshot(snap_id)
-        self.snapshot_list_store.append(GSnapshotInfo.new(s.key, s.timestamp.timestamp()))
-        idx = self.snapshot_list_store.get_n_items() - 1
-        self.snapshot_list.select_row(self.snapshot_list.get_row_at_index(idx))
+        group_id = self.group_id()
+        snap_id = self.iface.db.new_snapshot(group_id, self.iface.get_midi())
+        self.snapshot_selection.set_selected(
+            self.iface.db.snapshot_position(group_id, snap_id))
 
     def name_changed_event(self, _):
-        if self.group_id() is None:
+        if self.group_id() is None or self.library is not None:
             return
         name = self.name.get_text()
         self.iface.db.set_name(self.group_id(), name)
-        self.group_info().name = name
-        self.session_list.get_selected_row().get_child().set_label(name)
 
     def description_changed_event(self, buffer):
+        if self.group_id() is None or self.library is not None:
+            return
         start = buffer.get_start_iter()
         end = buffer.get_end_iter()
         self.iface.db.set_description(self.group_id(), buffer.get_text(start, end, True))
 
 
+def selection_model(model: Gio.ListModel) -> Gtk.SingleSelection:
+    selection = Gtk.SingleSelection.new(model)
+    selection.set_autoselect(False)
+    selection.set_can_unselect(True)
+    return selection
+
+
+def list_factory(setup, bind, unbind=None) -> Gtk.SignalListItemFactory:
+    factory = Gtk.SignalListItemFactory()
+    factory.connect("setup", setup)
+    factory.connect("bind", bind)
+    if unbind is not None:
+        factory.connect("unbind", unbind)
+    return factory
+
+
 def session_pane(iface):
+    source = Gtk.DropDown.new_from_strings(
+        ["Patches"] + [library.name for library in iface.libraries])
+    source.set_visible(bool(iface.libraries))
     search_bar = Gtk.SearchEntry()
+    search_bar.set_placeholder_text("Search patches")
+    search_bar.set_visible(False)
 
     session_overlay = Gtk.Overlay()
-    session_list = Gtk.ListBox()
-    list_box = Gtk.Box.new(Gtk.Orientation.VERTICAL, 5)
-    list_box.append(session_list)
-    list_box.append(list_box_label(""))
-    # session_list.set_vexpand(True)
+    session_list = Gtk.ListView()
     scroll = Gtk.ScrolledWindow()
-    scroll.set_child(list_box)
+    scroll.set_child(session_list)
     scroll.set_vexpand(True)
     session_overlay.set_child(scroll)
 
     ctrl = Gtk.Box.new(Gtk.Orientation.VERTICAL, 0)
+    ctrl.append(source)
     ctrl.append(search_bar)
     ctrl.append(session_overlay)
 
@@ -436,7 +768,7 @@ def session_pane(iface):
     new_group_button.set_property("halign", Gtk.Align.CENTER)
     new_group_button.set_property("valign", Gtk.Align.END)
     new_group_button.set_margin_bottom(5)
-    session_list.set_margin_bottom(new_group_button.get_height() + 10)
+    scroll.set_margin_bottom(40)
 
     info = Gtk.Box.new(Gtk.Orientation.VERTICAL, 5)
     info.set_margin_start(5)
@@ -460,21 +792,31 @@ def session_pane(iface):
 
     snaps_overlay = Gtk.Overlay()
     new_snapshot_button = icon_button("list-add-symbolic")
-    new_snapshot_button.set_property("halign", Gtk.Align.CENTER)
-    new_snapshot_button.set_property("valign", Gtk.Align.END)
-    new_snapshot_button.set_margin_bottom(5)
+    compare_button = Gtk.ToggleButton()
+    compare_button.set_icon_name("view-dual-symbolic")
+    compare_button.set_tooltip_text("Compare snapshots with the current state")
+    setlist_button = icon_button("media-playlist-consecutive-symbolic")
+    setlist_button.set_tooltip_text("Play the snapshots of this group as setlist")
+    generate_button = icon_button("media-playlist-shuffle-symbolic")
+    generate_button.set_tooltip_text("Generate variations of the current state in a new group")
+    snaps_buttons = Gtk.Box.new(Gtk.Orientation.HORIZONTAL, 5)
+    snaps_buttons.append(new_snapshot_button)
+    snaps_buttons.append(compare_button)
+    snaps_buttons.append(setlist_button)
+    snaps_buttons.append(generate_button)
+    snaps_buttons.set_property("halign", Gtk.Align.CENTER)
+    snaps_buttons.set_property("valign", Gtk.Align.END)
+    snaps_buttons.set_margin_bottom(5)
     snaps_frame = Gtk.Frame()
     snaps_frame.set_label("Snapshots")
     snaps_scroll = Gtk.ScrolledWindow()
-    snaps = Gtk.ListBox()
-    snaps_box = Gtk.Box.new(Gtk.Orientation.VERTICAL, 0)
-    snaps_box.append(snaps)
-    snaps_box.append(list_box_label(""))
-    snaps_scroll.set_child(snaps_box)
+    snaps = Gtk.ListView()
+    snaps_scroll.set_child(snaps)
+    snaps_scroll.set_margin_bottom(40)
     snaps_frame.set_child(snaps_overlay)
     snaps_frame.set_vexpand(True)
     snaps_overlay.set_child(snaps_scroll)
-    snaps_overlay.add_overlay(new_snapshot_button)
+    snaps_overlay.add_overlay(snaps_buttons)
     info.append(snaps_frame)
     info.set_sensitive(False)
 
@@ -485,6 +827,7 @@ def session_pane(iface):
 
     pane = SessionPane(
         iface=iface,
+        source=source,
         search_entry=search_bar,
         session_list=session_list,
         add_session_button=new_group_button,
@@ -492,7 +835,10 @@ def session_pane(iface):
         name=title,
         description=descr,
         snapshot_list=snaps,
-        add_snapshot_button=new_snapshot_button)
+        add_snapshot_button=new_snapshot_button,
+        compare_button=compare_button,
+        setlist_button=setlist_button,
+        generate_button=generate_button)
 
     return vbox, pane
 
@@ -509,12 +855,47 @@ def on_activate(app, iface):
     header_bar.set_show_title_buttons(True)
     side_bar_button = Gtk.Button()
     win.set_titlebar(header_bar)
+
+    setlist_bar, setlist_buttons = tool_bar(
+        previous="go-previous-symbolic", next="go-next-symbolic")
+    setlist_label = Gtk.Label()
+    setlist_bar.insert_child_after(setlist_label, setlist_buttons["previous"])
+    setlist_buttons["previous"].connect("clicked", lambda _: iface.engine.setlist_step(-1))
+    setlist_buttons["next"].connect("clicked", lambda _: iface.engine.setlist_step(1))
+    header_bar.pack_start(setlist_bar)
+
+    def show_setlist(position):
+        setlist_bar.set_visible(iface.setlist_length > 0)
+        number = "-" if position is None else str(position + 1)
+        setlist_label.set_label(f"{iface.setlist_name}: {number}/{iface.setlist_length}")
+
+    iface.set_setlist_position = show_setlist
+    show_setlist(None)
+
+    device_label = Gtk.Label()
+    header_bar.pack_end(device_label)
+
+    def show_device(connected, sync_time=None):
+        if not connected:
+            device_label.set_label("Nymphes not connected")
+        elif sync_time is not None:
+            device_label.set_label(f"Nymphes synced in {sync_time * 1e3:.0f} ms")
+        else:
+            device_label.set_label("")
+
+    iface.set_device_status = show_device
+    show_device(iface.engine.connected)
     grid = Gtk.Grid()
     grid.add_css_class("mod-baseline")
     controls = {}
-
-    def set_ui_value(ctrl, mod, value):
-        if mod != controls["modulators.selector"].get_selected_row().get_index():
+    # (name, widget) of every modulated setting, filled once the widgets exist
+    modulated: list[tuple[str, Gtk.Widget]] = []
+    layer = 0
+    layer_class = "mod-baseline"
+
+    def set_ui_value(ctrl, mod, value, token=None):
+        tracer.stamp(token, "idle")
+        if mod != layer:
             return
         if ctrl not in controls:
             logging.warn("no widget to control %s", ctrl)
@@ -528,43 +909,79 @@ def on_activate(app, iface):
             case Gtk.ListBox():
                 w = controls[ctrl]
                 w.select_row(w.get_row_at_index(value))
+        tracer.finish(token, "widget")
 
     iface.set_ui_value = set_ui_value
 
-    def write_output_queue(ctrl, value):
+    def write_output_queue(ctrl, value, token=None):
         mod = controls["modulators.selector"].get_selected_row().get_index()
         if iface.register.flat_config[ctrl].mod is None:
             mod = 0
         if iface.register.gui_msg(ctrl, mod, value):
-            iface.q_out.put_nowait((ctrl, mod, value))
+            tracer.stamp(token, "enqueue")
+            iface.engine.send(ctrl, mod, value, token)
 
     def on_changed(widget, *args):
+        token = tracer.start("on_changed")
         match widget:
             case Gtk.ComboBoxText():
                 (ctrl,) = args
-                write_output_queue(ctrl, widget.get_active())
+                write_output_queue(ctrl, widget.get_active(), token)
             case Gtk.Scale():
                 (ctrl,) = args
-                write_output_queue(ctrl, int(widget.get_value()))
+                write_output_queue(ctrl, int(widget.get_value()), token)
             case Gtk.ListBox():
                 row, ctrl = args
-                write_output_queue(ctrl, row.get_index())
+                write_output_queue(ctrl, row.get_index(), token)
 
     def on_mod_change(widget, row):
-        value = row.get_child().get_label().lower().replace(" ", "-")
+        """Show another modulator layer. Only widgets whose value differs
+        between the layers are updated, with their change handlers
+        blocked, so that no messages are sent besides the selector."""
+        nonlocal layer, layer_class
         index = row.get_index()
-        css_classes = [re.sub("mod-.*", f"mod-{value}", c)
-                       for c in grid.get_css_classes()]
-        grid.set_css_classes(css_classes)
-        for name, setting in iface.register.flat_config.items():
-            if setting.mod is not None:
-                widget = controls[name]
-                match widget:
-                    case Gtk.Scale():
-                        widget.set_value(iface.register.values[index][name])
-                    case Gtk.ComboBox():
-                        widget.set_active(iface.register.values[index][name])
-        iface.q_out.put_nowait(("modulators.selector", None, row.get_index()))
+        new_class = "mod-" + row.get_child().get_label().lower().replace(" ", "-")
+        grid.remove_css_class(layer_class)
+        grid.add_css_class(new_class)
+        old_values = iface.register.values[layer]
+        new_values = iface.register.values[index]
+        layer, layer_class = index, new_class
+        for name, widget in modulated:
+            value = new_values[name]
+            if value == old_values[name]:
+                continue
+            widget.handler_block_by_func(on_changed)
+            match widget:
+                case Gtk.Scale():
+                    widget.set_value(value)
+                case Gtk.ComboBox():
+                    widget.set_active(value)
+            widget.handler_unblock_by_func(on_changed)
+        highlight_changes()
+        iface.engine.send("modulators.selector", None, index)
+
+    # Settings that differ from the snapshot being compared, as (mod, ctrl),
+    # and the names of the widgets that are highlighted.
+    changed: set[tuple[int, str]] = set()
+    highlighted: set[str] = set()
+
+    def highlight_changes():
+        if not changed and not highlighted:
+            return
+        names = { name for mod, name in changed
+                  if mod == (0 if iface.register.flat_config[name].mod is None else layer)
+                  and name in controls }
+        for name in highlighted - names:
+            controls[name].remove_css_class("changed")
+        for name in names - highlighted:
+            controls[name].add_css_class("changed")
+        highlighted.clear()
+        highlighted.update(names)
+
+    def show_diff(diff):
+        changed.clear()
+        changed.update((mod, ctrl) for mod, ctrl, _, _ in diff or [])
+        highlight_changes()
 
     settings = read_settings()
     layout = [("oscillator", 0, 0, 5, 1), 
@@ -588,6 +1005,9 @@ def on_activate(app, iface):
     mode_controls["misc.mode"].connect("row-selected", on_changed, "misc.mode")
     mode_controls["modulators.selector"].connect("row-selected", on_mod_change)
     controls.update(mode_controls)
+    modulated.extend((name, controls[name])
+                     for name, setting in iface.register.flat_config.items()
+                     if setting.mod is not None)
     grid.attach(mode_box, 8, 0, 2, 1)
     grid.set_margin_top(5)
     grid.set_margin_bottom(5)
@@ -598,7 +1018,8 @@ def on_activate(app, iface):
         for ctrl, value in v.items():
             set_ui_value(ctrl, mod, value)
 
-    side, _ = session_pane(iface)
+    side, pane = session_pane(iface)
+    pane.show_diff = show_diff
 
     scrolled_main = Gtk.ScrolledWindow()
     scrolled_main.set_child(grid)
@@ -615,7 +1036,7 @@ def spawn(iface: Interface):
     app = Gtk.Application(application_id='org.nymphescc')
 
     def stop_threads(_):
-        iface.quit_event.set()
+        iface.stop()
 
     app.connect('activate', on_activate, iface)
     app.connect('shutdown', stop_threads)
@@ -623,11 +1044,96 @@ def spawn(iface: Interface):
 
 
 def main():
+    parser = argparse.ArgumentParser(prog="nymphescc")
+    parser.add_argument(
+        "--resend-state", action="store_true",
+        help="send the restored state to the Nymphes on startup")
+    parser.add_argument(
+        "--autosave-interval", type=float, default=AUTOSAVE_INTERVAL,
+        help="seconds between saves of the live state (default: %(default)s)")
+    parser.add_argument(
+        "--simulate", action="store_true",
+        help="run against a simulated Nymphes instead of the ALSA device")
+    parser.add_argument(
+        "--engine-process", action="store_true",
+        help="run the MIDI engine in a separate process")
+    parser.add_argument(
+        "--setlist", metavar="NAME", help="load this setlist on startup")
+    parser.add_argument(
+        "--setlist-cc", type=int, nargs=2, metavar=("NEXT", "PREV"), default=(),
+        help="CC numbers on the through port that step through the setlist")
+    parser.add_argument(
+        "--sequence", metavar="NAME", help="play this sequence when MIDI clock starts")
+    parser.add_argument(
+        "--clock-port", choices=("through", "device"), default="through",
+        help="port on which to follow MIDI clock (default: %(default)s)")
+    parser.add_argument(
+        "--library", type=Path, action="append", default=[], metavar="FILE",
+        help="mount a patch library in the session pane (may be repeated)")
+    parser.add_argument(
+        "--metrics-file", type=Path,
+        help="periodically write metrics to this file, in Prometheus text format")
+    parser.add_argument(
+        "--metrics-port", type=int,
+        help="serve metrics over HTTP on this port, at /metrics")
+    parser.add_argument(
+        "--metrics-interval", type=float, default=10.0,
+        help="seconds between writes of the metrics file (default: %(default)s)")
+    parser.add_argument(
+        "--watchdog", type=float, metavar="MS",
+        help="report stalls of the main loop longer than this many milliseconds")
+    parser.add_argument(
+        "--trace", action="store_true",
+        help="trace message latencies; send SIGUSR1 to print statistics")
+    args = parser.parse_args()
+
+    if args.trace:
+        tracer.enable()
+
+        def dump_trace():
+            logging.info("latency:\n%s", tracer.dump())
+            return GLib.SOURCE_CONTINUE
+        GLib.unix_signal_add(GLib.PRIORITY_DEFAULT, signal.SIGUSR1, dump_trace)
+
     logging.getLogger().setLevel(logging.DEBUG)
-    iface = Interface()
+    plan = Register.new().plan
+    try:
+        libraries = [Library(path, plan) for path in args.library]
+    except LibraryError as e:
+        parser.error(f"can't mount library {e.path}: {e.what}")
+    except OSError as e:
+        parser.error(f"can't mount library: {e}")
+    iface = Interface(resend_state=args.resend_state, simulate=args.simulate,
+                      engine_process=args.engine_process, setlist_cc=tuple(args.setlist_cc),
+                      libraries=libraries, clock_port=args.clock_port)
+    if args.setlist is not None:
+        setlist_id = iface.db.setlist_id(args.setlist)
+        if setlist_id is None:
+            parser.error(f"unknown setlist '{args.setlist}'")
+        iface.load_setlist(setlist_id, args.setlist)
+    if args.sequence is not None:
+        sequence_id = iface.db.sequence_id(args.sequence)
+        if sequence_id is None:
+            parser.error(f"unknown sequence '{args.sequence}'")
+        iface.load_sequence(sequence_id)
     # Thread(target=spawn, args=(iface,)).start()
-    Thread(target=iface.send_nymphes).start()
-    Thread(target=iface.read_nymphes).start()
+    iface.engine.start()
+    Thread(target=iface.autosave, args=(args.autosave_interval,)).start()
+    Thread(target=iface.index).start()
+    if args.metrics_file is not None:
+        Thread(target=metrics.write_periodically, args=(
+            registry, args.metrics_file, args.metrics_interval, iface.quit_event)).start()
+    if args.metrics_port is not None:
+        metrics.serve(registry, args.metrics_port)
+    if args.watchdog is not None:
+        watchdog = Watchdog(threshold=args.watchdog / 1000)
+        GLib.timeout_add(int(watchdog.interval * 1000), watchdog.beat,
+                         priority=GLib.PRIORITY_DEFAULT_IDLE)
+        Thread(target=watchdog.run, args=(iface.quit_event,)).start()
     spawn(iface)
+    if args.watchdog is not None:
+        logging.info("main loop stalls:\n%s", watchdog.dump())
+    if args.trace:
+        logging.info("latency:\n%s", tracer.dump())
 
 # ~\~ end
@@ -0,0 +1,247 @@
+# ~\~ language=Python filename=nymphescc/library.py
+# ~\~ begin <<lit/library.md|nymphescc/library.py>>[0]
+from __future__ import annotations
+import argparse
+import bisect
+from dataclasses import dataclass
+import hashlib
+import mmap
+import os
+from pathlib import Path
+import struct
+from typing import Iterable, Optional
+
+import numpy as np
+
+from .core import Register, TransmitPlan
+from .compare import Comparator
+from .db import NymphesDB, Condition
+
+
+MAGIC = b"NYMPHLIB"
+VERSION = 1
+
+# magic, version, slots, groups, patches, layout hash,
+# offsets of the group table, patch table, name index, states and strings
+HEADER = struct.Struct("<8sIIII16s5Q")
+GROUP = np.dtype([("name", "<u4"), ("name_length", "<u4"),
+                  ("first", "<u4"), ("count", "<u4")])
+PATCH = np.dtype([("name", "<u4"), ("name_length", "<u4"),
+                  ("group", "<u4"), ("snapshot", "<u4"), ("timestamp", "<f8")])
+ALIGN = 64
+
+
+@dataclass
+class LibraryError(Exception):
+    path: Path
+    what: str
+
+
+def layout_hash(plan: TransmitPlan) -> bytes:
+    """Identifies the slots of a state vector, so that we don't read a
+    library written for other settings."""
+    layout = "\n".join(f"{mod} {ctrl}" for mod, ctrl in plan.slots)
+    return hashlib.blake2b(layout.encode(), digest_size=16).digest()
+
+
+def _align(n: int) -> int:
+    return -(-n // ALIGN) * ALIGN
+
+
+class Library:
+    """Read-only patch library, memory mapped.
+
+    Nothing is parsed when opening a library: the tables are numpy views
+    of the mapped file, so only the pages that are used are read.
+    """
+    def __init__(self, path: Path, plan: TransmitPlan):
+        self.path = path
+        self.plan = plan
+        with open(path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            magic, version, n_slots, n_groups, n_patches, layout, \
+                groups, patches, index, states, strings = self._header()
+        except LibraryError:
+            self._mmap.close()
+            raise
+        self.name = path.stem
+        self.groups = np.frombuffer(self._mmap, GROUP, n_groups, groups)
+        self.patches = np.frombuffer(self._mmap, PATCH, n_patches, patches)
+        self.name_index = np.frombuffer(self._mmap, "<u4", n_patches, index)
+        self.states = np.frombuffer(self._mmap, np.uint8, n_patches * n_slots, states) \
+                        .reshape(n_patches, n_slots)
+        self._strings = strings
+
+    def _header(self):
+        if len(self._mmap) < HEADER.size:
+            raise LibraryError(self.path, "file too short")
+        header = HEADER.unpack_from(self._mmap)
+        magic, version, n_slots, _, _, layout, *_ = header
+        if magic != MAGIC:
+            raise LibraryError(self.path, "not a patch library")
+        if version != VERSION:
+            raise LibraryError(self.path, f"unsupported version {version}")
+        if n_slots != len(self.plan.slots) or layout != layout_hash(self.plan):
+            raise LibraryError(self.path, "library was written for different settings")
+        return header
+
+    def __len__(self):
+        return len(self.patches)
+
+    def _string(self, offset: int, length: int) -> str:
+        start = self._strings + offset
+        return self._mmap[start:start + length].decode()
+
+    def group_name(self, group: int) -> str:
+        g = self.groups[group]
+        return self._string(g["name"], g["name_length"])
+
+    def group_patches(self, group: int) -> range:
+        g = self.groups[group]
+        return range(g["first"], g["first"] + g["count"])
+
+    def patch_name(self, patch: int) -> str:
+        p = self.patches[patch]
+        return self._string(p["name"], p["name_length"])
+
+    def state(self, patch: int) -> bytes:
+        return self.states[patch].tobytes()
+
+    def midi(self, patch: int) -> bytes:
+        return self.plan.encode_state(self.states[patch])
+
+    def search(self, prefix: str) -> list[int]:
+        """Patches of which the name starts with `prefix` (ignoring case),
+        in order of name. A binary search in the name index."""
+        prefix = prefix.casefold()
+        key = lambda i: self.patch_name(i).casefold()
+        start = bisect.bisect_left(self.name_index, prefix, key=key)
+        result = []
+        for i in self.name_index[start:]:
+            if not key(i).startswith(prefix):
+                break
+            result.append(int(i))
+        return result
+
+    def find(self, conditions: Iterable[Condition]) -> list[int]:
+        """Patches that satisfy every condition."""
+        mask = np.ones(len(self), dtype=bool)
+        for c in conditions:
+            column = self.states[:, self.plan.index[c.mod, c.name]]
+            mask &= (column >= c.low) & (column <= c.high)
+        return np.flatnonzero(mask).tolist()
+
+    def close(self):
+        # the views must be gone before the map can be closed
+        del self.groups, self.patches, self.name_index, self.states
+        self._mmap.close()
+
+
+def patch_name(tags: Optional[str], timestamp) -> str:
+    return tags or timestamp.strftime("%Y-%m-%d %H:%M:%S")
+
+
+def build_library(db: NymphesDB, register: Register, path: Path,
+                  page_size: int = 1000) -> int:
+    """Write all snapshots in `db` to a library at `path`, in a single pass
+    over the database. Returns the number of patches."""
+    comparator = Comparator(register)
+    plan = register.plan
+    strings = bytearray()
+    # rows of the group and patch tables
+    groups: list[tuple[int, int, int, int]] = []
+    patches: list[tuple[int, int, int, int, float]] = []
+    names: list[str] = []
+
+    def add_string(s: str) -> tuple[int, int]:
+        data = s.encode()
+        strings.extend(data)
+        return len(strings) - len(data), len(data)
+
+    tmp_path = path.with_name(path.name + ".tmp")
+    with open(tmp_path, "wb") as f:
+        states_offset = _align(HEADER.size)
+        f.write(bytes(states_offset))
+        for group_index, info in enumerate(db.groups()):
+            first = len(patches)
+            offset = 0
+            while page := db.snapshots_page(info.key, offset, page_size):
+                f.write(comparator.states([s.midi for s in page]).tobytes())
+                for s in page:
+                    name = patch_name(s.tags, s.timestamp)
+                    names.append(name.casefold())
+                    patches.append((*add_string(name), group_index, s.key,
+                                    s.timestamp.timestamp()))
+                offset += len(page)
+            groups.append((*add_string(info.name), first, len(patches) - first))
+
+        def write_table(data: bytes) -> int:
+            offset = _align(f.tell())
+            f.write(bytes(offset - f.tell()))
+            f.write(data)
+            return offset
+
+        index = sorted(range(len(names)), key=names.__getitem__)
+        groups_offset = write_table(np.array(groups, dtype=GROUP).tobytes())
+        patches_offset = write_table(np.array(patches, dtype=PATCH).tobytes())
+        index_offset = write_table(np.array(index, dtype="<u4").tobytes())
+        strings_offset = write_table(bytes(strings))
+        f.seek(0)
+        f.write(HEADER.pack(
+            MAGIC, VERSION, len(plan.slots), len(groups), len(patches), layout_hash(plan),
+            groups_offset, patches_offset, index_offset, states_offset, strings_offset))
+    os.replace(tmp_path, path)
+    return len(patches)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog="python -m nymphescc.library",
+        description="Build a patch library from a patch database.")
+    parser.add_argument("output", type=Path, help="library file to write")
+    parser.add_argument(
+        "--db", type=Path, help="patch database (default: the user's database)")
+    args = parser.parse_args()
+    n = build_library(NymphesDB(args.db), Register.new(), args.output)
+    print(f"wrote {n} patches to {args.output}")
+
+
+def test_library(tmp_path: Path):
+    import pytest
+    register = Register.new()
+    db = NymphesDB(tmp_path / "test.db")
+    patches: list[Register] = []
+    for group, cuts in (("bass", (10, 20, 30)), ("lead", (40, 50))):
+        group_id = db.new_group(group)
+        for i, cut in enumerate(cuts):
+            patch = Register.new()
+            patch.write("filter.cut", 0, cut)
+            patch.write("reverb.mix", 2, cut + 1)
+            db.new_snapshot(group_id, patch.snapshot().midi(), f"{group} {i}")
+            patches.append(patch)
+
+    path = tmp_path / "test.nymphlib"
+    assert build_library(db, register, path, page_size=2) == 5
+    library = Library(path, register.plan)
+    try:
+        assert len(library) == 5
+        assert [library.group_name(g) for g in range(2)] == ["bass", "lead"]
+        assert list(library.group_patches(1)) == [3, 4]
+        assert library.patch_name(4) == "lead 1"
+        assert library.midi(1) == patches[1].snapshot().midi()
+        assert library.search("LEAD") == [3, 4]
+        assert library.search("bass 2") == [2]
+        assert library.search("x") == []
+        assert library.find([Condition("filter.cut", low=25),
+                             Condition("reverb.mix", high=45, mod=2)]) == [2, 3]
+    finally:
+        library.close()
+
+    with pytest.raises(LibraryError):
+        Library(tmp_path / "test.db", register.plan)
+
+
+if __name__ == "__main__":
+    main()
+# ~\~ end
@@ -0,0 +1,349 @@
+# ~\~ language=Python filename=nymphescc/maintenance.py
+# ~\~ begin <<lit/maintenance.md|nymphescc/maintenance.py>>[0]
+from __future__ import annotations
+import argparse
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from dataclasses import dataclass
+import itertools
+import os
+from pathlib import Path
+import sqlite3
+import time
+from typing import Callable, Optional
+
+import numpy as np
+
+from .core import Register, BytesPort
+from .compare import Comparator
+from .db import db_schema, default_path
+
+
+# Number of snapshot ids in a chunk of work.
+CHUNK_SIZE = 1000
+
+Rows = list[tuple[int, bytes]]
+
+
+@dataclass
+class Job:
+    """A maintenance job over all snapshots.
+
+    Attributes:
+        description: shown in the command-line help.
+        work: runs in a worker process on the (id, midi) rows of one chunk.
+        write: stores the result of `work` for the ids in [start, stop). It
+            runs in the transaction that also marks the chunk as done.
+    """
+    description: str
+    work: Callable[[Register, Rows], list]
+    write: Callable[[sqlite3.Connection, int, int, list], None]
+
+
+@dataclass
+class Progress:
+    job: str
+    chunks_done: int
+    chunks: int
+    snapshots: int = 0
+    elapsed: float = 0.0
+
+    @property
+    def throughput(self) -> float:
+        """Snapshots per second, in this run."""
+        return self.snapshots / self.elapsed if self.elapsed > 0 else 0.0
+
+    def __str__(self):
+        return f"{self.job}: {self.chunks_done}/{self.chunks} chunks, " \
+               f"{self.snapshots} snapshots, {self.throughput:.0f} snapshots/s"
+
+
+def split(register: Register, rows: Rows) -> tuple[Rows, np.ndarray, Rows]:
+    """Separate the snapshots that have the layout of the transmit plan,
+    which are read as state vectors in one go, from the others, which have
+    to be decoded message by message. Returns the first rows with their
+    states, and the other rows."""
+    comparator = Comparator(register)
+    full = comparator.full([midi for _, midi in rows]).tolist()
+    full_rows = [row for row, f in zip(rows, full) if f]
+    other_rows = [row for row, f in zip(rows, full) if not f]
+    return full_rows, comparator.states([midi for _, midi in full_rows]), other_rows
+
+
+def reencode(register: Register, rows: Rows) -> list:
+    """Rewrite snapshots in the layout of the transmit plan. Snapshots that
+    contain every setting become a full buffer as written by `send_all`;
+    others keep only the settings they contain, in plan order. Unknown
+    and redundant messages are dropped."""
+    plan = register.plan
+    updates = []
+    for snap_id, midi in split(register, rows)[2]:
+        values = {}
+        for mod, ctrl, value in register.decode(midi):
+            i = plan.index.get((mod, ctrl))
+            if i is not None:
+                values[i] = value
+        if len(values) == len(plan.slots):
+            new = plan.encode_state(bytes(values[i] for i in range(len(plan.slots))))
+        else:
+            new, _ = plan.encode_slots(sorted(values.items()))
+        if new != midi:
+            updates.append((new, snap_id))
+    return updates
+
+
+def write_reencoded(connection: sqlite3.Connection, start: int, stop: int, updates: list):
+    connection.executemany("""
+        update "snapshots" set "midi" = ? where "id" = ?""", updates)
+
+
+def index(register: Register, rows: Rows) -> list:
+    full_rows, states, other_rows = split(register, rows)
+    slots = register.plan.slots
+    return [(snap_id, mod, name, value)
+            for (snap_id, _), state in zip(full_rows, states.tolist())
+            for (mod, name), value in zip(slots, state)] + \
+           [(snap_id, mod, name, value)
+            for snap_id, midi in other_rows
+            for mod, name, value in register.decode(midi)]
+
+
+def write_index(connection: sqlite3.Connection, start: int, stop: int, parameters: list):
+    connection.execute("""
+        delete from "parameters" where "snapshot" >= ? and "snapshot" < ?""",
+        (start, stop))
+    connection.executemany("""
+        insert or replace into "parameters" ("snapshot", "mod", "name", "value")
+        values (?, ?, ?, ?)""", parameters)
+
+
+def validate(register: Register, rows: Rows) -> list:
+    """Check every message against the bounds in `messages.dhall`."""
+    full_rows, states, other_rows = split(register, rows)
+    slots = register.plan.slots
+    bounds = [register.flat_config[ctrl].bounds for _, ctrl in slots]
+    lower = np.array([b.lower for b in bounds])
+    upper = np.array([b.upper for b in bounds])
+    problems = [(full_rows[r][0], f"{slots[i][1]}: value {states[r, i]} out of bounds")
+                for r, i in np.argwhere((states < lower) | (states > upper)).tolist()]
+    for snap_id, midi in other_rows:
+        for _, param, value in BytesPort(midi).read_cc(None):
+            if param not in register.midi_map:
+                problems.append((snap_id, f"unknown control change {param}"))
+                continue
+            _, ctrl = register.midi_map[param]
+            if not register.flat_config[ctrl].accepts(value):
+                problems.append((snap_id, f"{ctrl}: value {value} out of bounds"))
+    return problems
+
+
+def write_problems(connection: sqlite3.Connection, start: int, stop: int, problems: list):
+    connection.execute("""
+        delete from "snapshot_problems" where "snapshot" >= ? and "snapshot" < ?""",
+        (start, stop))
+    connection.executemany("""
+        insert into "snapshot_problems" ("snapshot", "problem")
+        values (?, ?)""", problems)
+
+
+JOBS = {
+    "reencode": Job("rewrite snapshots in the layout of the transmit plan",
+                    reencode, write_reencoded),
+    "index": Job("rebuild the parameter index", index, write_index),
+    "validate": Job("check snapshots against the bounds of each setting",
+                    validate, write_problems) }
+
+# Jobs that SQLite runs on the whole database, in the writer.
+STATEMENTS = {
+    "vacuum": "vacuum",
+    "analyze": "analyze" }
+
+
+_worker: Optional[tuple[Register, sqlite3.Connection]] = None
+
+
+def _init_worker(path: Path):
+    global _worker
+    connection = sqlite3.connect(path.resolve().as_uri() + "?mode=ro", uri=True)
+    _worker = (Register.new(), connection)
+
+
+def _work(job: str, start: int, stop: int) -> tuple[int, int, int, list]:
+    assert _worker is not None
+    register, connection = _worker
+    rows = connection.execute("""
+        select "id", "midi" from "snapshots"
+        where "id" >= ? and "id" < ? order by "id"
+        """, (start, stop)).fetchall()
+    return start, stop, len(rows), JOBS[job].work(register, rows)
+
+
+def chunks(connection: sqlite3.Connection, job: str,
+           chunk_size: int) -> tuple[list[tuple[int, int]], int]:
+    """Split the snapshot ids into ranges. Returns the ranges that were
+    not yet done by an earlier, interrupted run, and the total number of
+    ranges. Ranges are aligned to `chunk_size`, so they stay the same when
+    snapshots are added or deleted in between."""
+    first, last = connection.execute("""
+        select min("id"), max("id") from "snapshots" """).fetchone()
+    if first is None:
+        return [], 0
+    ranges = [(k * chunk_size, (k + 1) * chunk_size)
+              for k in range(first // chunk_size, last // chunk_size + 1)]
+    done = connection.execute("""
+        select "start", "stop" from "maintenance_progress" where "job" = ?
+        """, (job,)).fetchall()
+    todo = [(start, stop) for start, stop in ranges
+            if not any(a <= start and stop <= b for a, b in done)]
+    return todo, len(ranges)
+
+
+def run_job(path: Path, job: str, workers: Optional[int] = None,
+            chunk_size: int = CHUNK_SIZE, resume: bool = True,
+            on_progress: Optional[Callable[[Progress], None]] = None) -> Progress:
+    """Run a maintenance job on the database at `path`.
+
+    Chunks of snapshots are processed by a pool of `workers` processes
+    (default: one per core), each with its own read-only connection. The
+    results are written by this process only, one transaction per chunk,
+    which also records the chunk as done. If the job is interrupted, the
+    next run with `resume` skips the chunks that were done. Other
+    connections (like the GUI) can keep using the database meanwhile.
+    """
+    workers = workers or os.cpu_count() or 1
+    connection = sqlite3.connect(path)
+    connection.executescript(db_schema)
+    t0 = time.perf_counter()
+    try:
+        if job in STATEMENTS:
+            connection.execute(STATEMENTS[job])
+            progress = Progress(job, 1, 1, elapsed=time.perf_counter() - t0)
+            if on_progress is not None:
+                on_progress(progress)
+            return progress
+
+        write = JOBS[job].write
+        if not resume:
+            with connection:
+                connection.execute("""
+                    delete from "maintenance_progress" where "job" = ?""", (job,))
+        todo, total = chunks(connection, job, chunk_size)
+        progress = Progress(job, total - len(todo), total)
+        pending = iter(todo)
+        running: set = set()
+        with ProcessPoolExecutor(workers, initializer=_init_worker,
+                                 initargs=(path,)) as pool:
+            try:
+                while True:
+                    # keep every worker busy, but don't queue up results
+                    for chunk in itertools.islice(pending, 2 * workers - len(running)):
+                        running.add(pool.submit(_work, job, *chunk))
+                    if not running:
+                        break
+                    finished, running = wait(running, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        start, stop, count, result = future.result()
+                        with connection:
+                            write(connection, start, stop, result)
+                            connection.execute("""
+                                insert or replace into "maintenance_progress"
+                                ("job", "start", "stop") values (?, ?, ?)""",
+                                (job, start, stop))
+                        progress.chunks_done += 1
+                        progress.snapshots += count
+                        progress.elapsed = time.perf_counter() - t0
+                        if on_progress is not None:
+                            on_progress(progress)
+            except BaseException:
+                pool.shutdown(cancel_futures=True)
+                raise
+
+        with connection:
+            connection.execute("""
+                delete from "maintenance_progress" where "job" = ?""", (job,))
+        return progress
+    finally:
+        connection.close()
+
+
+def main():
+    jobs = JOBS.keys() | STATEMENTS.keys()
+    parser = argparse.ArgumentParser(
+        prog="python -m nymphescc.maintenance",
+        description="Run maintenance jobs on the patch database.",
+        epilog="jobs: " + "; ".join(
+            [f"{name}: {job.description}" for name, job in JOBS.items()] +
+            [f"{name}: {statement} the database" for name, statement in STATEMENTS.items()]))
+    parser.add_argument("jobs", nargs="+", metavar="JOB", help="jobs to run, in order")
+    parser.add_argument(
+        "--db", type=Path, default=default_path(),
+        help="patch database (default: the user's database)")
+    parser.add_argument(
+        "-j", "--workers", type=int, help="number of worker processes (default: one per core)")
+    parser.add_argument(
+        "--chunk-size", type=int, default=CHUNK_SIZE,
+        help="snapshot ids per chunk of work (default: %(default)s)")
+    parser.add_argument(
+        "--restart", action="store_true",
+        help="start over instead of resuming an interrupted job")
+    args = parser.parse_args()
+    for job in args.jobs:
+        if job not in jobs:
+            parser.error(f"unknown job '{job}'")
+
+    for job in args.jobs:
+        progress = run_job(args.db, job, args.workers, args.chunk_size, not args.restart,
+                           on_progress=lambda p: print(p, end="\r", flush=True))
+        print(progress)
+
+
+def test_maintenance(tmp_path: Path):
+    import pytest
+    from .db import NymphesDB, Condition
+    register = Register.new()
+    path = tmp_path / "test.db"
+    db = NymphesDB(path)
+    group_id = db.new_group("test")
+    full = register.snapshot().midi()
+    port = BytesPort()
+    register.send_cc(port, "reverb.mix", 2, 100)
+    register.send_cc(port, "filter.cut", 0, 10)
+    partial = bytes(port.bytes)
+    db.new_snapshots(group_id, [full, partial] * 5)
+    bad = db.new_snapshot(group_id, bytes((0xb0, 22, 99, 0xb0, 127, 1)))
+    state = bytearray(register.snapshot().state)
+    state[register.plan.index[0, "misc.legato"]] = 2
+    bad_full = db.new_snapshot(group_id, register.plan.encode_state(state))
+
+    # interrupt after two chunks, then resume
+    def interrupt(progress):
+        if progress.chunks_done == 2:
+            raise KeyboardInterrupt
+    with pytest.raises(KeyboardInterrupt):
+        run_job(path, "index", workers=2, chunk_size=3, on_progress=interrupt)
+    seen = []
+    progress = run_job(path, "index", workers=2, chunk_size=3,
+                       on_progress=lambda p: seen.append(p.chunks_done))
+    assert progress.chunks == 5
+    assert seen == [3, 4, 5]
+    assert db.find_snapshots([Condition.equal("reverb.mix", 100, mod=2)]) == \
+        list(range(2, 11, 2))
+    assert db.find_snapshots([Condition.equal("misc.legato", 2)]) == [bad_full]
+
+    assert run_job(path, "validate", workers=2).snapshots == 12
+    assert db.snapshot_problems() == \
+        [(bad, "lfo.lfo-1.type: value 99 out of bounds"), (bad, "unknown control change 127"),
+         (bad_full, "misc.legato: value 2 out of bounds")]
+
+    run_job(path, "reencode", workers=2)
+    assert db.snapshot(1).midi == full
+    # the selector comes first now, in plan order
+    assert db.snapshot(2).midi == partial[6:] + partial[:6]
+    assert db.snapshot(bad).midi == bytes((0xb0, 22, 99))
+    for job in STATEMENTS:
+        run_job(path, job)
+    db.close()
+
+
+if __name__ == "__main__":
+    main()
+# ~\~ end
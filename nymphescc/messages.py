@@ -4,9 +4,9 @@ from __future__ import annotations
 from importlib import resources
 import dhall
 from pathlib import Path
-from dataclasses import dataclass, is_dataclass
+from dataclasses import dataclass, fields, is_dataclass
 import typing
-from typing import Optional, Union
+from typing import Any, Callable, Optional, Union
 import types
 
 
@@ -69,6 +69,9 @@ class Setting:
         and len(self.labels) != (self.bounds.upper - self.bounds.lower + 1):
             raise ConfigValueError(self, "wrong number of labels")
 
+    def accepts(self, value: int) -> bool:
+        return self.bounds.lower <= value <= self.bounds.upper
+
     def is_scale(self):
         return self.bounds.lower == 0 and self.bounds.upper == 127
 
@@ -92,40 +95,124 @@ class Group:
         return list(filter(Setting.is_enum, self.content))
 
 
-def isgeneric(annot):
-    return hasattr(annot, "__origin__") \
-        and hasattr(annot, "__args__")
+Builder = Callable[[Any, str], Any]
+_builders: dict[Any, Builder] = {}
 
 
-def construct(annot, json):
-    """Construct an object from a given type from a JSON stream.
+def _parser_error(json, path: str, what: str) -> ConfigParserError:
+    input_str = repr(json)
+    if len(input_str) > 80:
+        input_str = input_str[:77] + "..."
+    return ConfigParserError(input_str, f"{path}: {what}")
 
-    The `annot` type should be one of: str, int, list[T], Optional[T],
-    or a dataclass, and the JSON data should match exactly the given
-    definitions in the dataclass hierarchy.
-    """
-    if annot is str:
-        assert isinstance(json, str)
-        return json
-    if annot is int:
-        assert isinstance(json, int)
+
+def _primitive_builder(annot) -> Builder:
+    accept = (int, float) if annot is float else annot
+    reject = bool if annot is not bool else ()
+
+    def build_primitive(json, path):
+        if not isinstance(json, accept) or isinstance(json, reject):
+            raise _parser_error(json, path, f"expected {annot.__name__}")
         return json
-    if isgeneric(annot) and typing.get_origin(annot) is list:
-        assert isinstance(json, list)
-        return [construct(typing.get_args(annot)[0], item) for item in json]
-    if isgeneric(annot) and typing.get_origin(annot) is Union \
-        and typing.get_args(annot)[1] is types.NoneType:
+    return build_primitive
+
+
+def _list_builder(item: Builder) -> Builder:
+    def build_list(json, path):
+        if not isinstance(json, list):
+            raise _parser_error(json, path, "expected list")
+        return [item(x, f"{path}[{i}]") for i, x in enumerate(json)]
+    return build_list
+
+
+def _dict_builder(item: Builder) -> Builder:
+    def build_dict(json, path):
+        if not isinstance(json, dict):
+            raise _parser_error(json, path, "expected dict")
+        return { k: item(v, f"{path}.{k}") for k, v in json.items() }
+    return build_dict
+
+
+def _optional_builder(item: Builder) -> Builder:
+    def build_optional(json, path):
         if json is None:
             return None
-        else:
-            return construct(typing.get_args(annot)[0], json)
-    if is_dataclass(annot):
-        assert isinstance(json, dict)
-        arg_annot = typing.get_type_hints(annot)
-        assert all(k in json for k in arg_annot)
-        args = { k: construct(v, json[k])
-                 for k, v in arg_annot.items() }
-        return annot(**args)
+        return item(json, path)
+    return build_optional
+
+
+def _dataclass_builder(annot) -> Builder:
+    members: list[tuple[str, Builder]] = []
+    validate = getattr(annot, "validate", None)
+
+    def build_dataclass(json, path):
+        if not isinstance(json, dict):
+            raise _parser_error(json, path, f"expected {annot.__name__}")
+        try:
+            args = { k: build(json[k], f"{path}.{k}") for k, build in members }
+        except KeyError as e:
+            raise _parser_error(json, path, f"missing field '{e.args[0]}'") from None
+        obj = annot(**args)
+        if validate is not None:
+            obj.validate()
+        return obj
+
+    # Register before compiling the members, so that recursive types resolve
+    # to this builder. If compilation fails, drop it again, together with any
+    # builders that were compiled against it in the meantime.
+    known = set(_builders)
+    _builders[annot] = build_dataclass
+    try:
+        hints = typing.get_type_hints(annot)
+        members.extend((f.name, compile_builder(hints[f.name]))
+                       for f in fields(annot) if f.init)
+    except Exception:
+        for key in set(_builders) - known:
+            del _builders[key]
+        raise
+    return build_dataclass
+
+
+def compile_builder(annot) -> Builder:
+    """Compile a function that constructs an object of type `annot` from
+    JSON data. The returned builder takes the JSON data and a path (used in
+    error messages). Builders are cached per type, so all type reflection is
+    done only once.
+    """
+    if annot in _builders:
+        return _builders[annot]
+    origin = typing.get_origin(annot)
+    args = typing.get_args(annot)
+    if annot in (str, int, float, bool):
+        builder = _primitive_builder(annot)
+    elif origin is list:
+        builder = _list_builder(compile_builder(args[0]))
+    elif origin is dict and args[0] is str:
+        builder = _dict_builder(compile_builder(args[1]))
+    elif origin in (Union, types.UnionType) and types.NoneType in args:
+        (item,) = [a for a in args if a is not types.NoneType]
+        builder = _optional_builder(compile_builder(item))
+    elif is_dataclass(annot):
+        return _dataclass_builder(annot)
+    else:
+        raise TypeError(f"cannot construct {annot!r} from JSON")
+    _builders[annot] = builder
+    return builder
+
+
+def construct(annot, json):
+    """Construct an object from a given type from a JSON stream.
+
+    The `annot` type should be one of: str, int, float, bool, list[T],
+    dict[str, T], Optional[T], or a dataclass, and the JSON data should match
+    exactly the given definitions in the dataclass hierarchy. Dataclasses that
+    have a `validate` method are validated after construction.
+
+    Raises:
+        ConfigParserError: if the JSON data does not match `annot`.
+        ConfigValueError: if a constructed object fails validation.
+    """
+    return compile_builder(annot)(json, "$")
 
 
 def read_settings():
@@ -140,6 +227,34 @@ def modulators(settings):
     return ["Baseline"] + labels
 
 
+def test_construct():
+    import pytest
+    from dataclasses import make_dataclass
+    json = { "name": "misc", "long": "Misc", "description": None
+           , "content": [ { "name": "amp", "long": "Amp level", "cc": 7
+                          , "bounds": { "lower": 0, "upper": 127 }
+                          , "description": None, "mod": None, "tics": None
+                          , "labels": None, "flags": None } ] }
+    (group,) = construct(list[Group], [json])
+    assert group.content[0].bounds == Bounds(0, 127)
+    assert construct(list[Group], [json]) == [group]
+
+    json["content"][0]["cc"] = "7"
+    with pytest.raises(ConfigParserError) as e:
+        construct(Group, json)
+    assert e.value.what == "$.content[0].cc: expected int"
+
+    json["content"][0]["cc"] = 7
+    json["content"][0]["labels"] = ["on"]
+    with pytest.raises(ConfigValueError):
+        construct(Group, json)
+
+    Broken = make_dataclass("Broken", [("value", complex)])
+    with pytest.raises(TypeError):
+        compile_builder(Broken)
+    assert Broken not in _builders
+
+
 if __name__ == "__main__":
     print(read_settings())
 # ~\~ end
@@ -0,0 +1,218 @@
+# ~\~ language=Python filename=nymphescc/metrics.py
+# ~\~ begin <<lit/metrics.md|nymphescc/metrics.py>>[0]
+from __future__ import annotations
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import logging
+import os
+from pathlib import Path
+from threading import Event, Thread
+from typing import Callable, Optional
+
+
+class Metric:
+    """A single metric. Counters only go up, gauges go up and down. If
+    `fn` is given, the value is read from that function at export time.
+
+    Updates are plain attribute writes, cheap enough for the MIDI path.
+    Concurrent updates of the same metric from different threads may
+    occasionally be lost; each metric is updated by a single thread."""
+    def __init__(self, kind: str, fn: Optional[Callable[[], float]] = None):
+        self.kind = kind
+        self.value: float = 0
+        self._fn = fn
+
+    def inc(self, n: float = 1):
+        self.value += n
+
+    def dec(self, n: float = 1):
+        self.value -= n
+
+    def set(self, value: float):
+        self.value = value
+
+    def get(self) -> float:
+        return self._fn() if self._fn is not None else self.value
+
+
+class Summary:
+    """Keeps the count, sum and maximum of observed values."""
+    kind = "summary"
+
+    def __init__(self):
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float):
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+
+# A metric's name and labels
+Key = tuple[str, tuple[tuple[str, str], ...]]
+
+# The state of a metric as sent between processes: (name, labels, help,
+# kind, values), with values (count, sum, max) for a summary and (value,)
+# otherwise.
+Sample = tuple[str, tuple[tuple[str, str], ...], str, str, tuple[float, ...]]
+
+
+def _values(metric: Metric | Summary) -> tuple[float, ...]:
+    if isinstance(metric, Summary):
+        return (metric.count, metric.sum, metric.max)
+    return (metric.get(),)
+
+
+def _combine(kind: str, a: tuple[float, ...], b: tuple[float, ...]) -> tuple[float, ...]:
+    if kind == "summary":
+        return (a[0] + b[0], a[1] + b[1], max(a[2], b[2]))
+    return (a[0] + b[0],)
+
+
+class Registry:
+    def __init__(self):
+        self._help: dict[str, str] = {}
+        self._metrics: dict[Key, Metric | Summary] = {}
+        self._remote: dict[Key, tuple[str, tuple[float, ...]]] = {}
+
+    def _get(self, name, help, labels, new):
+        key = (name, tuple(sorted(labels.items())))
+        if key not in self._metrics:
+            self._help.setdefault(name, help)
+            self._metrics[key] = new()
+        return self._metrics[key]
+
+    def _bind(self, metric: Metric, fn) -> Metric:
+        # A metric that is read from a function follows the object that
+        # registered it last, e.g. a rebuilt Engine, not the first one.
+        if fn is not None:
+            metric._fn = fn
+        return metric
+
+    def counter(self, name: str, help: str, fn=None, **labels: str) -> Metric:
+        return self._bind(self._get(name, help, labels, lambda: Metric("counter", fn)), fn)
+
+    def gauge(self, name: str, help: str, fn=None, **labels: str) -> Metric:
+        return self._bind(self._get(name, help, labels, lambda: Metric("gauge", fn)), fn)
+
+    def summary(self, name: str, help: str, **labels: str) -> Summary:
+        return self._get(name, help, labels, Summary)
+
+    def samples(self) -> list[Sample]:
+        """The current state of all metrics, to be passed to `merge` in
+        another process."""
+        return [(name, labels, self._help[name], metric.kind, _values(metric))
+                for (name, labels), metric in list(self._metrics.items())]
+
+    def merge(self, samples: list[Sample]):
+        """Export the metrics of another process (e.g. the engine process)
+        along with our own, replacing the samples of an earlier call. Values
+        of metrics that exist in both processes are added up, and the
+        maximum of a summary is the larger of the two."""
+        for name, _, help, _, _ in samples:
+            self._help.setdefault(name, help)
+        self._remote = { (name, labels): (kind, values)
+                         for name, labels, _, kind, values in samples }
+
+    def exposition(self) -> str:
+        """Render all metrics in the Prometheus text format. The maximum
+        of a summary is not part of the summary type, so it is exported as
+        a gauge family of its own, `{name}_max`."""
+        merged = { key: (metric.kind, _values(metric))
+                   for key, metric in list(self._metrics.items()) }
+        for key, (kind, values) in self._remote.items():
+            if key in merged:
+                values = _combine(kind, merged[key][1], values)
+            merged[key] = (kind, values)
+        lines = []
+        maxima: dict[str, list[str]] = {}
+        described = set()
+        for (name, labels), (kind, values) in sorted(merged.items(), key=lambda kv: kv[0]):
+            if name not in described:
+                lines.append(f"# HELP {name} {self._help[name]}")
+                lines.append(f"# TYPE {name} {kind}")
+                described.add(name)
+            label_str = ",".join(f'{k}="{v}"' for k, v in labels)
+            label_str = f"{{{label_str}}}" if label_str else ""
+            if kind == "summary":
+                count, total, maximum = values
+                lines.append(f"{name}_count{label_str} {count}")
+                lines.append(f"{name}_sum{label_str} {total}")
+                maxima.setdefault(name, []).append(f"{name}_max{label_str} {maximum}")
+            else:
+                lines.append(f"{name}{label_str} {values[0]}")
+        for name, samples in maxima.items():
+            lines.append(f"# HELP {name}_max Maximum of {name}.")
+            lines.append(f"# TYPE {name}_max gauge")
+            lines.extend(samples)
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+
+def write_periodically(registry: Registry, path: Path, interval: float, quit_event: Event):
+    """Write the metrics to `path` every `interval` seconds, until
+    `quit_event` is set. Run this in a thread."""
+    tmp = path.with_name(path.name + ".tmp")
+    while True:
+        stop = quit_event.wait(interval)
+        tmp.write_text(registry.exposition())
+        os.replace(tmp, path)
+        if stop:
+            break
+
+
+def serve(registry: Registry, port: int, host: str = "127.0.0.1") -> ThreadingHTTPServer:
+    """Serve the metrics over HTTP at `/metrics`, in a daemon thread."""
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != "/metrics":
+                self.send_error(404)
+                return
+            body = registry.exposition().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            logging.debug("metrics: " + format, *args)
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def test_registry():
+    r = Registry()
+    a = r.counter("midi_messages_total", "MIDI messages", port="in")
+    b = r.counter("midi_messages_total", "MIDI messages", port="out")
+    assert r.counter("midi_messages_total", "MIDI messages", port="in") is a
+    a.inc()
+    b.inc(3)
+    r.gauge("depth", "queue depth", fn=lambda: 6)
+    r.gauge("depth", "queue depth", fn=lambda: 7)
+    r.summary("query_seconds", "query time").observe(0.5)
+    text = r.exposition()
+    assert '# TYPE midi_messages_total counter' in text
+    assert 'midi_messages_total{port="in"} 1' in text
+    assert 'midi_messages_total{port="out"} 3' in text
+    assert 'depth 7' in text
+    assert 'query_seconds_count 1' in text
+    assert '# TYPE query_seconds_max gauge\nquery_seconds_max 0.5' in text
+
+    other = Registry()
+    other.counter("midi_messages_total", "MIDI messages", port="in").inc(2)
+    other.gauge("connected", "device connected").set(1)
+    other.summary("query_seconds", "query time").observe(0.75)
+    r.merge(other.samples())
+    text = r.exposition()
+    assert 'midi_messages_total{port="in"} 3' in text
+    assert '# TYPE connected gauge\nconnected 1' in text
+    assert 'query_seconds_count 2' in text
+    assert 'query_seconds_max 0.75' in text
+# ~\~ end
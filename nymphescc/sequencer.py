@@ -0,0 +1,324 @@
+# ~\~ language=Python filename=nymphescc/sequencer.py
+# ~\~ begin <<lit/sequencer.md|nymphescc/sequencer.py>>[0]
+from __future__ import annotations
+import bisect
+from collections import deque
+from dataclasses import dataclass
+import time
+from threading import Condition, Event
+from typing import Callable, Iterable, Optional
+
+from .core import TransmitPlan, CONTROL_CHANGE
+from .db import StepValue
+from .sim import MIDI_BAUD, BITS_PER_BYTE
+from .metrics import registry
+
+
+# Part of the wire time of a step that the sequencer may use. The rest is
+# left for changes made by hand.
+BANDWIDTH_SHARE = 0.5
+# Intervals between clock ticks longer than this (s) are pauses of the
+# clock source, not tempo changes.
+MAX_TICK = 0.25
+
+STEP_ERROR = registry.summary(
+    "nymphescc_sequencer_step_error_seconds",
+    "Time at which a step was sent, relative to the clock tick it falls on.")
+SKIPPED_CC = registry.counter(
+    "nymphescc_sequencer_skipped_total", "Sequenced CCs skipped for lack of bandwidth.")
+
+
+@dataclass
+class Step:
+    """Messages of one step, ready to send.
+
+    Attributes:
+        midi: MIDI buffer.
+        selected: the modulator selected after sending it, if any.
+        values: (ctrl, mod, value) of every value in the buffer.
+        index: number of the step since start; None if it is not part of
+            the sequence.
+    """
+    midi: bytes
+    selected: Optional[int]
+    values: list[tuple[str, int, int]]
+    index: Optional[int] = None
+
+
+@dataclass
+class StepTable:
+    """The values of one step, encoded in plan order. The buffer can be
+    cut after any value, and still be sent on its own.
+
+    Attributes:
+        midi: MIDI buffer of all values.
+        ends: end of each value in `midi`.
+        selected: the modulator selected after each value.
+        values: (ctrl, mod, value) of each value.
+    """
+    midi: bytes
+    ends: list[int]
+    selected: list[Optional[int]]
+    values: list[tuple[str, int, int]]
+
+    @staticmethod
+    def compile(plan: TransmitPlan, values: Iterable[tuple[int, str, int]]) -> StepTable:
+        """Compile (mod, ctrl, value) triples."""
+        buffer = bytearray()
+        table = StepTable(b"", [], [], [])
+        selected = None
+        by_slot = { (mod, ctrl): value for mod, ctrl, value in values }
+        for mod, ctrl in sorted(by_slot, key=plan.index.__getitem__):
+            value = by_slot[mod, ctrl]
+            if mod != 0 and mod != selected:
+                buffer.extend((CONTROL_CHANGE, plan.selector, mod - 1))
+                selected = mod
+            buffer.extend((CONTROL_CHANGE, plan.cc[mod, ctrl], value))
+            table.ends.append(len(buffer))
+            table.selected.append(selected)
+            table.values.append((ctrl, mod, value))
+        table.midi = bytes(buffer)
+        return table
+
+    def step(self, budget: Optional[int] = None) -> tuple[Step, int]:
+        """The step, cut to at most `budget` bytes. Returns the step and the
+        number of values that were skipped."""
+        n = len(self.ends) if budget is None else bisect.bisect_right(self.ends, budget)
+        if n == 0:
+            return Step(b"", None, []), len(self.ends)
+        return Step(self.midi[:self.ends[n-1]], self.selected[n-1], self.values[:n]), \
+               len(self.ends) - n
+
+
+def compile_sequence(plan: TransmitPlan, steps: int,
+                     values: Iterable[StepValue]) -> list[StepTable]:
+    per_step: list[list[tuple[int, str, int]]] = [[] for _ in range(steps)]
+    for step, mod, ctrl, value in values:
+        if 0 <= step < steps:
+            per_step[step].append((mod, ctrl, value))
+    return [StepTable.compile(plan, v) for v in per_step]
+
+
+class Clock:
+    """Follows an incoming MIDI clock: counts ticks since the last start,
+    and measures the tick period with an exponential moving average.
+
+    Attributes:
+        tick: ticks since start; the first clock after start is tick 0.
+        last: time of the last tick.
+        period: measured time between ticks, None until measured.
+    """
+    def __init__(self, smoothing: float = 0.1):
+        self.smoothing = smoothing
+        self.running = False
+        self.tick = -1
+        self.last: Optional[float] = None
+        self.period: Optional[float] = None
+
+    def clock(self, t: float):
+        if self.last is not None and t - self.last < MAX_TICK:
+            dt = t - self.last
+            self.period = dt if self.period is None \
+                else self.period + self.smoothing * (dt - self.period)
+        self.last = t
+        if self.running:
+            self.tick += 1
+
+    def start(self):
+        self.running = True
+        self.tick = -1
+
+    def stop(self):
+        self.running = False
+
+    def resume(self):
+        self.running = True
+
+
+class Sequencer:
+    """Plays a sequence in time with an incoming MIDI clock.
+
+    Clock messages are passed to `handle`, from the thread reading the
+    port. The steps are sent from `run`, in a thread of its own: rather
+    than waiting for the tick a step falls on, it predicts the time of that
+    tick from the measured period, and plays the step ahead of it by the
+    wire time of the step and of the `backlog` waiting before it. Each tick
+    refines the prediction; if the tick arrives before the step was played,
+    the step is played right away. Every step is cut to fit in its share of
+    the wire time, minus the backlog, so that a dense sequence at a fast
+    tempo doesn't fall behind.
+
+    Whoever sends the steps reports the time each step went out through
+    `sent`; the timing error is measured against that.
+
+    Args:
+        play: sends a step; called with the lock held, so should not block.
+        release: called when the clock stops, to undo the sequenced values.
+        baud: speed of the MIDI wire.
+        backlog: number of bytes waiting to be sent before a step we play.
+    """
+    def __init__(self, play: Callable[[Step], None],
+                 release: Optional[Callable[[list[int]], None]] = None,
+                 baud: int = MIDI_BAUD, backlog: Callable[[], int] = lambda: 0):
+        self.play = play
+        self.release = release
+        self.baud = baud
+        self.backlog = backlog
+        self.clock = Clock()
+        self.tables: list[StepTable] = []
+        self.division = 6
+        self.slots: list[int] = []
+        self.skipped = 0
+        self.errors: deque[float] = deque(maxlen=4096)
+        self._cond = Condition()
+        self._next = 0
+        self._deadline: Optional[float] = None
+        # ticks and send times of steps, until we have seen both
+        self._ticks: dict[int, float] = {}
+        self._sent: dict[int, float] = {}
+
+    def load(self, plan: TransmitPlan, steps: int, division: int, values: list[StepValue]):
+        tables = compile_sequence(plan, steps, values)
+        with self._cond:
+            self.tables = tables
+            self.division = division
+            self.slots = sorted({plan.index[mod, ctrl] for _, mod, ctrl, _ in values})
+
+    def handle(self, kind: str, t: float):
+        """Handle a "clock", "start", "stop" or "continue" message,
+        received at time `t` (from `time.monotonic`)."""
+        with self._cond:
+            match kind:
+                case "clock":
+                    self.clock.clock(t)
+                    if self.clock.running and self.tables:
+                        tick = self.clock.tick
+                        if tick % self.division == 0:
+                            self._tick(tick // self.division, t)
+                        self._schedule()
+                case "start":
+                    self.clock.start()
+                    self._next = 0
+                    self._deadline = None
+                    self._ticks.clear()
+                    self._sent.clear()
+                case "continue":
+                    self.clock.resume()
+                case "stop":
+                    self.clock.stop()
+                    self._deadline = None
+                    self._ticks.clear()
+                    self._sent.clear()
+                    if self.release is not None and self.slots:
+                        self.release(self.slots)
+            self._cond.notify()
+
+    def _schedule(self):
+        boundary = self._next * self.division
+        clock = self.clock
+        if clock.tick >= boundary:
+            self._deadline = clock.last
+        elif clock.period is None:
+            self._deadline = None
+        else:
+            self._deadline = clock.last + (boundary - clock.tick) * clock.period
+
+    def _tick(self, step: int, t: float):
+        # the tick and the sending of a step can come in either order
+        sent = self._sent.pop(step, None)
+        if sent is None:
+            self._ticks[step] = t
+        else:
+            self._error(sent - t)
+
+    def sent(self, step: int, t: float):
+        """Report that step number `step` went out at time `t`."""
+        with self._cond:
+            tick = self._ticks.pop(step, None)
+            if tick is None:
+                self._sent[step] = t
+            else:
+                self._error(t - tick)
+
+    def _error(self, error: float):
+        self.errors.append(error)
+        STEP_ERROR.observe(error)
+
+    def _budget(self, backlog: int) -> Optional[int]:
+        if self.clock.period is None:
+            return None
+        wire_time = self.clock.period * self.division * BANDWIDTH_SHARE
+        return max(0, int(wire_time * self.baud / BITS_PER_BYTE) - backlog)
+
+    def _wire_time(self, n_bytes: int) -> float:
+        return n_bytes * BITS_PER_BYTE / self.baud
+
+    def run(self, quit_event: Event):
+        with self._cond:
+            while not quit_event.is_set():
+                if self._deadline is None:
+                    self._cond.wait(0.1)
+                    continue
+                n = self._next
+                backlog = self.backlog()
+                step, skipped = self.tables[n % len(self.tables)].step(self._budget(backlog))
+                lead = self._wire_time(backlog + len(step.midi))
+                delay = self._deadline - lead - time.monotonic()
+                if delay > 0:
+                    self._cond.wait(min(delay, 0.1))
+                    continue
+                step.index = n
+                self.play(step)
+                if skipped:
+                    self.skipped += skipped
+                    SKIPPED_CC.inc(skipped)
+                self._next += 1
+                self._schedule()
+
+
+def test_step_table():
+    from .core import Register, BytesPort
+    register = Register.new()
+    plan = register.plan
+    table = StepTable.compile(
+        plan, [(2, "filter.cut", 5), (0, "filter.cut", 10), (1, "filter.cut", 20)])
+    assert table.values == [("filter.cut", 0, 10), ("filter.cut", 1, 20), ("filter.cut", 2, 5)]
+    step, skipped = table.step()
+    assert skipped == 0 and step.selected == 2
+    assert sorted(register.decode(step.midi)) == \
+        [(0, "filter.cut", 10), (1, "filter.cut", 20), (2, "filter.cut", 5)]
+    step, skipped = table.step(budget=8)
+    assert skipped == 2 and step.selected is None and len(step.midi) == 3
+    step, skipped = table.step(budget=9)
+    assert skipped == 1 and step.selected == 1 and step.values[-1] == ("filter.cut", 1, 20)
+    assert table.step(budget=2)[1] == 3
+
+
+def test_sequencer():
+    from .core import Register
+    from .sim import SimulatedClock
+    from threading import Thread
+    register = Register.new()
+    played = []
+    released = []
+
+    def play(step):
+        played.append(step.values)
+        sequencer.sent(step.index, time.monotonic())
+    sequencer = Sequencer(play, released.append)
+    values = [(step, 0, "filter.cut", 10 * step) for step in range(4)]
+    sequencer.load(register.plan, 4, 6, values)
+    quit_event = Event()
+    thread = Thread(target=sequencer.run, args=(quit_event,))
+    thread.start()
+    try:
+        SimulatedClock(bpm=300).run(sequencer.handle, ticks=6 * 6)
+    finally:
+        quit_event.set()
+        thread.join()
+    assert played == [[("filter.cut", 0, 10 * (i % 4))] for i in range(6)]
+    assert released == [[register.plan.index[0, "filter.cut"]]]
+    assert len(sequencer.errors) == 6
+    # once the period is known, steps are sent ahead of their tick
+    assert max(abs(e) for e in list(sequencer.errors)[1:]) < 0.005
+# ~\~ end
@@ -0,0 +1,120 @@
+# ~\~ language=Python filename=nymphescc/setlist.py
+# ~\~ begin <<lit/setlist.md|nymphescc/setlist.py>>[0]
+from __future__ import annotations
+from dataclasses import dataclass
+from typing import Optional
+
+from .core import Register, TransmitPlan
+from .compare import Comparator
+
+
+# MIDI buffer and the modulator selected after sending it
+Delta = tuple[bytes, Optional[int]]
+
+
+@dataclass
+class SetlistEntry:
+    """A compiled setlist entry.
+
+    Attributes:
+        snapshot: id of the snapshot in the database.
+        state: decoded state vector.
+        forward: messages from the previous entry to this one.
+        backward: messages from the next entry to this one.
+    """
+    snapshot: int
+    state: bytes
+    forward: Optional[Delta]
+    backward: Optional[Delta]
+
+
+class Setlist:
+    """An ordered list of patches, ready to send.
+
+    Moving to a neighbouring entry sends only the settings in which the two
+    entries differ, from a buffer that was encoded when the setlist was
+    loaded. If the live state was changed since the last recall, the
+    difference with the live state is encoded instead.
+    """
+    def __init__(self, plan: TransmitPlan, entries: list[SetlistEntry]):
+        self.plan = plan
+        self.entries = entries
+        self.position: Optional[int] = None
+
+    def __len__(self):
+        return len(self.entries)
+
+    @staticmethod
+    def compile(register: Register, snapshots: list[tuple[int, bytes]]) -> Setlist:
+        """Compile a setlist from (snapshot id, midi) pairs. Snapshots that
+        don't contain all settings are decoded on top of their predecessor
+        (the first on top of the current register)."""
+        plan = register.plan
+        comparator = Comparator(register)
+        states = []
+        base = comparator.state(register.snapshot())
+        for _, midi in snapshots:
+            base = comparator.state(midi, base)
+            states.append(base.tobytes())
+        n = len(states)
+        entries = [SetlistEntry(
+                snap_id, state,
+                plan.encode_diff(states[i-1], state) if i > 0 else None,
+                plan.encode_diff(states[i+1], state) if i < n - 1 else None)
+            for i, ((snap_id, _), state) in enumerate(zip(snapshots, states))]
+        return Setlist(plan, entries)
+
+    def recall(self, index: int, live: bytes) -> tuple[bytes, Delta]:
+        """Move to entry `index`, given the `live` state vector. Returns the
+        state of the entry and the messages to send."""
+        entry = self.entries[index]
+        current = self.position
+        delta: Optional[Delta] = None
+        if current is not None and live == self.entries[current].state:
+            if current == index - 1:
+                delta = entry.forward
+            elif current == index + 1:
+                delta = entry.backward
+        if delta is None:
+            delta = self.plan.encode_diff(live, entry.state)
+        self.position = index
+        return entry.state, delta
+
+
+def test_setlist():
+    from .sim import SimulatedNymphes
+    patches = []
+    for cut, mix in ((10, 0), (20, 100), (20, 50)):
+        r = Register.new()
+        r.write("filter.cut", 0, cut)
+        r.write("reverb.mix", 3, mix)
+        patches.append(r)
+
+    register = Register.new()
+    device = SimulatedNymphes(Register.new())
+    setlist = Setlist.compile(
+        register, [(i, p.snapshot().midi()) for i, p in enumerate(patches)])
+    assert len(setlist) == 3
+
+    def recall(index):
+        state, (midi, selected) = setlist.recall(index, register.snapshot().state)
+        device.send_midi(midi)
+        register.load_state(state)
+        return midi
+
+    assert len(recall(0)) == 3
+    device.assert_state(patches[0])
+    # neighbours come precompiled: a value and a selector plus value
+    assert recall(1) is setlist.entries[1].forward[0]
+    assert len(setlist.entries[1].forward[0]) == 9
+    device.assert_state(patches[1])
+    assert recall(2) is setlist.entries[2].forward[0]
+    assert recall(1) is setlist.entries[1].backward[0]
+    device.assert_state(patches[1])
+
+    # after a change to the live state, the difference is encoded again
+    register.write("filter.cut", 0, 99)
+    device.send_midi(register.snapshot().midi())
+    assert recall(0) is not setlist.entries[0].backward[0]
+    device.assert_state(patches[0])
+# ~\~ end
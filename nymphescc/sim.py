@@ -0,0 +1,247 @@
+# ~\~ language=Python filename=nymphescc/sim.py
+# ~\~ begin <<lit/simulator.md|nymphescc/sim.py>>[0]
+from __future__ import annotations
+from dataclasses import dataclass
+import queue
+from queue import Queue
+import random
+import time
+from threading import Event
+from typing import Callable, Iterator, Optional
+
+import mido
+
+from .core import Register, Announcement
+
+
+# MIDI runs at 31250 baud, with 10 bits per byte (start, 8 data, stop).
+MIDI_BAUD = 31250
+BITS_PER_BYTE = 10
+# ALSA client id of the simulated device.
+CLIENT_ID = 24
+
+
+@dataclass
+class Selector:
+    selected_mod: int = 1
+
+
+class SimulatedNymphes:
+    """In-process stand-in for the Nymphes. Implements the output port
+    interface of `AlsaPort`; use `input_port` to read from the device.
+
+    The device keeps its own register and follows the modulator selector
+    the way the real device does. Time spent on the MIDI wire is accounted
+    in `wire_time`, and only actually waited for if `realtime` is set.
+    The device can be unplugged and plugged in again; messages sent while
+    it is unplugged are lost.
+
+    Args:
+        register: register of the device, defaults to `Register.new()`.
+        echo: echo every parameter change back to the host.
+        baud: speed of the MIDI wire.
+        realtime: wait for the wire time of every message.
+        drop_rate: probability that an incoming message is lost.
+        corrupt_rate: probability that the value of an incoming message
+            is replaced by a random value.
+        seed: seed for fault injection.
+    """
+    def __init__(self, register: Optional[Register] = None, echo: bool = False,
+                 baud: int = MIDI_BAUD, realtime: bool = False,
+                 drop_rate: float = 0.0, corrupt_rate: float = 0.0,
+                 seed: Optional[int] = None):
+        self.selected_mod = 0
+        self.state = register or Register.new()
+        self.echo = echo
+        self.baud = baud
+        self.realtime = realtime
+        self.drop_rate = drop_rate
+        self.corrupt_rate = corrupt_rate
+        self.wire_time = 0.0
+        self.plugged = True
+        self.received = 0
+        self.dropped = 0
+        self.corrupted = 0
+        self.unknown = 0
+        self.selector_switches = 0
+        self._device = Selector()
+        self._random = random.Random(seed)
+        self._out: Queue[tuple[int, int, int]] = Queue()
+        self._announce: Queue[Announcement] = Queue()
+
+    def is_input_port(self) -> bool:
+        return True
+
+    def is_output_port(self) -> bool:
+        return True
+
+    def auto_connect(self) -> bool:
+        return self.plugged
+
+    def exited(self, client_id: int, port_id: Optional[int]):
+        pass
+
+    def unplug(self):
+        self.plugged = False
+        self._announce.put(("exit", CLIENT_ID, None))
+
+    def plug(self, register: Optional[Register] = None):
+        """Plug the device in again. It comes up with the settings in
+        `register`, by default `Register.new()`, as after power on."""
+        self.state = register or Register.new()
+        self._device = Selector()
+        self.plugged = True
+        self._announce.put(("start", CLIENT_ID, None))
+        self._announce.put(("start", CLIENT_ID, 0))
+
+    def announce(self) -> SimulatedAnnounce:
+        return SimulatedAnnounce(self)
+
+    def send_cc(self, channel: int, param: int, value: int):
+        self._wire(3)
+        self._receive(channel, param, value)
+
+    def send_midi(self, buffer: bytes):
+        self._wire(len(buffer))
+        for i in range(0, len(buffer), 3):
+            status, param, value = buffer[i:i+3]
+            self._receive(status & 0x0f, param, value)
+
+    def read_cc(self, quit_event: Event, timeout=0.1) -> Iterator[tuple[int, int, int]]:
+        while True:
+            try:
+                yield self._out.get(timeout=timeout)
+            except queue.Empty:
+                if quit_event.is_set():
+                    return
+
+    def input_port(self) -> SimulatedInput:
+        return SimulatedInput(self)
+
+    def _wire(self, n_bytes: int):
+        dt = n_bytes * BITS_PER_BYTE / self.baud
+        self.wire_time += dt
+        if self.realtime:
+            time.sleep(dt)
+
+    def _receive(self, channel: int, param: int, value: int):
+        if not self.plugged:
+            return
+        self.received += 1
+        if self._random.random() < self.drop_rate:
+            self.dropped += 1
+            return
+        if self._random.random() < self.corrupt_rate:
+            self.corrupted += 1
+            value = self._random.randrange(128)
+        if param not in self.state.midi_map:
+            self.unknown += 1
+            return
+        if param == self.state.plan.selector:
+            self.selector_switches += 1
+        for _ in self.state.ingest(self._device, [(channel, param, value)]):
+            pass
+        if self.echo:
+            self._out.put((channel, param, value))
+
+    def diff(self, register: Register) -> list[tuple[int, str, int, int]]:
+        """Returns (mod, ctrl, device value, register value) for every
+        setting where the device differs from `register`."""
+        return [(mod, ctrl, self.state.values[mod][ctrl], register.values[mod][ctrl])
+                for mod, ctrl in register.plan.slots
+                if self.state.values[mod][ctrl] != register.values[mod][ctrl]]
+
+    def assert_state(self, register: Register):
+        differences = self.diff(register)
+        assert not differences, f"device state differs: {differences}"
+
+
+class SimulatedInput:
+    """Input port of a `SimulatedNymphes`, with its own view of the selected
+    modulator, like an `AlsaPort` with caps "in"."""
+    def __init__(self, device: SimulatedNymphes):
+        self.selected_mod = 0
+        self._device = device
+
+    def auto_connect(self) -> bool:
+        return self._device.plugged
+
+    def exited(self, client_id: int, port_id: Optional[int]):
+        pass
+
+    def read_cc(self, quit_event: Event, timeout=0.1) -> Iterator[tuple[int, int, int]]:
+        return self._device.read_cc(quit_event, timeout)
+
+    def read_midi(self, quit_event: Event, timeout=0.1) -> Iterator[mido.Message]:
+        for channel, param, value in self.read_cc(quit_event, timeout):
+            yield mido.Message("control_change", channel=channel, control=param, value=value)
+
+
+class SimulatedAnnounce:
+    """Announcements of a `SimulatedNymphes` being plugged in and out,
+    like an `AlsaAnnounce`."""
+    def __init__(self, device: SimulatedNymphes):
+        self._queue = device._announce
+
+    def events(self, quit_event: Event, timeout=0.1) -> Iterator[Announcement]:
+        while True:
+            try:
+                yield self._queue.get(timeout=timeout)
+            except queue.Empty:
+                if quit_event.is_set():
+                    return
+
+
+class SimulatedClock:
+    """A MIDI clock source: start, a number of clock ticks at a steady
+    tempo, and stop, in real time.
+
+    Args:
+        bpm: tempo in quarter notes per minute (24 ticks each).
+        jitter: standard deviation (s) of the timing of each tick.
+        seed: seed for the jitter.
+    """
+    def __init__(self, bpm: float = 120, jitter: float = 0.0, seed: Optional[int] = None):
+        self.period = 60 / (bpm * 24)
+        self.jitter = jitter
+        self._random = random.Random(seed)
+
+    def run(self, handle: Callable[[str, float], None], ticks: int) -> list[float]:
+        """Send the messages to `handle(kind, time)`. Returns the times at
+        which the ticks were due."""
+        t0 = time.monotonic() + self.period
+        handle("start", time.monotonic())
+        due = []
+        for k in range(ticks):
+            t = t0 + k * self.period + self._random.gauss(0, self.jitter)
+            due.append(t)
+            delay = t - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            handle("clock", time.monotonic())
+        handle("stop", time.monotonic())
+        return due
+
+
+def test_simulated_device():
+    import pytest
+    register = Register.new()
+    register.write("filter.cut", 0, 64)
+    register.write("reverb.mix", 3, 100)
+    device = SimulatedNymphes(Register.new())
+    register.send_all(device)
+    device.assert_state(register)
+    assert device.selector_switches == 4
+    assert device.wire_time == pytest.approx(len(register.plan.template) * 10 / 31250)
+
+    register.send_cc(device, "reverb.mix", 2, 17)
+    with pytest.raises(AssertionError):
+        device.assert_state(register)
+    register.write("reverb.mix", 2, 17)
+    device.assert_state(register)
+
+    lossy = SimulatedNymphes(Register.new(), drop_rate=0.5, seed=1)
+    register.send_all(lossy)
+    assert lossy.dropped > 0
+    assert lossy.diff(register)
+# ~\~ end
@@ -0,0 +1,117 @@
+# ~\~ language=Python filename=nymphescc/trace.py
+# ~\~ begin <<lit/tracing.md|nymphescc/trace.py>>[0]
+from __future__ import annotations
+from collections import defaultdict, deque
+import itertools
+import threading
+import time
+from typing import Iterable, Iterator, Optional, TypeVar
+
+T = TypeVar("T")
+
+# A token collects (stage, time) stamps along the path of a single message.
+# When tracing is disabled, tokens are None.
+Token = Optional[list[tuple[str, int]]]
+
+
+class Tracer:
+    """Records the latency between stages on the path of a message.
+
+    Args:
+        capacity: number of samples kept per stage.
+    """
+    def __init__(self, capacity: int = 10000):
+        self.enabled = False
+        # Each reader thread (device, through) stamps its own input time.
+        self._input = threading.local()
+        self._capacity = capacity
+        self._samples: defaultdict[str, deque[int]] = \
+            defaultdict(lambda: deque(maxlen=self._capacity))
+
+    @property
+    def last_input(self) -> int:
+        """Arrival time of the last message read on the current thread."""
+        return getattr(self._input, "time", 0)
+
+    def enable(self):
+        self.enabled = True
+
+    def start(self, stage: str) -> Token:
+        if not self.enabled:
+            return None
+        return [(stage, time.perf_counter_ns())]
+
+    def stamp(self, token: Token, stage: str):
+        if token is not None:
+            token.append((stage, time.perf_counter_ns()))
+
+    def finish(self, token: Token, stage: str):
+        """Add a last stamp, and record the time spent in every stage."""
+        if token is None:
+            return
+        self.stamp(token, stage)
+        for (a, t0), (b, t1) in itertools.pairwise(token):
+            self._samples[f"{a} → {b}"].append(t1 - t0)
+        self._samples[f"{token[0][0]} → {stage} (total)"].append(token[-1][1] - token[0][1])
+
+    def inputs(self, messages: Iterable[T]) -> Iterator[T]:
+        """Pass through `messages`, remembering when the last one arrived.
+        Use `start_input` to start a token from that time."""
+        for msg in messages:
+            self._input.time = time.perf_counter_ns()
+            yield msg
+
+    def start_input(self, stage: str) -> Token:
+        if not self.enabled:
+            return None
+        return [("input", self.last_input), (stage, time.perf_counter_ns())]
+
+    def stats(self) -> dict[str, dict[str, float]]:
+        """Latency statistics per stage, in milliseconds."""
+        result = {}
+        for name, samples in list(self._samples.items()):
+            s = sorted(samples)
+            if not s:
+                continue
+            result[name] = { "count": len(s)
+                           , "p50": s[len(s) // 2] / 1e6
+                           , "p99": s[min(len(s) - 1, len(s) * 99 // 100)] / 1e6
+                           , "max": s[-1] / 1e6 }
+        return result
+
+    def dump(self) -> str:
+        lines = [f"{'stage':50} {'count':>8} {'p50 ms':>9} {'p99 ms':>9} {'max ms':>9}"]
+        for name, s in self.stats().items():
+            lines.append(f"{name:50} {s['count']:8} {s['p50']:9.3f} {s['p99']:9.3f} {s['max']:9.3f}")
+        return "\n".join(lines)
+
+
+tracer = Tracer()
+
+
+def test_tracer():
+    t = Tracer()
+    assert t.start("a") is None
+    t.finish(None, "b")
+    assert t.stats() == {}
+
+    t.enable()
+    for _ in range(10):
+        token = t.start("a")
+        t.stamp(token, "b")
+        t.finish(token, "c")
+    stats = t.stats()
+    assert set(stats) == {"a → b", "b → c", "a → c (total)"}
+    assert stats["a → b"]["count"] == 10
+    assert stats["a → c (total)"]["max"] >= stats["a → b"]["p50"]
+
+    list(t.inputs([1, 2]))
+    token = t.start_input("read")
+    assert token[0] == ("input", t.last_input)
+
+    other = threading.Thread(target=lambda: list(t.inputs([3])))
+    last = t.last_input
+    other.start()
+    other.join()
+    assert t.last_input == last
+# ~\~ end
@@ -0,0 +1,126 @@
+# ~\~ language=Python filename=nymphescc/watchdog.py
+# ~\~ begin <<lit/watchdog.md|nymphescc/watchdog.py>>[0]
+from __future__ import annotations
+from collections import Counter
+from dataclasses import dataclass, field
+import logging
+from pathlib import Path
+import sys
+import threading
+from threading import Event
+import time
+import traceback
+from typing import Optional
+
+from .metrics import registry
+
+
+STALLS = registry.counter(
+    "nymphescc_main_loop_stalls_total", "Stalls of the GTK main loop.")
+STALL_TIME = registry.summary(
+    "nymphescc_main_loop_stall_seconds", "Duration of main loop stalls.")
+
+PACKAGE_DIR = str(Path(__file__).parent)
+
+
+@dataclass
+class StallReport:
+    samples: Counter[str] = field(default_factory=Counter)
+    stacks: dict[str, str] = field(default_factory=dict)
+    stalls: int = 0
+    total_time: float = 0.0
+    max_time: float = 0.0
+
+
+class Watchdog:
+    """Detects stalls of the main loop.
+
+    The main loop should call `beat` every `interval` seconds. A separate
+    thread (`run`) checks that it does; if the last beat is older than
+    `threshold` seconds, the main loop is stalled. While stalled, we sample
+    the stack of the main thread every `interval`, and aggregate the
+    samples by the innermost frame in NymphesCC: the offending handler.
+
+    Args:
+        threshold: time (s) after which we consider the main loop stalled.
+        interval: time (s) between heartbeats and samples.
+        thread_id: id of the thread running the main loop.
+    """
+    def __init__(self, threshold: float = 0.1, interval: float = 0.02,
+                 thread_id: Optional[int] = None):
+        self.threshold = threshold
+        self.interval = interval
+        self.report = StallReport()
+        self._thread_id = thread_id or threading.main_thread().ident
+        self._last_beat = time.monotonic()
+        self._stalled_since: Optional[float] = None
+
+    def beat(self) -> bool:
+        self._last_beat = time.monotonic()
+        return True
+
+    def run(self, quit_event: Event):
+        while not quit_event.wait(self.interval):
+            self.check()
+
+    def check(self):
+        last_beat = self._last_beat
+        now = time.monotonic()
+        if now - last_beat > self.threshold:
+            if self._stalled_since is None:
+                self._stalled_since = last_beat
+            self.sample()
+        elif self._stalled_since is not None:
+            self._stall_ended(last_beat - self._stalled_since)
+
+    def sample(self):
+        frame = sys._current_frames().get(self._thread_id)
+        if frame is None:
+            return
+        stack = traceback.extract_stack(frame)
+        ours = [f for f in stack if f.filename.startswith(PACKAGE_DIR)] or stack
+        where = f"{Path(ours[-1].filename).name}:{ours[-1].lineno} in {ours[-1].name}"
+        self.report.samples[where] += 1
+        self.report.stacks.setdefault(where, "".join(traceback.format_list(stack)))
+
+    def _stall_ended(self, duration: float):
+        self._stalled_since = None
+        self.report.stalls += 1
+        self.report.total_time += duration
+        self.report.max_time = max(self.report.max_time, duration)
+        STALLS.inc()
+        STALL_TIME.observe(duration)
+        logging.warning("main loop stalled for %.0f ms", duration * 1000)
+
+    def dump(self) -> str:
+        r = self.report
+        lines = [f"{r.stalls} stalls, total {r.total_time * 1000:.0f} ms, "
+                 f"max {r.max_time * 1000:.0f} ms"]
+        for where, n in r.samples.most_common():
+            lines.append(f"{n:6} samples  {where}")
+        if r.samples:
+            worst = r.samples.most_common(1)[0][0]
+            lines.append(f"stack of {worst}:\n{r.stacks[worst]}")
+        return "\n".join(lines)
+
+
+def test_watchdog():
+    quit_event = Event()
+    watchdog = Watchdog(threshold=0.05, interval=0.01, thread_id=threading.get_ident())
+    thread = threading.Thread(target=watchdog.run, args=(quit_event,))
+    thread.start()
+
+    def stalling_handler():
+        time.sleep(0.2)
+
+    watchdog.beat()
+    stalling_handler()
+    watchdog.beat()
+    time.sleep(0.05)
+    quit_event.set()
+    thread.join()
+
+    assert watchdog.report.stalls == 1
+    assert watchdog.report.max_time >= 0.15
+    assert any("stalling_handler" in where for where in watchdog.report.samples)
+# ~\~ end